@@ -12,13 +12,19 @@ import re
 import asyncio
 import logging
 import threading
+import contextvars
 from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, WebAppInfo
-from contextlib import asynccontextmanager
+from telegram import InputMediaPhoto, InputMediaVideo, InputMediaAudio, InputMediaDocument
+from contextlib import asynccontextmanager, nullcontext
+from pathlib import Path
 import uuid
 import time
+import json
+import shutil
+import weakref
 
 # Load environment variables from .env file
 load_dotenv(override=True)
@@ -34,7 +40,7 @@ from telethon import TelegramClient
 from telethon.sessions import StringSession
 from telethon.tl.types import MessageMediaPhoto
 from telethon.errors import (
-    ChannelPrivateError, ChatForbiddenError, InviteHashExpiredError,
+    ChannelPrivateError, ChannelInvalidError, ChatForbiddenError, InviteHashExpiredError,
     InviteHashInvalidError, FloodWaitError, UserAlreadyParticipantError,
     SessionPasswordNeededError, AuthKeyUnregisteredError, UserDeactivatedError
 )
@@ -49,8 +55,27 @@ from database import (
     get_user_session, has_active_session, delete_user_session, set_user_session,
     confirm_referral, check_and_reward_referrer, get_referral_stats,
     check_and_reset_daily_limits,
-    get_next_pending_download, update_download_status,
-    try_acquire_bot_leadership
+    claim_pending_downloads, update_download_status,
+    get_cancelled_download_ids, add_download_listener, QUEUE_NOTIFY_ADDR,
+    renew_download_leases, reclaim_expired_downloads, release_download_leases,
+    update_download_progress, enqueue_download, defer_download, retry_download, get_next_available_at,
+    try_acquire_bot_leadership,
+    get_cached_media, save_cached_media, delete_cached_media,
+    get_download_journal, save_download_journal, delete_download_journal,
+    get_cached_entity, save_cached_entities, delete_cached_entity,
+    get_setting, set_setting
+)
+from media_pipeline import (
+    BOT_SEND_METHODS, media_cache_keys, extract_sent_file_id, ChunkPipe,
+    ParallelDownloader, classify_size, DOWNLOAD_PART_SIZE,
+    chunk_checksum, verify_partial_file,
+    ALBUM_MEDIA_FAMILIES, plan_media_groups,
+    UserClientPool, SingleFlight, FairScheduler,
+    DOWNLOAD_LANE_NAMES, choose_lane, progress_throttle, BandwidthGovernor,
+    flood_wait_seconds, FloodRegistry, MetricsRegistry,
+    media_dc_id, ThroughputEstimator, StallGuard, StallGuardGroup, TransferStalled, UploadPathSelector,
+    SpoolManager, TransferRegistry, BotSenderPool, ExportedSenderCache,
+    parse_telegram_link, normalize_telegram_link
 )
 
 # Unique ID for this instance
@@ -172,6 +197,137 @@ WAITING_FOR_LINK = 1
 MAX_RETRIES = 3
 RETRY_DELAY = 2  # seconds
 
+# Pool de clientes Telethon de usuario (conexiones reutilizadas entre peticiones)
+USER_CLIENT_POOL_SIZE = int(os.getenv('USER_CLIENT_POOL_SIZE', '100'))
+USER_CLIENT_IDLE_TIMEOUT = int(os.getenv('USER_CLIENT_IDLE_TIMEOUT', '900'))  # segundos
+USER_CLIENT_HEALTH_TTL = 600  # Revalidar la sesión con get_me() como mucho cada 10 min
+# Senders exportados para media en otro DC: se mantienen por (usuario, DC) entre peticiones
+EXPORTED_SENDER_IDLE_TIMEOUT = int(os.getenv('EXPORTED_SENDER_IDLE_TIMEOUT', '600'))
+
+# Streaming descarga->subida (sin archivo temporal) cuando bot_client está disponible
+STREAMING_UPLOAD_ENABLED = os.getenv('STREAMING_UPLOAD', 'true').lower() == 'true'
+
+# Conexiones (peticiones de partes concurrentes) por clase de tamaño para la descarga paralela
+DOWNLOAD_CONNECTIONS = {
+    'small': int(os.getenv('DOWNLOAD_CONNECTIONS_SMALL', '2')),
+    'medium': int(os.getenv('DOWNLOAD_CONNECTIONS_MEDIUM', '4')),
+    'large': int(os.getenv('DOWNLOAD_CONNECTIONS_LARGE', '8')),
+}
+
+# Descargas reanudables: el parcial y su diario sobreviven a un timeout
+# Spool gestionado para los temporales del pipeline: cuota reservada por
+# trabajo (con su file_size) antes de empezar y barrido de huérfanos. Las
+# descargas parciales que se guardan para reanudar cuentan contra la misma
+# cuota y se desalojan (las más antiguas) cuando un trabajo nuevo no cabe.
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'bot_spool'))
+SPOOL_QUOTA_MB = int(os.getenv('SPOOL_QUOTA_MB', '8192'))
+SPOOL_MIN_FREE_MB = int(os.getenv('SPOOL_MIN_FREE_MB', '512'))
+SPOOL_ORPHAN_AGE = 3600  # Archivos sin trabajo activo más viejos que esto son huérfanos
+SPOOL_SWEEP_INTERVAL = 600
+PARTIAL_MAX_AGE = 24 * 3600  # Las descargas parciales se conservan un día para reanudar
+download_spool = SpoolManager(
+    SPOOL_DIR, SPOOL_QUOTA_MB * 1024 * 1024, SPOOL_MIN_FREE_MB * 1024 * 1024,
+    on_evict=lambda path: forget_partial_journal(path)
+)
+
+PARTIAL_DOWNLOADS_DIR = os.getenv('PARTIAL_DOWNLOADS_DIR', os.path.join(SPOOL_DIR, 'partials'))
+JOURNAL_EVERY_PARTS = 16  # Guardar el diario cada 16 partes (8 MB)
+_partial_locks = weakref.WeakValueDictionary()
+
+# Carriles de descarga por clase de tamaño: cada uno con su planificador justo
+# (slots) y su presupuesto de ancho de banda en MB/s (0 = sin límite)
+DOWNLOAD_LANES = {
+    'photo': {
+        'slots': int(os.getenv('LANE_PHOTO_SLOTS', '8')),
+        'bandwidth_mbps': float(os.getenv('LANE_PHOTO_MBPS', '0')),
+    },
+    'medium': {
+        'slots': int(os.getenv('LANE_MEDIUM_SLOTS', '4')),
+        'bandwidth_mbps': float(os.getenv('LANE_MEDIUM_MBPS', '0')),
+    },
+    'large': {
+        'slots': int(os.getenv('LANE_LARGE_SLOTS', '2')),
+        'bandwidth_mbps': float(os.getenv('LANE_LARGE_MBPS', '0')),
+    },
+}
+MAX_CONCURRENT_DOWNLOADS = sum(DOWNLOAD_LANES[lane]['slots'] for lane in DOWNLOAD_LANE_NAMES)
+DOWNLOAD_PRIORITY_WEIGHTS = {0: 1, 1: 2, 2: 4}  # premium_level -> peso (Free, Premium, VIP)
+DOWNLOAD_USER_CAPS = {0: 1, 1: 2, 2: 3}         # premium_level -> descargas simultáneas por carril
+download_lanes = {
+    lane: FairScheduler(DOWNLOAD_LANES[lane]['slots'], name=lane)
+    for lane in DOWNLOAD_LANE_NAMES
+}
+
+# Gobernador global de ancho de banda (MB/s, 0 = sin límite): entrada y salida
+# compartidas por todas las rutas, con cuota máxima por carril. Se puede
+# cambiar en caliente desde el panel (setting 'bandwidth_config').
+BANDWIDTH_INGRESS_MBPS = float(os.getenv('BANDWIDTH_INGRESS_MBPS', '0'))
+BANDWIDTH_EGRESS_MBPS = float(os.getenv('BANDWIDTH_EGRESS_MBPS', '0'))
+BANDWIDTH_SETTING_KEY = 'bandwidth_config'
+bandwidth_governor = BandwidthGovernor(
+    BANDWIDTH_INGRESS_MBPS, BANDWIDTH_EGRESS_MBPS,
+    lane_mbps={lane: DOWNLOAD_LANES[lane]['bandwidth_mbps'] for lane in DOWNLOAD_LANE_NAMES}
+)
+
+# Single-flight: transferencias idénticas concurrentes comparten una sola descarga
+media_singleflight = SingleFlight()
+SINGLEFLIGHT_MAX_WAITS = 3
+
+# Timeouts adaptativos: una transferencia se abandona cuando deja de progresar
+# (entre STALL_TIMEOUT_MIN y STALL_TIMEOUT_MAX segundos sin bytes, según el
+# throughput medido por DC/ruta), no por una duración fija
+STALL_TIMEOUT_MIN = int(os.getenv('STALL_TIMEOUT_MIN', '15'))
+STALL_TIMEOUT_MAX = int(os.getenv('STALL_TIMEOUT_MAX', '120'))
+STALL_TIMEOUT_DEFAULT = 45  # Sin mediciones todavía
+QUEUE_JOB_MAX_SECONDS = int(os.getenv('QUEUE_JOB_MAX_SECONDS', str(3 * 3600)))  # Solo red de seguridad
+transfer_throughput = ThroughputEstimator()
+
+# Servidor Bot API propio (telegram-bot-api --local). En modo local los archivos
+# del spool se envían por ruta en vez de subirse por multipart y el límite pasa
+# de 50 MB a 2 GB; el servidor tiene que ver el mismo disco que SPOOL_DIR.
+BOT_API_SERVER_URL = (os.getenv('BOT_API_SERVER_URL', '') or '').strip().rstrip('/')
+BOT_API_LOCAL_MODE = bool(BOT_API_SERVER_URL) and os.getenv('BOT_API_LOCAL_MODE', 'true').lower() == 'true'
+
+# Selección de ruta de subida (MTProto con bot_client o Bot API con PTB)
+BOT_API_UPLOAD_LIMIT = (2000 if BOT_API_LOCAL_MODE else 50) * 1024 * 1024
+upload_selector = UploadPathSelector()
+
+# Emisores MTProto del bot para las subidas: bot_client y clones que comparten
+# su clave de autorización en conexiones propias (sin volver a iniciar sesión)
+BOT_UPLOAD_SENDERS = int(os.getenv('BOT_UPLOAD_SENDERS', '3'))
+bot_sender_pool = BotSenderPool(lambda index: connect_bot_sender(index), size=BOT_UPLOAD_SENDERS)
+
+# FloodWait: ventanas por sesión de usuario y por ruta del bot. Los trabajos
+# contra una sesión limitada se aplazan en la cola persistente (hasta
+# FLOOD_MAX_DEFER segundos y FLOOD_MAX_DEFERRALS veces); más allá se informa
+# al usuario como antes.
+FLOOD_MAX_DEFER = int(os.getenv('FLOOD_MAX_DEFER', '1800'))
+FLOOD_MAX_DEFERRALS = 3
+BOT_PATH_PTB = 'bot:ptb'
+BOT_PATH_MTPROTO = 'bot:mtproto'
+flood_registry = FloodRegistry()
+
+# Métricas del pipeline, publicadas en settings para el panel (otro proceso)
+PIPELINE_METRICS_KEY = 'pipeline_metrics'
+PIPELINE_METRICS_INTERVAL = 5
+pipeline_metrics = MetricsRegistry()
+
+# Progreso en vivo: registro de transferencias y ediciones del mensaje de estado
+# agrupadas (como mucho una cada PROGRESS_EDIT_INTERVAL segundos por mensaje)
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '4'))
+transfer_registry = TransferRegistry()
+
+# Cancelación: botón en el mensaje de estado y cancelaciones de la MiniApp
+# (el panel marca la fila como 'cancelled' y el bot lo comprueba periódicamente)
+CANCEL_CALLBACK_DATA = 'cancel_download'
+USER_CANCEL_MSG = 'user_cancelled'
+CANCELLED_TEXT = "🛑 *Descarga cancelada*\n\nNo se ha descontado de tu límite diario."
+MINIAPP_CANCEL_POLL_INTERVAL = 3
+
+# Álbumes: descargas concurrentes por álbum y presupuesto de subida por send_media_group
+ALBUM_FETCH_CONCURRENCY = int(os.getenv('ALBUM_FETCH_CONCURRENCY', '4'))
+ALBUM_GROUP_MAX_BYTES = BOT_API_UPLOAD_LIMIT  # Límite de subida del Bot API
+
 # Global flag to prevent multiple bot instances (Conflict 409 protection)
 _bot_instance_running = False
 _bot_instance_lock = threading.Lock()
@@ -205,6 +361,7 @@ async def retry_on_error(func, *args, max_retries=MAX_RETRIES, delay=RETRY_DELAY
                 logger.error(f"All {max_retries} attempts failed for {func.__name__}")
                 raise
         except RetryAfter as e:
+            flood_registry.record(BOT_PATH_PTB, flood_wait_seconds(e))
             wait_time = e.retry_after + 1
             logger.warning(f"Rate limited. Waiting {wait_time} seconds...")
             await asyncio.sleep(wait_time)
@@ -220,32 +377,355 @@ async def retry_on_error(func, *args, max_retries=MAX_RETRIES, delay=RETRY_DELAY
     return None
 
 
+user_client_pool = UserClientPool(
+    lambda session_string: TelegramClient(StringSession(session_string), int(TELEGRAM_API_ID), TELEGRAM_API_HASH),
+    max_open=USER_CLIENT_POOL_SIZE,
+    idle_timeout=USER_CLIENT_IDLE_TIMEOUT,
+    health_ttl=USER_CLIENT_HEALTH_TTL
+)
+exported_senders = ExportedSenderCache(idle_timeout=EXPORTED_SENDER_IDLE_TIMEOUT)
+
+
+async def _invalidate_user_session(user_id: int):
+    """Limpia una sesión de usuario rechazada por Telegram"""
+    logger.error(f"❌ Sesión inválida detectada para usuario {user_id}. Limpiando...")
+    await user_client_pool.discard(user_id)
+    delete_user_session(user_id)
+    # Intentar borrar el archivo físico .session si existe (opcional pero recomendado)
+    try:
+        session_file = f"sessions/session_{user_id}.session"
+        if os.path.exists(session_file):
+            os.remove(session_file)
+    except: pass
+
+
 @asynccontextmanager
 async def get_user_client(user_id: int):
-    """Obtiene un cliente de Telethon para el usuario y verifica su sesión"""
+    """Obtiene del pool un cliente de Telethon conectado para el usuario y verifica su sesión"""
     session_string = get_user_session(user_id)
     if not session_string:
+        await user_client_pool.discard(user_id)
         raise ValueError("No session found for user")
     
-    client = TelegramClient(StringSession(session_string), int(TELEGRAM_API_ID), TELEGRAM_API_HASH)
-    await client.connect()
+    try:
+        # Verificación de la sesión (get_me) solo si el cliente es nuevo o la última es antigua
+        client = await user_client_pool.acquire(user_id, session_string)
+    except (AuthKeyUnregisteredError, UserDeactivatedError, SessionPasswordNeededError):
+        await _invalidate_user_session(user_id)
+        raise ValueError("Invalid session")
     
     try:
-        # Verificación activa de la sesión
-        await client.get_me()
         yield client
     except (AuthKeyUnregisteredError, UserDeactivatedError, SessionPasswordNeededError):
-        logger.error(f"❌ Sesión inválida detectada para usuario {user_id}. Limpiando...")
-        delete_user_session(user_id)
-        # Intentar borrar el archivo físico .session si existe (opcional pero recomendado)
-        try:
-            session_file = f"sessions/session_{user_id}.session"
-            if os.path.exists(session_file):
-                os.remove(session_file)
-        except: pass
+        await _invalidate_user_session(user_id)
         raise ValueError("Invalid session")
     finally:
-        await client.disconnect()
+        # El cliente queda conectado en el pool para la siguiente petición
+        user_client_pool.release(user_id)
+
+
+def partial_file_key(path: str) -> Optional[str]:
+    """Clave del diario de una descarga parcial (None si la ruta no es un parcial)"""
+    if os.path.dirname(path) != PARTIAL_DOWNLOADS_DIR or not path.endswith('.part'):
+        return None
+    return f"doc:{os.path.basename(path)[:-len('.part')]}"
+
+
+def forget_partial_journal(path: str):
+    """Borra el diario de un parcial desalojado del spool (ya no se puede reanudar)"""
+    file_key = partial_file_key(path)
+    if not file_key:
+        return
+    journal = get_download_journal(file_key)
+    if journal and journal['path'] == path:
+        delete_download_journal(file_key)
+
+
+def keep_spool_file(path: str) -> bool:
+    """En el barrido del spool, conserva las descargas parciales con diario válido"""
+    file_key = partial_file_key(path)
+    if not file_key:
+        return False
+    journal = get_download_journal(file_key)
+    if not journal or journal['path'] != path:
+        return False
+    if time.time() - os.path.getmtime(path) > PARTIAL_MAX_AGE:
+        delete_download_journal(file_key)
+        return False
+    return True
+
+
+def list_idle_partials() -> list:
+    """Descargas parciales en disco que no está escribiendo ninguna transferencia"""
+    if not os.path.isdir(PARTIAL_DOWNLOADS_DIR):
+        return []
+    idle = []
+    for name in os.listdir(PARTIAL_DOWNLOADS_DIR):
+        path = os.path.join(PARTIAL_DOWNLOADS_DIR, name)
+        lock = _partial_locks.get(partial_file_key(path) or '')
+        if partial_file_key(path) and not (lock is not None and lock.locked()):
+            idle.append(path)
+    return idle
+
+
+async def spool_sweeper():
+    """Barre al arrancar todos los temporales huérfanos y después, periódicamente, los viejos"""
+    min_age = 0  # Al arrancar no hay trabajos activos: todo lo no reanudable sobra
+    while True:
+        try:
+            await asyncio.to_thread(download_spool.sweep, min_age, keep_spool_file)
+            # Los parciales que quedan en disco (sin descarga en curso) cuentan contra la cuota
+            download_spool.refresh_retained(await asyncio.to_thread(list_idle_partials))
+        except Exception as e:
+            logger.error(f"Error en spool_sweeper: {e}")
+        min_age = SPOOL_ORPHAN_AGE
+        await asyncio.sleep(SPOOL_SWEEP_INTERVAL)
+
+
+async def user_client_pool_janitor():
+    """Cierra periódicamente los clientes de usuario inactivos"""
+    while True:
+        await asyncio.sleep(60)
+        try:
+            returned = await exported_senders.evict_idle()
+            if returned:
+                logger.info(f"🧹 {returned} senders de otros DC inactivos devueltos")
+            closed = await user_client_pool.evict_idle()
+            if closed:
+                logger.info(f"🧹 {closed} clientes de usuario inactivos cerrados ({user_client_pool.stats()})")
+        except Exception as e:
+            logger.error(f"Error en user_client_pool_janitor: {e}")
+
+
+def apply_bandwidth_config(raw: Optional[str]):
+    """Aplica al gobernador la configuración JSON guardada por el panel"""
+    config = json.loads(raw) if raw else {}
+    bandwidth_governor.configure(
+        ingress_mbps=config.get('ingress_mbps', BANDWIDTH_INGRESS_MBPS),
+        egress_mbps=config.get('egress_mbps', BANDWIDTH_EGRESS_MBPS),
+        lane_shares=config.get('lane_shares'),
+        lane_mbps=config.get('lane_mbps')
+    )
+
+
+async def bandwidth_config_watcher():
+    """Relee la configuración de ancho de banda del panel (proceso aparte) y la aplica"""
+    current = None
+    while True:
+        try:
+            raw = get_setting(BANDWIDTH_SETTING_KEY)
+            if raw != current:
+                apply_bandwidth_config(raw)
+                current = raw
+                logger.info(f"📶 Ancho de banda actualizado: {bandwidth_governor.snapshot()}")
+        except Exception as e:
+            logger.error(f"Error en bandwidth_config_watcher: {e}")
+        await asyncio.sleep(15)
+
+
+# ==================== TAREAS EN SEGUNDO PLANO ====================
+
+# El bucle de eventos solo guarda referencias débiles a las tareas: las que se
+# lanzan sin esperar su resultado se retienen aquí hasta que terminan
+background_tasks = set()
+
+
+def spawn_background(coro) -> asyncio.Task:
+    """asyncio.create_task con una referencia fuerte mientras la tarea viva"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+# ==================== FLOODWAIT ====================
+
+def user_flood_key(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def note_bot_flood(path: str, error) -> bool:
+    """Si el error es un límite de Telegram en una ruta del bot, lo registra. True si lo era."""
+    seconds = flood_wait_seconds(error)
+    if seconds is None:
+        return False
+    flood_registry.record(path, seconds)
+    return True
+
+
+def bot_api_file(path: str):
+    """
+    Archivo del spool para un envío por PTB: con el servidor Bot API en modo
+    local se pasa la ruta (PTB la manda como file://, sin subida); si no, el
+    archivo abierto para multipart. Se usa con `with`.
+    """
+    if BOT_API_LOCAL_MODE:
+        return nullcontext(Path(path).resolve())
+    return open(path, 'rb')
+
+
+async def connect_bot_sender(index: int):
+    """Emisor 0: el propio bot_client. Los demás reutilizan su sesión en otra conexión."""
+    if bot_client is None:
+        raise ConnectionError("bot_client no iniciado")
+    if index == 0:
+        if not bot_client.is_connected():
+            await bot_client.connect()
+        return bot_client
+    client = TelegramClient(
+        StringSession(StringSession.save(bot_client.session)), int(TELEGRAM_API_ID), TELEGRAM_API_HASH
+    )
+    await client.connect()
+    return client
+
+
+def bot_client_available() -> bool:
+    """Algún emisor MTProto del bot conectado y sin ventana de flood activa"""
+    return bot_sender_pool.available and not flood_registry.is_flooded(BOT_PATH_MTPROTO)
+
+
+def available_upload_paths(file_size: int) -> list:
+    """Rutas de subida que pueden llevar este archivo ahora mismo (sin FloodWait activo)"""
+    capable = []
+    if bot_sender_pool.available:
+        capable.append('mtproto')
+    if file_size <= BOT_API_UPLOAD_LIMIT:
+        capable.append('ptb')
+    paths = [p for p in capable
+             if not flood_registry.is_flooded(BOT_PATH_MTPROTO if p == 'mtproto' else BOT_PATH_PTB)]
+    # Si todas están limitadas, intentar igualmente con las que sirven
+    return paths or capable
+
+
+async def run_respecting_flood(user_id: int, job) -> float:
+    """
+    Ejecuta `await job()` con la sesión del usuario salvo que esté en FloodWait.
+    Devuelve 0 si se ejecutó, o los segundos que hay que aplazar el trabajo
+    (ventana ya activa o FloodWaitError recibido durante el trabajo).
+    """
+    key = user_flood_key(user_id)
+    wait = flood_registry.remaining(key)
+    if wait:
+        logger.info(f"⏸️ Sesión de {user_id} en FloodWait ({wait:.0f}s), aplazando trabajo")
+        return wait
+    try:
+        await job()
+        return 0
+    except FloodWaitError as e:
+        return flood_registry.record(key, e.seconds)
+
+
+def flood_deferral_text(wait: float) -> str:
+    return (
+        "⏳ *Telegram limitó tu cuenta temporalmente*\n\n"
+        f"No hace falta que hagas nada: reintentaré tu descarga automáticamente en {int(wait) + 1} segundos."
+    )
+
+
+def defer_chat_download(user_id: int, link: str, wait: float) -> Optional[int]:
+    """
+    Aplaza una descarga pedida por chat metiéndola en la cola de descargas con
+    available_at: el reintento queda en la base de datos (sobrevive a un
+    reinicio) y lo ejecuta el consumidor de la cola cuando acaba la ventana.
+    """
+    channel_key, message_key = normalize_telegram_link(link) or (None, None)
+    download_id, _ = enqueue_download(user_id, link, channel_key, message_key, source='chat', delay=wait + 1)
+    logger.info(f"⏸️ Descarga de {user_id} aplazada {wait:.0f}s en la cola (download {download_id})")
+    return download_id
+
+
+async def publish_pipeline_metrics():
+    """Publica periódicamente las métricas del pipeline para el panel"""
+    while True:
+        try:
+            set_setting(PIPELINE_METRICS_KEY, json.dumps(pipeline_metrics.collect()))
+        except Exception as e:
+            logger.error(f"Error publicando métricas del pipeline: {e}")
+        await asyncio.sleep(PIPELINE_METRICS_INTERVAL)
+
+
+# ==================== CANCELACIÓN DE TRANSFERENCIAS ====================
+
+# (chat_id, message_id del mensaje de estado) -> (user_id, tarea)
+cancellable_transfers: Dict[tuple, tuple] = {}
+# download_id de la cola MiniApp -> tarea que lo procesa
+queued_download_tasks: Dict[int, asyncio.Task] = {}
+# Tareas canceladas por su usuario (distingue su CancelledError del apagado del bot)
+user_cancelled_tasks = weakref.WeakSet()
+
+
+def register_cancellable(user_id: int, status_msg) -> tuple:
+    """Asocia el mensaje de estado a la tarea actual para poder cancelarla con su botón"""
+    key = (status_msg.chat_id, status_msg.message_id)
+    cancellable_transfers[key] = (user_id, asyncio.current_task())
+    return key
+
+
+def unregister_cancellable(key: tuple):
+    cancellable_transfers.pop(key, None)
+
+
+def cancel_button_markup():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🛑 Cancelar", callback_data=CANCEL_CALLBACK_DATA)]])
+
+
+def cancel_markup_for(status_msg):
+    """Botón de cancelar del mensaje de estado (None si su transferencia ya no es cancelable)"""
+    if status_msg is None or (status_msg.chat_id, status_msg.message_id) not in cancellable_transfers:
+        return None
+    return cancel_button_markup()
+
+
+def cancel_task_for_user(task: Optional[asyncio.Task]) -> bool:
+    """
+    Cancela la tarea de una transferencia. Sus finally liberan el slot del
+    carril, el ancho de banda y el archivo temporal; los contadores diarios
+    solo se suman al terminar con éxito, así que no se tocan.
+    """
+    if task is None or task.done():
+        return False
+    user_cancelled_tasks.add(task)
+    task.cancel(USER_CANCEL_MSG)
+    return True
+
+
+def cancel_transfer(chat_id: int, message_id: int, user_id: int) -> bool:
+    """Cancela la transferencia del mensaje de estado si pertenece a user_id"""
+    entry = cancellable_transfers.get((chat_id, message_id))
+    if not entry or entry[0] != user_id:
+        return False
+    unregister_cancellable((chat_id, message_id))
+    return cancel_task_for_user(entry[1])
+
+
+def cancelled_by_user() -> bool:
+    """True si la tarea actual fue cancelada por su usuario (y no por un apagado)"""
+    return asyncio.current_task() in user_cancelled_tasks
+
+
+async def miniapp_cancel_watcher(application: Application):
+    """Cancela los trabajos de la cola que el usuario canceló desde la MiniApp"""
+    while True:
+        await asyncio.sleep(MINIAPP_CANCEL_POLL_INTERVAL)
+        if not queued_download_tasks:
+            continue
+        try:
+            for download_id in get_cancelled_download_ids(list(queued_download_tasks)):
+                task = queued_download_tasks.get(download_id)
+                status_key = next((key for key, (_, t) in cancellable_transfers.items() if t is task), None)
+                if not cancel_task_for_user(task):
+                    continue
+                logger.info(f"🛑 Download {download_id} cancelada desde la MiniApp")
+                if status_key:
+                    unregister_cancellable(status_key)
+                    try:
+                        await application.bot.edit_message_text(
+                            CANCELLED_TEXT, chat_id=status_key[0], message_id=status_key[1], parse_mode='Markdown'
+                        )
+                    except Exception as e:
+                        logger.debug(f"No se pudo editar el mensaje cancelado: {e}")
+        except Exception as e:
+            logger.error(f"Error comprobando cancelaciones de la MiniApp: {e}")
 
 
 def ensure_admin_premium(user_id):
@@ -831,6 +1311,7 @@ async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [[InlineKeyboardButton(get_msg("btn_back_start", lang), callback_data="back_to_menu")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
+    await user_client_pool.discard(user_id)
     if delete_user_session(user_id):
         msg_text = get_msg("logout_success", lang)
     else:
@@ -939,41 +1420,74 @@ class UsageNotification:
         return summary
     
 
-def parse_telegram_link(url: str) -> tuple[str, int | None] | None:
-    """Extrae identificador del canal y message_id (puede ser None)"""
-    url = url.strip()
-    
-    # Enlaces con hash de invitación: t.me/+HASH o t.me/+HASH/123
-    match = re.search(r't\.me/\+([^/]+)(?:/(\d+))?', url)
-    if match:
-        return f"+{match.group(1)}", int(match.group(2)) if match.group(2) else None
-    
-    # Enlaces privados numéricos: t.me/c/123456789 o t.me/c/123456789/123
-    match = re.search(r't\.me/c/(\d+)(?:/(\d+))?', url)
-    if match:
-        return match.group(1), int(match.group(2)) if match.group(2) else None
-    
-    # Canales públicos: t.me/username o t.me/username/123
-    match = re.search(r't\.me/([^/\s]+)(?:/(\d+))?', url)
-    if match and match.group(1) not in ['joinchat', 'c', '+']:
-        return match.group(1), int(match.group(2)) if match.group(2) else None
-    
-    return None
+def remember_channel_entities(user_id: int, entities):
+    """Guarda en la caché persistente los canales resueltos (con access_hash) del usuario"""
+    if not user_id:
+        return
+    rows = []
+    for entity in entities:
+        access_hash = getattr(entity, 'access_hash', None)
+        if access_hash is None or getattr(entity, 'min', False) or not hasattr(entity, 'title'):
+            continue
+        rows.append((entity.id, access_hash, entity.title))
+    if rows:
+        try:
+            save_cached_entities(user_id, rows)
+        except Exception as e:
+            logger.warning(f"No se pudo guardar caché de entidades: {e}")
+
+
+def forget_channel_entity(user_id: int, identifier: str):
+    """Invalida el canal cacheado tras ChannelPrivateError o ChannelInvalidError"""
+    if user_id and identifier and identifier.isdigit():
+        try:
+            delete_cached_entity(user_id, int(identifier))
+        except Exception as e:
+            logger.warning(f"No se pudo invalidar caché de entidad: {e}")
 
 
-async def get_entity_from_identifier(client, identifier: str):
+async def get_entity_from_identifier(client, identifier: str, user_id: int = None):
     """Resolve channel identifier to Telegram entity"""
     if identifier.startswith('+'):
-        return await client.get_entity(identifier)
+        entity = await client.get_entity(identifier)
+        remember_channel_entities(user_id, [entity])
+        return entity
     elif identifier.isdigit():
         # For numeric channel IDs (from t.me/c/ID/MSG format)
-        # Need to convert to proper channel ID: -100{channel_id}
         channel_id = int(identifier)
-        return await client.get_entity(f"-100{channel_id}")
+        
+        # OPTIMIZACIÓN: Canal ya resuelto antes por este usuario -> InputPeer sin RPC
+        if user_id:
+            cached = get_cached_entity(user_id, channel_id)
+            if cached:
+                from telethon.tl.types import InputPeerChannel
+                return InputPeerChannel(channel_id=channel_id, access_hash=cached['access_hash'])
+        
+        # Need to convert to proper channel ID: -100{channel_id}
+        entity = await client.get_entity(f"-100{channel_id}")
+        remember_channel_entities(user_id, [entity])
+        return entity
     else:
         return identifier
 
 
+async def get_channel_messages(client, entity, identifier: str, ids, user_id: int = None):
+    """
+    get_messages sobre un canal ya resuelto. Si el access_hash cacheado no vale
+    para esta sesión (ChannelInvalidError), se invalida y se resuelve de nuevo
+    una vez. Retorna (entidad, mensajes).
+    """
+    try:
+        return entity, await client.get_messages(entity, ids=ids)
+    except ChannelInvalidError:
+        if not (user_id and identifier.isdigit()):
+            raise
+        logger.info(f"♻️ access_hash cacheado inválido para {identifier}, resolviendo de nuevo")
+        forget_channel_entity(user_id, identifier)
+        entity = await get_entity_from_identifier(client, identifier, user_id=user_id)
+        return entity, await client.get_messages(entity, ids=ids)
+
+
 def extract_message_caption(message) -> str:
     """Extract caption or text from a Telegram message"""
     caption = ""
@@ -1057,16 +1571,465 @@ def get_file_size(message) -> int:
     return 0
 
 
-async def download_and_send_media(message, chat_id: int, bot, caption=None):
+async def send_cached_media(bot, chat_id: int, cache_keys: list, caption=None) -> bool:
+    """
+    Reenvía un media ya subido usando su file_id cacheado (sin descargar ni subir).
+    Devuelve False si no hay entrada o Telegram rechaza el file_id.
+    """
+    try:
+        cached = get_cached_media(cache_keys)
+    except Exception as e:
+        logger.warning(f"Error leyendo caché de file_id: {e}")
+        return False
+    if not cached:
+        return False
+
+    method_name, param = BOT_SEND_METHODS.get(cached['media_kind'], BOT_SEND_METHODS['document'])
+    kwargs = {'chat_id': chat_id, param: cached['file_id'], 'caption': caption if caption else None}
+    if cached['media_kind'] == 'video':
+        kwargs['supports_streaming'] = True
+
+    # Un FloodWait no invalida el file_id: solo se borra si Telegram lo rechaza
+    flooded = False
+    if not flood_registry.is_flooded(BOT_PATH_PTB):
+        try:
+            await getattr(bot, method_name)(**kwargs)
+            logger.info(f"⚡ Cache hit ({cached['source_key']}): enviado por file_id a {chat_id}")
+            return True
+        except Exception as e:
+            flooded = note_bot_flood(BOT_PATH_PTB, e)
+            logger.warning(f"file_id cacheado rechazado ({cached['source_key']}): {e}")
+    else:
+        flooded = True
+
+    # Los file_id empaquetados desde Telethon los entiende mejor el propio bot_client
+    if bot_client_available():
+        try:
+            async with bot_sender_pool.sender() as client:
+                await client.send_file(chat_id, cached['file_id'], caption=caption if caption else None)
+            logger.info(f"⚡ Cache hit ({cached['source_key']}): enviado con Telethon a {chat_id}")
+            return True
+        except Exception as e:
+            flooded = note_bot_flood(BOT_PATH_MTPROTO, e) or flooded
+            logger.warning(f"bot_client tampoco aceptó el file_id cacheado: {e}")
+
+    if flooded:
+        return False
+    try:
+        delete_cached_media(cache_keys)
+    except Exception as e:
+        logger.warning(f"Error invalidando caché de file_id: {e}")
+    return False
+
+
+def remember_sent_media(cache_keys: list, sent_msg, file_size: int = 0):
+    """Guarda el file_id del mensaje enviado para servir futuras peticiones del mismo media"""
+    try:
+        extracted = extract_sent_file_id(sent_msg)
+        if extracted:
+            file_id, media_kind = extracted
+            save_cached_media(cache_keys, file_id, media_kind, file_size)
+    except Exception as e:
+        logger.warning(f"No se pudo guardar file_id en caché: {e}")
+
+
+def _resumable_journal(message) -> Optional[dict]:
+    document = getattr(message, 'document', None)
+    if not document:
+        return None
+    try:
+        journal = get_download_journal(f"doc:{document.id}")
+    except Exception as e:
+        logger.warning(f"Error leyendo diario de descarga: {e}")
+        return None
+    if journal and os.path.exists(journal['path']):
+        return journal
+    return None
+
+
+def get_resumable_offset(message) -> int:
+    """Bytes ya descargados de este documento según el diario (0 si no hay parcial)"""
+    journal = _resumable_journal(message)
+    return journal['offset'] if journal else 0
+
+
+def resumable_partial_path(message) -> Optional[str]:
+    """Parcial que va a retomar la descarga de este documento (para adoptarlo en el spool)"""
+    journal = _resumable_journal(message)
+    return journal['path'] if journal else None
+
+
+def discard_partial_download(message):
+    """Borra el parcial y el diario del documento (descarga cancelada por el usuario)"""
+    document = getattr(message, 'document', None)
+    if not document:
+        return
+    file_key = f"doc:{document.id}"
+    lock = _partial_locks.get(file_key)
+    if lock is not None and lock.locked():
+        return  # Otra transferencia del mismo documento sigue usándolo
+    try:
+        journal = get_download_journal(file_key)
+        delete_download_journal(file_key)
+        if journal:
+            download_spool.forget(journal['path'])
+            if os.path.exists(journal['path']):
+                os.remove(journal['path'])
+    except Exception as e:
+        logger.warning(f"No se pudo descartar el parcial de {file_key}: {e}")
+
+
+async def download_document_to_path(message, path: str, file_size: int, throttle=None,
+                                    guard: Optional[StallGuard] = None) -> str:
+    """
+    Descarga el documento del mensaje a `path` con la descarga paralela por partes.
+    Si una descarga anterior del mismo documento quedó a medias (timeout, reintento
+    desde la cola), continúa desde el último offset guardado en el diario.
+    """
+    document = message.document
+    file_key = f"doc:{document.id}"
+    part_size = DOWNLOAD_PART_SIZE
+
+    lock = _partial_locks.get(file_key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _partial_locks[file_key] = lock
+
+    async with lock:
+        os.makedirs(PARTIAL_DOWNLOADS_DIR, exist_ok=True)
+        partial_path = os.path.join(PARTIAL_DOWNLOADS_DIR, f"{document.id}.part")
+        offset, checksums = 0, []
+
+        journal = get_download_journal(file_key)
+        if (journal and journal['file_size'] == file_size and journal['part_size'] == part_size
+                and await asyncio.to_thread(
+                    verify_partial_file, journal['path'], journal['offset'], part_size, journal['checksums']
+                )):
+            partial_path = journal['path']
+            offset, checksums = journal['offset'], journal['checksums']
+            logger.info(f"♻️ Reanudando descarga {file_key} desde {offset / (1024*1024):.1f} MB")
+        # Mientras se escribe, el parcial va cubierto por la reserva de este trabajo
+        download_spool.forget(partial_path)
+
+        workers = DOWNLOAD_CONNECTIONS[classify_size(file_size)]
+        downloader = ParallelDownloader(
+            message.client, document, file_size, workers=workers, throttle=throttle,
+            on_flood=guard.extend if guard else None,
+            senders=exported_senders, source=getattr(message, 'chat_id', None)
+        )
+        state = {'offset': offset}
+
+        with open(partial_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+
+            def save_journal():
+                f.flush()
+                save_download_journal(file_key, partial_path, file_size, state['offset'], part_size, checksums)
+
+            async def write_chunk(data: bytes):
+                f.write(data)
+                if guard is not None:
+                    guard.progress(len(data))
+                checksums.append(chunk_checksum(data))
+                state['offset'] += len(data)
+                if len(checksums) % JOURNAL_EVERY_PARTS == 0:
+                    save_journal()
+
+            try:
+                await downloader.download(write_chunk, offset=offset)
+            except BaseException:
+                # Timeout, cancelación o error: conservar el progreso para el siguiente intento
+                # (el parcial sigue contando contra la cuota del spool)
+                try:
+                    save_journal()
+                except Exception as e:
+                    logger.warning(f"No se pudo guardar el diario de {file_key}: {e}")
+                download_spool.retain(partial_path)
+                raise
+
+        delete_download_journal(file_key)
+        shutil.move(partial_path, path)
+    return path
+
+
+async def stream_media_to_bot_client(message, chat_id: int, caption, content_type: str, file_size: int,
+                                     throttle=None, egress=None,
+                                     download_guard: Optional[StallGuard] = None,
+                                     upload_guard: Optional[StallGuard] = None):
+    """
+    Descarga por chunks con el cliente del usuario y sube en paralelo con bot_client.
+    La subida MTProto consume los chunks a medida que llegan; no se toca disco.
+    Cada etapa alimenta su propio StallGuard (la espera a la otra no cuenta).
+    """
+    document = message.document
+    file_name = None
+    for attr in getattr(document, 'attributes', None) or []:
+        if getattr(attr, 'file_name', None):
+            file_name = attr.file_name
+            break
+    if not file_name:
+        file_name = f"{content_type}_{document.id}{'.mp4' if content_type == 'video' else ''}"
+
+    pipe = ChunkPipe(file_size, name=file_name, writer_guard=download_guard, reader_guard=upload_guard)
+
+    downloader = ParallelDownloader(
+        message.client, document, file_size,
+        workers=DOWNLOAD_CONNECTIONS[classify_size(file_size)],
+        throttle=throttle,
+        on_flood=download_guard.extend if download_guard else None,
+        senders=exported_senders, source=getattr(message, 'chat_id', None)
+    )
+
+    download_error = None
+
+    async def write_chunk(data: bytes):
+        if download_guard is not None:
+            download_guard.progress(len(data))
+        await pipe.write(data)
+
+    async def produce():
+        nonlocal download_error
+        try:
+            await downloader.download(write_chunk)
+            await pipe.close()
+        except asyncio.CancelledError:
+            await pipe.close(ConnectionAbortedError("Descarga cancelada"))
+            raise
+        except Exception as e:
+            download_error = e
+            await pipe.close(e)
+
+    logger.info(f"Streaming {file_size / (1024*1024):.1f} MB de descarga a subida con bot_client")
+    producer = asyncio.create_task(produce())
+    try:
+        if upload_guard is not None:
+            upload_progress = transfer_progress(upload_guard, egress)
+        else:
+            upload_progress = progress_throttle(egress) if egress else None
+        async with bot_sender_pool.sender(file_size) as client:
+            uploaded = await client.upload_file(
+                pipe, file_size=file_size, file_name=file_name,
+                progress_callback=upload_progress
+            )
+            await producer
+            return await client.send_file(
+                chat_id,
+                uploaded,
+                caption=caption if caption else None,
+                attributes=list(getattr(document, 'attributes', None) or []),
+                mime_type=getattr(document, 'mime_type', None),
+                supports_streaming=(content_type == 'video'),
+                force_document=False
+            )
+    except FloodWaitError as e:
+        if e is download_error:
+            raise  # Sesión del usuario: se aplaza el trabajo con run_respecting_flood
+        # Límite del bot en la subida: se anota y el llamador pasa al archivo temporal
+        note_bot_flood(BOT_PATH_MTPROTO, e)
+        raise RuntimeError(f"FloodWait en la subida del bot: {e}") from e
+    finally:
+        if not producer.done():
+            producer.cancel()
+            try:
+                await producer
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+def stall_timeout_for(key: str) -> float:
+    """Segundos sin progreso tras los que se abandona una transferencia por `key`"""
+    rate = transfer_throughput.estimate(key)
+    if not rate:
+        return STALL_TIMEOUT_DEFAULT
+    # Tiempo de unas pocas partes al ritmo medido, acotado
+    return min(STALL_TIMEOUT_MAX, max(STALL_TIMEOUT_MIN, 4 * DOWNLOAD_PART_SIZE / rate))
+
+
+def transfer_progress(guard: StallGuard, throttle=None):
+    """progress_callback de Telethon que alimenta el StallGuard y el throttle de ancho de banda"""
+    state = {'last': 0}
+
+    async def callback(current, total):
+        delta = current - state['last']
+        state['last'] = current
+        if delta > 0:
+            guard.progress(delta)
+            if throttle is not None:
+                await throttle(delta)
+
+    return callback
+
+
+PROGRESS_PHASE_TEXT = {
+    'descargando': '📥 Descargando',
+    'subiendo': '📤 Enviando',
+    'streaming': '⚡ Descargando y enviando',
+}
+
+
+def format_progress_text(progress, content_type: str) -> str:
+    """Texto del mensaje de estado con barra, MB, velocidad y ETA"""
+    header = f"{PROGRESS_PHASE_TEXT.get(progress.phase, '⏳ Procesando')} *{content_type}...*"
+    done_mb = progress.bytes / (1024 * 1024)
+    if not progress.total:
+        return f"{header}\n\n{done_mb:.1f} MB"
+    ratio = min(1.0, progress.bytes / progress.total)
+    filled = int(ratio * 10)
+    lines = [
+        header, "",
+        f"{'▰' * filled}{'▱' * (10 - filled)} {ratio * 100:.0f}%",
+        f"{done_mb:.1f} / {progress.total / (1024 * 1024):.1f} MB",
+    ]
+    if progress.rate:
+        eta = progress.eta
+        lines.append(f"🚀 {progress.rate / (1024 * 1024):.1f} MB/s" + (f" · ⏱️ {int(eta)}s" if eta is not None else ""))
+    return "\n".join(lines)
+
+
+def status_progress_updater(status_msg, content_type: str):
+    """on_update para TransferProgress que edita el mensaje de estado del usuario"""
+    last_text = {'value': None}
+
+    async def update(progress):
+        if progress.phase not in PROGRESS_PHASE_TEXT or flood_registry.is_flooded(BOT_PATH_PTB):
+            return
+        text = format_progress_text(progress, content_type)
+        if text == last_text['value']:
+            return
+        try:
+            await status_msg.edit_text(text, parse_mode='Markdown', reply_markup=cancel_markup_for(status_msg))
+            last_text['value'] = text
+        except Exception as e:
+            # Las ediciones comparten límites con los envíos del bot
+            note_bot_flood(BOT_PATH_PTB, e)
+            logger.debug(f"No se pudo actualizar el progreso: {e}")
+
+    return update
+
+
+def pick_download_lane(message) -> str:
+    """Carril de la transferencia según get_file_size/detect_content_type"""
+    is_photo = isinstance(message.media, MessageMediaPhoto) or (
+        detect_content_type(message) == 'photo' and not getattr(message, 'document', None)
+    )
+    return choose_lane(get_file_size(message), is_photo=is_photo)
+
+
+@asynccontextmanager
+async def download_slot(user_id: int, status_msg=None, lane: str = 'medium'):
+    """
+    Reserva un slot del carril para una transferencia y devuelve su throttle
+    de ancho de banda. El peso y el límite en vuelo salen del premium_level.
+    """
+    user = get_user(user_id, auto_reset=False) or {}
+    level = (user.get('premium_level') or 0) if user.get('premium') else 0
+    weight = DOWNLOAD_PRIORITY_WEIGHTS.get(level, 1)
+    limit = DOWNLOAD_USER_CAPS.get(level, 1)
+
+    async def announce_queue(position):
+        logger.info(f"⏳ Usuario {user_id} en cola de descargas (posición {position})")
+        if status_msg is not None:
+            await status_msg.edit_text(
+                f"⏳ *En cola de descarga*\n\nPosición: {position}\n"
+                "Tu archivo empezará a descargarse en breve.",
+                parse_mode='Markdown',
+                reply_markup=cancel_markup_for(status_msg)
+            )
+
+    async with download_lanes[lane].slot(user_id, weight=weight, limit=limit, on_queued=announce_queue):
+        yield bandwidth_governor.ingress(lane)
+
+
+async def download_and_send_media(message, chat_id: int, bot, caption=None, status_msg=None):
     """Download media from protected channel and send to user with optimized performance"""
     logger.info(f"Iniciando download_and_send_media para chat_id {chat_id}")
+    if caption is None:
+        caption = extract_message_caption(message)
+    
+    # OPTIMIZACIÓN: Si este media ya se envió antes, reutilizar su file_id
+    cache_keys = media_cache_keys(message)
+    if await send_cached_media(bot, chat_id, cache_keys, caption=caption):
+        return True
+    
+    # OPTIMIZACIÓN: Single-flight por media de origen. Si otro usuario ya está
+    # transfiriendo este mismo archivo, esperar su resultado y enviar por file_id.
+    lane = pick_download_lane(message)
+    
+    async def transfer():
+        async with download_slot(chat_id, status_msg, lane) as throttle:
+            content_type = detect_content_type(message)
+            tracker = transfer_registry.start(
+                chat_id, lane, content_type, get_file_size(message),
+                on_update=status_progress_updater(status_msg, content_type) if status_msg else None,
+                min_interval=PROGRESS_EDIT_INTERVAL,
+                tag=current_queue_download.get()
+            )
+            outcome = 'error'
+            try:
+                result = await transfer_and_send_media(
+                    message, chat_id, bot, caption, cache_keys, throttle, bandwidth_governor.egress(lane), tracker
+                )
+                outcome = 'ok' if result else 'failed'
+                return result
+            except asyncio.CancelledError:
+                outcome = 'cancelled'
+                raise
+            finally:
+                transfer_registry.finish(tracker, outcome)
+    
+    flight_key = cache_keys[0] if cache_keys else None
+    if not flight_key:
+        return await transfer()
+    
+    for _ in range(SINGLEFLIGHT_MAX_WAITS):
+        result, shared = await media_singleflight.run(flight_key, transfer)
+        if not shared:
+            return result
+        if result and await send_cached_media(bot, chat_id, cache_keys, caption=caption):
+            logger.info(f"🔀 {flight_key} servido desde una transferencia compartida a {chat_id}")
+            return True
+        # El líder falló (o su file_id no sirve): volver a intentarlo, quizá como líder
+    return await transfer()
+
+
+async def transfer_and_send_media(message, chat_id: int, bot, caption, cache_keys: list,
+                                  throttle=None, egress=None, tracker=None):
+    """
+    Descarga el media con el cliente del usuario y lo sube al chat (sin caché).
+    throttle/egress marcan el ritmo de bajada y subida según el gobernador; las
+    transferencias se abandonan cuando dejan de progresar (StallGuard).
+    Devuelve True si el media llegó al chat. En un trabajo de la cola un atasco
+    se propaga como TransferStalled para que la cola lo reprograme.
+    """
+    async def pace_upload(n_bytes: int):
+        # PTB lee el archivo entero de golpe: se reserva su tamaño antes de enviar
+        if egress is not None and n_bytes:
+            await egress(n_bytes)
+    
+    on_progress = tracker.add if tracker else None
+    
+    def set_phase(phase: str, total: Optional[int] = None):
+        if tracker:
+            tracker.set_phase(phase, total)
+    
+    async def send_with_bot_client(**kwargs):
+        guard = StallGuard(stall_timeout_for('upload:mtproto'), name='subida mtproto', on_progress=on_progress)
+        # OPTIMIZACIÓN: cada subida va al emisor del bot con menos carga
+        async with bot_sender_pool.sender(file_size) as client:
+            sent = await guard.run(client.send_file(
+                chat_id, path, progress_callback=transfer_progress(guard, egress), **kwargs
+            ))
+        transfer_throughput.observe('upload:mtproto', guard.bytes, guard.elapsed)
+        return sent
+    
+    dc_key = f"dc{media_dc_id(message) or 0}"
     path = None
     try:
-        if caption is None:
-            caption = extract_message_caption(message)
         from telethon.tl.types import MessageMediaPhoto
         is_photo = isinstance(message.media, MessageMediaPhoto)
         content_type = detect_content_type(message)
+        sent_msg = None
 
         # Verificar tamaño antes de descargar (Límite aumentado a 2000MB = 2GB)
         file_size = 0
@@ -1080,211 +2043,177 @@ async def download_and_send_media(message, chat_id: int, bot, caption=None):
         # Límite aumentado a 2000MB (2GB)
         if file_size > 2000 * 1024 * 1024:
             await bot.send_message(chat_id=chat_id, text=f"❌ El archivo ({file_size / (1024*1024):.1f} MB) supera el límite de 2GB de Telegram.")
-            return
+            return False
 
         if is_photo:
             # Descargar foto a memoria (rápido)
             photo_bytes = BytesIO()
-            result = await message.download_media(file=photo_bytes)
+            guard = StallGuard(stall_timeout_for(dc_key), name=f'foto {dc_key}', on_progress=on_progress)
+            set_phase('descargando')
+            result = await guard.run(message.download_media(
+                file=photo_bytes,
+                progress_callback=transfer_progress(guard, throttle)
+            ))
+            transfer_throughput.observe(dc_key, guard.bytes, guard.elapsed)
             if not result:
                 await bot.send_message(chat_id=chat_id, text="❌ No se pudo descargar la foto. Puede estar protegida o eliminada.")
-                return
+                return False
+            set_phase('subiendo', photo_bytes.tell())
+            await pace_upload(photo_bytes.tell())
             photo_bytes.seek(0)
-            await bot.send_photo(
+            sent_msg = await bot.send_photo(
                 chat_id=chat_id,
                 photo=photo_bytes,
                 caption=caption if caption else None
             )
+            remember_sent_media(cache_keys, sent_msg)
         else:
-            # OPTIMIZACIÓN AVANZADA: Configuración específica para archivos grandes
-            suffix = '.mp4' if content_type == 'video' else ''
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-            path = temp_file.name
-            temp_file.close()
+            # OPTIMIZACIÓN: Descarga paralela, número de conexiones según la clase de tamaño
+            size_class = classify_size(file_size)
+            logger.info(f"Archivo {size_class} ({file_size / (1024*1024):.1f} MB), descarga con {DOWNLOAD_CONNECTIONS[size_class]} conexiones")
             
-            # Configuración optimizada basada en tamaño del archivo
-            download_config = {
-                'progress_callback': None,  # Podemos agregar callback de progreso si queremos
-            }
+            # OPTIMIZACIÓN: Sin timeout fijo; se abandona solo si deja de progresar
+            stall_after = stall_timeout_for(dc_key)
+            logger.info(f"Iniciando descarga de {file_size / (1024*1024):.1f} MB desde {dc_key} (abandono tras {stall_after:.0f}s sin progreso)")
             
-            # OPTIMIZACIÓN: Configuración avanzada para diferentes tamaños de archivo
-            if file_size > 500 * 1024 * 1024:  # >500MB - Archivos muy grandes
-                logger.info(f"Archivo muy grande detectado ({file_size / (1024*1024):.1f} MB), usando configuración ultra-optimizada")
-                # Para archivos muy grandes, usar configuración especial de Telethon
-                download_config.update({
-                    'dc_id': None,  # Usar DC automático
-                    'workers': 1,   # Un solo worker para estabilidad
-                })
-                timeout_seconds = 900  # 15 minutos para archivos >500MB
-            elif file_size > 100 * 1024 * 1024:  # >100MB - Archivos grandes
-                logger.info(f"Archivo grande detectado ({file_size / (1024*1024):.1f} MB), usando configuración optimizada")
-                download_config.update({
-                    'workers': 2,   # Dos workers para archivos grandes
-                })
-                timeout_seconds = 600  # 10 minutos para archivos >100MB
-            elif file_size > 50 * 1024 * 1024:   # >50MB - Archivos medianos-grandes
-                logger.info(f"Archivo mediano-grande detectado ({file_size / (1024*1024):.1f} MB), usando configuración balanceada")
-                download_config.update({
-                    'workers': 4,   # Cuatro workers para velocidad
-                })
-                timeout_seconds = 300  # 5 minutos para archivos >50MB
-            else:  # Archivos pequeños
-                timeout_seconds = 300  # 5 minutos para archivos pequeños
+            # Rutas de subida en orden de preferencia, decididas una vez por transferencia:
+            # la primera decide el streaming y todas sirven de respaldo para la subida a disco
+            upload_order = upload_selector.order(file_size, content_type, available_upload_paths(file_size))
             
-            # Timeout dinámico basado en tamaño (mínimo 300s, máximo 900s)
-            timeout_seconds = min(900, max(300, file_size // (1024 * 1024)))  # 1MB = 1 segundo, mín 5 min
+            # OPTIMIZACIÓN: Streaming descarga->subida con bot_client, sin archivo temporal
+            # (si hay un parcial guardado, reanudar a disco sale más barato que re-descargar)
+            if (STREAMING_UPLOAD_ENABLED and bot_client_available() and file_size > 0 and message.document
+                    and not get_resumable_offset(message)
+                    and upload_order and upload_order[0] == 'mtproto'):
+                try:
+                    # Un StallGuard por etapa: un atasco en la descarga se detecta con su
+                    # propio umbral, sin esperar a que la subida vacíe la tubería
+                    download_guard = StallGuard(stall_after, name=f'descarga {dc_key}')
+                    upload_guard = StallGuard(
+                        stall_timeout_for('upload:mtproto'), name='subida mtproto', on_progress=on_progress
+                    )
+                    guard = StallGuardGroup(download_guard, upload_guard, name='streaming')
+                    set_phase('streaming', file_size)
+                    sent_msg = await guard.run(stream_media_to_bot_client(
+                        message, chat_id, caption, content_type, file_size, throttle, egress,
+                        download_guard, upload_guard
+                    ))
+                    transfer_throughput.observe('upload:mtproto', file_size, guard.elapsed)
+                    upload_selector.record('mtproto', file_size, content_type, True, guard.elapsed)
+                    remember_sent_media(cache_keys, sent_msg, file_size)
+                    logger.info(f"download_and_send_media completado (streaming) para chat_id {chat_id}")
+                    return True
+                except TransferStalled as stall:
+                    # Atasco del streaming: se reintenta a disco, donde el progreso
+                    # se guarda en el diario y un nuevo atasco se puede reanudar
+                    logger.warning(f"Streaming atascado ({stall}), usando descarga a archivo temporal")
+                except (asyncio.TimeoutError, FloodWaitError):
+                    raise
+                except Exception as stream_error:
+                    note_bot_flood(BOT_PATH_MTPROTO, stream_error)
+                    logger.warning(f"Streaming falló ({stream_error}), usando descarga a archivo temporal")
             
-            logger.info(f"Iniciando descarga con timeout de {timeout_seconds}s para archivo de {file_size / (1024*1024):.1f} MB")
+            # Archivo en el spool: reserva file_size y espera si no hay espacio
+            suffix = '.mp4' if content_type == 'video' else ''
+            path = await download_spool.acquire(file_size, suffix=suffix, adopt=resumable_partial_path(message))
             
+            guard = StallGuard(stall_after, name=f'descarga {dc_key}', on_progress=on_progress)
+            set_phase('descargando', file_size - get_resumable_offset(message))
             try:
-                # Usar asyncio.wait_for para timeout personalizado
-                result = await asyncio.wait_for(
-                    message.download_media(file=path, **download_config),
-                    timeout=timeout_seconds
-                )
+                if message.document and file_size > 0:
+                    download_coro = download_document_to_path(message, path, file_size, throttle, guard)
+                else:
+                    download_coro = message.download_media(
+                        file=path,
+                        progress_callback=transfer_progress(guard, throttle)
+                    )
+                result = await guard.run(download_coro)
+                transfer_throughput.observe(dc_key, guard.bytes, guard.elapsed)
             except asyncio.TimeoutError:
+                logger.warning(f"Descarga atascada: {guard.bytes / (1024*1024):.1f} MB en {guard.elapsed:.0f}s")
+                if current_queue_download.get() is not None:
+                    # Trabajo de la cola: se reprograma con el diario intacto y el aviso lo da la cola
+                    raise
+                resume_text = ""
+                saved_offset = get_resumable_offset(message)
+                if saved_offset:
+                    resume_text = f"\n\n💾 Progreso guardado ({saved_offset / (1024*1024):.1f} MB). Vuelve a enviar el enlace para continuar donde quedó."
                 await bot.send_message(
                     chat_id=chat_id, 
-                    text=f"❌ Tiempo de espera agotado ({timeout_seconds}s). El archivo es muy grande ({file_size / (1024*1024):.1f} MB) o la conexión es lenta.\n\n💡 Intenta con un archivo más pequeño o verifica tu conexión."
+                    text=f"❌ La descarga dejó de avanzar ({guard.stall_after:.0f}s sin recibir datos). Telegram o la conexión no están respondiendo.\n\n💡 Inténtalo de nuevo en unos minutos.{resume_text}"
                 )
                 if path and os.path.exists(path):
                     os.remove(path)
-                return
+                return False
             
             if not result or not os.path.exists(path):
                 await bot.send_message(chat_id=chat_id, text="❌ No se pudo descargar el archivo. Puede estar protegido o eliminado.")
                 if path and os.path.exists(path):
-                    os.remove(path)
-                return
-            
-            # OPTIMIZACIÓN: Estrategia inteligente de envío basada en tamaño y tipo
-            sent = False
-            
-            # Para archivos muy grandes (>200MB), priorizar Telethon bot_client
-            if bot_client and file_size > 200 * 1024 * 1024:
-                try:
-                    logger.info(f"Enviando archivo muy grande ({file_size / (1024*1024):.1f} MB) con Telethon bot_client prioritario")
-                    await bot_client.send_file(
-                        chat_id,
-                        path,
-                        caption=caption if caption else None,
-                        supports_streaming=(content_type == 'video'),
-                        force_document=False,  # Intentar mantener formato original
-                        timeout=600  # 10 minutos timeout para envío
-                    )
-                    sent = True
-                    logger.info("Archivo enviado exitosamente con Telethon (prioridad alta)")
-                except Exception as e:
-                    logger.error(f"Error enviando con Telethon prioritario: {e}")
-                    # Fallback a PTB
+                    os.remove(path)
+                return False
             
-            # Para archivos medianos (50-200MB), usar Telethon si está disponible
-            elif bot_client and file_size > 50 * 1024 * 1024:
-                try:
-                    logger.info(f"Enviando archivo mediano ({file_size / (1024*1024):.1f} MB) con Telethon bot_client")
-                    await bot_client.send_file(
-                        chat_id,
-                        path,
-                        caption=caption if caption else None,
-                        supports_streaming=(content_type == 'video'),
-                        force_document=False
+            # OPTIMIZACIÓN: Ruta de subida elegida de antemano por UploadPathSelector
+            # (éxito y throughput medidos por ruta, clase de tamaño y tipo)
+            async def send_with_ptb():
+                await pace_upload(file_size)
+                method_name = {'video': 'send_video', 'music': 'send_audio'}.get(content_type, 'send_document')
+                param = {'send_video': 'video', 'send_audio': 'audio'}.get(method_name, 'document')
+                extra = {'supports_streaming': True} if content_type == 'video' else {}
+                with bot_api_file(path) as f:
+                    return await getattr(bot, method_name)(
+                        chat_id=chat_id, **{param: f}, caption=caption if caption else None, **extra
                     )
-                    sent = True
-                    logger.info("Archivo enviado exitosamente con Telethon")
-                except Exception as e:
-                    logger.error(f"Error enviando con Telethon: {e}")
-                    # Fallback a PTB
             
-            if not sent:
-                # Fallback a PTB (python-telegram-bot) con configuraciones ultra-optimizadas
-                # Para videos, intentar primero con bot_client si está disponible
-                if content_type == 'video' and bot_client:
-                    try:
-                        logger.info("Intentando enviar video con Telethon bot_client primero")
-                        await bot_client.send_file(
-                            chat_id,
-                            path,
-                            caption=caption if caption else None,
-                            supports_streaming=True,
-                            timeout=600  # 10 minutos
-                        )
-                        sent = True
-                        logger.info("Video enviado exitosamente con Telethon")
-                    except Exception as telethon_error:
-                        logger.error(f"Error enviando video con Telethon: {telethon_error}")
-                        # Fallback a PTB
-                
-                if not sent:
-                    with open(path, 'rb') as f:
-                        try:
-                            if content_type == 'video':
-                                # Configuración específica para videos grandes
-                                if file_size > 500 * 1024 * 1024:  # >500MB
-                                    logger.info("Enviando video ultra-grande con configuración máxima")
-                                    await bot.send_video(
-                                        chat_id=chat_id,
-                                        video=f,
-                                        caption=caption if caption else None,
-                                        supports_streaming=True
-                                    )
-                                elif file_size > 100 * 1024 * 1024:  # >100MB
-                                    logger.info("Enviando video grande con configuración optimizada")
-                                    await bot.send_video(
-                                        chat_id=chat_id,
-                                        video=f,
-                                        caption=caption if caption else None,
-                                        supports_streaming=True
-                                    )
-                                else:
-                                    await bot.send_video(
-                                        chat_id=chat_id,
-                                        video=f,
-                                        caption=caption if caption else None,
-                                        supports_streaming=True
-                                    )
-                            elif content_type == 'music':
-                                await bot.send_audio(
-                                    chat_id=chat_id,
-                                    audio=f,
-                                    caption=caption if caption else None
-                                )
-                            else:
-                                # Para documentos/APK, configuración optimizada
-                                if file_size > 100 * 1024 * 1024:  # >100MB
-                                    await bot.send_document(
-                                        chat_id=chat_id,
-                                        document=f,
-                                        caption=caption if caption else None
-                                    )
-                                else:
-                                    await bot.send_document(
-                                        chat_id=chat_id,
-                                        document=f,
-                                        caption=caption if caption else None
-                                    )
-                        except Exception as send_error:
-                            logger.error(f"Error enviando con PTB: {send_error}")
-                            # Si falla por timeout, intentar con Telethon como último recurso
-                            if bot_client and ("timeout" in str(send_error).lower() or "read" in str(send_error).lower()):
-                                try:
-                                    logger.info("Reintentando envío con Telethon después de timeout de PTB")
-                                    await bot_client.send_file(
-                                        chat_id,
-                                        path,
-                                        caption=caption if caption else None,
-                                        supports_streaming=(content_type == 'video'),
-                                        timeout=600  # 10 minutos como último recurso
-                                    )
-                                    sent = True
-                                    logger.info("Reintento con Telethon exitoso")
-                                except Exception as telethon_retry_error:
-                                    logger.error(f"Telethon retry también falló: {telethon_retry_error}")
-                                    raise send_error  # Re-lanzar el error original
+            upload_senders = {
+                'mtproto': lambda: send_with_bot_client(
+                    caption=caption if caption else None,
+                    supports_streaming=(content_type == 'video'),
+                    force_document=False
+                ),
+                'ptb': send_with_ptb,
+            }
+            last_error = None
+            # Si el streaming dejó una ruta en FloodWait, pasa al final sin reordenar las demás
+            upload_order.sort(key=lambda p: flood_registry.is_flooded(BOT_PATH_MTPROTO if p == 'mtproto' else BOT_PATH_PTB))
+            for upload_path in upload_order:
+                set_phase('subiendo', file_size)
+                started = time.monotonic()
+                try:
+                    logger.info(f"Enviando {file_size / (1024*1024):.1f} MB ({content_type}) por {upload_path}")
+                    sent_msg = await upload_senders[upload_path]()
+                    upload_selector.record(upload_path, file_size, content_type, True, time.monotonic() - started)
+                    break
+                except Exception as send_error:
+                    last_error = send_error
+                    # Un FloodWait es de la ruta, no del archivo: no penaliza sus estadísticas
+                    if not note_bot_flood(BOT_PATH_MTPROTO if upload_path == 'mtproto' else BOT_PATH_PTB, send_error):
+                        upload_selector.record(upload_path, file_size, content_type, False)
+                    logger.error(f"Error enviando por {upload_path}: {send_error}")
+            else:
+                if isinstance(last_error, FloodWaitError):
+                    # FloodWait del bot, no de la sesión del usuario: no debe aplazar su trabajo
+                    raise RuntimeError(f"Todas las rutas de subida están limitadas: {last_error}") from last_error
+                raise last_error or RuntimeError("No hay rutas de subida disponibles")
             
+            remember_sent_media(cache_keys, sent_msg, file_size)
+            os.remove(path)
+    except asyncio.CancelledError:
+        # Cancelada por el usuario: no se guarda progreso para reanudar
+        # (el archivo del spool lo borra el finally al liberar su reserva)
+        if cancelled_by_user():
+            logger.info(f"🛑 Transferencia cancelada por el usuario {chat_id}")
+            discard_partial_download(message)
+        raise
+    except FloodWaitError:
+        # Límite de la sesión del usuario: lo gestiona run_respecting_flood
+        if path and os.path.exists(path):
             os.remove(path)
-    except (asyncio.TimeoutError, TimeoutError):
+        raise
+    except (asyncio.TimeoutError, TimeoutError) as timeout_error:
         if path and os.path.exists(path):
             os.remove(path)
+        if isinstance(timeout_error, TransferStalled) and current_queue_download.get() is not None:
+            raise
         logger.error("Timeout en download_and_send_media")
         await bot.send_message(
             chat_id=chat_id, 
@@ -1297,6 +2226,8 @@ async def download_and_send_media(message, chat_id: int, bot, caption=None):
         logger.error(f"Error en download_and_send_media: {e}")
         await bot.send_message(chat_id=chat_id, text=f"❌ Error: {str(e)}")
         return False
+    finally:
+        await download_spool.release(path)
     
     logger.info(f"download_and_send_media completado exitosamente para chat_id {chat_id}")
     return True
@@ -1406,6 +2337,18 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.message.reply_text(welcome_message, parse_mode='Markdown', reply_markup=reply_markup)
         return
         
+    if query.data == CANCEL_CALLBACK_DATA:
+        # Cancela la descarga en curso de este mensaje de estado y libera su slot
+        if cancel_transfer(query.message.chat_id, query.message.message_id, query.from_user.id):
+            await query.answer("🛑 Cancelando...")
+            try:
+                await query.edit_message_text(CANCELLED_TEXT, parse_mode='Markdown')
+            except Exception as e:
+                logger.debug(f"No se pudo editar el mensaje cancelado: {e}")
+        else:
+            await query.answer("Esta descarga ya no se puede cancelar.")
+        return
+
     if query.data == "cancel_login":
         await query.answer()
         await cancel_login(update, context)
@@ -2369,7 +3312,7 @@ async def handle_link_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         # Llamar a la función de descarga mejorada
-        await process_download(update, context, channel_identifier, message_id, processing_msg)
+        await process_download(update, context, channel_identifier, message_id, processing_msg, link=link)
         
         # Finalizar conversación
         return ConversationHandler.END
@@ -2392,8 +3335,11 @@ async def cancel_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def process_download(update: Update, context: ContextTypes.DEFAULT_TYPE, 
-                          channel_identifier: str, message_id: int, status_msg):
-    """Procesa la descarga del contenido con manejo optimizado de errores"""
+                          channel_identifier: str, message_id: int, status_msg, link: str = None):
+    """
+    Procesa la descarga del contenido con manejo optimizado de errores.
+    Con la sesión en FloodWait se aplaza en la cola igual que un enlace directo.
+    """
     user_id = update.effective_user.id
     user = get_user(user_id)
     lang = get_user_language(user)
@@ -2408,7 +3354,7 @@ async def process_download(update: Update, context: ContextTypes.DEFAULT_TYPE,
         )
         return
 
-    try:
+    async def job():
         async with get_user_client(user_id) as client:
             # 1. Resolver entidad (canal/grupo)
             try:
@@ -2423,14 +3369,24 @@ async def process_download(update: Update, context: ContextTypes.DEFAULT_TYPE,
                         await BotError.invite_link_expired(status_msg, is_message=True)
                         return
                     channel = await client.get_entity(invite_hash)
+                elif channel_identifier.isdigit():
+                    channel = await get_entity_from_identifier(client, channel_identifier, user_id=user_id)
                 else:
-                    channel = await client.get_entity(int(channel_identifier) if channel_identifier.isdigit() else channel_identifier)
+                    channel = await client.get_entity(channel_identifier)
             except (ChannelPrivateError, ChatForbiddenError, ValueError):
+                forget_channel_entity(user_id, channel_identifier)
                 await BotError.private_channel_no_invite(status_msg, is_message=True)
                 return
             
             # 2. Obtener mensaje(s)
-            original_message = await client.get_messages(channel, ids=message_id)
+            try:
+                channel, original_message = await get_channel_messages(
+                    client, channel, channel_identifier, message_id, user_id=user_id
+                )
+            except (ChannelPrivateError, ChatForbiddenError):
+                forget_channel_entity(user_id, channel_identifier)
+                await BotError.private_channel_no_invite(status_msg, is_message=True)
+                return
             if not original_message:
                 await BotError.message_not_found(status_msg, is_message=True)
                 return
@@ -2543,7 +3499,9 @@ async def process_download(update: Update, context: ContextTypes.DEFAULT_TYPE,
             
             report_lines.append(f"\n{get_msg('status_starting_download', lang)}")
             
-            await status_msg.edit_text("\n".join(report_lines), parse_mode='Markdown')
+            await status_msg.edit_text(
+                "\n".join(report_lines), parse_mode='Markdown', reply_markup=cancel_markup_for(status_msg)
+            )
             await asyncio.sleep(1) # Breve pausa para que el usuario lea
 
             # 5. Ejecutar descargas
@@ -2552,22 +3510,23 @@ async def process_download(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 return # El mensaje ya tiene la advertencia
 
             total_to_download = len(messages_to_download)
-            for idx, msg in enumerate(messages_to_download, 1):
-                msg_type = detect_content_type(msg)
-                
-                # Actualizar estado de descarga
-                if total_to_download > 1:
-                    status_text = (
-                        f"📥 *{get_msg('status_downloading', lang)}* ({idx}/{total_to_download})\n"
-                        f"📦 {msg_type.capitalize()}"
-                    )
-                    await status_msg.edit_text(status_text, parse_mode='Markdown')
-                
+            if total_to_download > 1:
+                # OPTIMIZACIÓN: Álbum completo con descargas concurrentes y send_media_group
+                await status_msg.edit_text(
+                    f"📥 *{get_msg('status_downloading', lang)}* ({total_to_download})",
+                    parse_mode='Markdown',
+                    reply_markup=cancel_markup_for(status_msg)
+                )
+                delivered = await deliver_album(
+                    context.bot, user_id, messages_to_download,
+                    caption=f"📸 Álbum ({total_to_download})\n\n{shared_caption}"
+                )
+                for content_type in delivered:
+                    await record_successful_download(context.bot, user_id, content_type)
+            else:
                 # Descargar - pasamos bypass_limits=True porque ya los verificamos nosotros
                 await handle_media_download(
-                    update, context, msg, user, status_msg,
-                    is_album=(total_to_download > 1),
-                    album_index=idx, album_total=total_to_download,
+                    update, context, messages_to_download[0], user, status_msg,
                     bypass_limits=True, custom_caption=shared_caption
                 )
 
@@ -2576,7 +3535,7 @@ async def process_download(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 try:
                     await status_msg.edit_text(
                         f"✅ *{get_msg('success_download', lang).strip()}*\n\n"
-                        f"📥 {total_to_download} {get_msg('success_album', lang).split(' ')[-2]}",
+                        f"📥 {len(delivered)} {get_msg('success_album', lang).split(' ')[-2]}",
                         parse_mode='Markdown'
                     )
                 except Exception:
@@ -2585,21 +3544,89 @@ async def process_download(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 # Para un solo archivo que se descargó con éxito, handle_media_download borra el status_msg
                 pass
 
-    except FloodWaitError as e:
-        await BotError.flood_wait(status_msg, e.seconds, is_message=True)
+    # El mensaje de estado lleva el botón de cancelar mientras dure la transferencia
+    cancel_key = register_cancellable(user_id, status_msg)
+    try:
+        wait = await run_respecting_flood(user_id, job)
+        if not wait:
+            return
+        if wait > FLOOD_MAX_DEFER or not link:
+            await BotError.flood_wait(status_msg, int(wait) + 1, is_message=True)
+            return
+        defer_chat_download(user_id, link, wait)
+        await status_msg.edit_text(flood_deferral_text(wait), parse_mode='Markdown')
+    except asyncio.CancelledError:
+        if not cancelled_by_user():
+            raise
+        logger.info(f"🛑 Descarga guiada de {user_id} cancelada por el usuario")
     except Exception as e:
         logger.error(f"Error en process_download: {e}")
         import traceback
         logger.error(traceback.format_exc())
         await BotError.download_failed(status_msg, is_message=True)
+    finally:
+        unregister_cancellable(cancel_key)
+
 
 
+async def record_successful_download(bot, user_id: int, content_type: str):
+    """Incrementa contadores y procesa referidos tras una entrega exitosa"""
+    # Incrementar contadores
+    if content_type == 'photo':
+        increment_daily_counter(user_id, 'photo')
+        increment_total_downloads(user_id)  # Contar fotos para referidos
+    elif content_type == 'video':
+        increment_total_downloads(user_id)
+        increment_daily_counter(user_id, 'video')
+    elif content_type == 'music':
+        increment_total_downloads(user_id)  # Contar música para referidos
+        increment_daily_counter(user_id, 'music')
+    elif content_type == 'apk':
+        increment_total_downloads(user_id)  # Contar APKs para referidos
+        increment_daily_counter(user_id, 'apk')
+    
+    # SISTEMA DE REFERIDOS: Confirmar referido si cumple requisitos
+    referrer_id = confirm_referral(user_id)
+    if referrer_id:
+        # Verificar y recompensar al referente si alcanzó 15 referidos
+        rewards_count = check_and_reward_referrer(referrer_id)
+        if rewards_count > 0:
+            try:
+                downloads_earned = rewards_count * 10
+                await bot.send_message(
+                    chat_id=referrer_id,
+                    text=f"🎉 *¡Felicidades!*\n\n"
+                         f"Has alcanzado 15 referidos válidos y has ganado *{downloads_earned} descargas extra*.\n\n"
+                         f"🎁 ¡Gracias por ayudarnos a crecer!\n\n"
+                         f"Usa /referidos para ver tu progreso.",
+                    parse_mode='Markdown'
+                )
+            except Exception as e:
+                logger.warning(f"Could not notify referrer {referrer_id}: {e}")
+        else:
+            # Notificar confirmación del referido sin recompensa aún
+            try:
+                stats = get_referral_stats(referrer_id)
+                await bot.send_message(
+                    chat_id=referrer_id,
+                    text=f"✅ *Referido confirmado!*\n\n"
+                         f"Tienes {stats['confirmed']}/15 referidos válidos.\n\n"
+                         f"Usa /referidos para más detalles.",
+                    parse_mode='Markdown'
+                )
+            except Exception as e:
+                logger.warning(f"Could not notify referrer {referrer_id}: {e}")
+
 
 async def handle_media_download(update: Update, context_or_bot,
                                 message, user: dict, status_msg, is_album: bool = False, 
                                 album_index: int = 1, album_total: int = 1,
-                                bypass_limits: bool = False, custom_caption: str = None):
-    """Maneja la descarga según el tipo de medio con validaciones optimizadas"""
+                                bypass_limits: bool = False, custom_caption: str = None) -> bool:
+    """
+    Maneja la descarga según el tipo de medio con validaciones optimizadas.
+    Devuelve True solo si el archivo llegó al usuario (los avisos de error
+    ya se le muestran aquí o en download_and_send_media).
+    """
     user_id = user.get('user_id', user.get('id'))
     bot = context_or_bot.bot if hasattr(context_or_bot, 'bot') else context_or_bot
     
@@ -2608,7 +3635,7 @@ async def handle_media_download(update: Update, context_or_bot,
     
     if content_type == 'other':
         await BotError.unsupported_content(status_msg, is_message=True)
-        return
+        return False
     
     # Verificar tamaño del archivo
     file_size = 0
@@ -2623,7 +3650,7 @@ async def handle_media_download(update: Update, context_or_bot,
     if file_size > 2000 * 1024 * 1024:
         file_size_mb = file_size / (1024 * 1024)
         await BotError.file_too_large(status_msg, file_size_mb, is_message=True)
-        return
+        return False
     
     # Verificar límites de usuario (solo si no se saltan)
     if not bypass_limits:
@@ -2643,13 +3670,14 @@ async def handle_media_download(update: Update, context_or_bot,
                 await BotError.total_limit_reached(status_msg, is_message=True)
             elif error_type == 'premium_required':
                 await BotError.premium_required(status_msg, content_type, is_message=True)
-            return
+            return False
 
     # Descargar y enviar
     await status_msg.edit_text(
         f"📥 *Descargando {content_type}...*\n\n"
         "⏳ Preparando archivo",
-        parse_mode='Markdown'
+        parse_mode='Markdown',
+        reply_markup=cancel_markup_for(status_msg)
     )
     
     try:
@@ -2670,55 +3698,11 @@ async def handle_media_download(update: Update, context_or_bot,
         
         # Usar la función optimizada para descargar y enviar
         logger.info(f"Iniciando envío de {content_type} para usuario {user_id}")
-        success = await download_and_send_media(message, user_id, bot, caption=final_caption)
+        success = await download_and_send_media(message, user_id, bot, caption=final_caption, status_msg=status_msg)
         logger.info(f"Resultado del envío: {success} para usuario {user_id}")
         
         if success:
-            # Incrementar contadores
-            if content_type == 'photo':
-                increment_daily_counter(user_id, 'photo')
-                increment_total_downloads(user_id)  # Contar fotos para referidos
-            elif content_type == 'video':
-                increment_total_downloads(user_id)
-                increment_daily_counter(user_id, 'video')
-            elif content_type == 'music':
-                increment_total_downloads(user_id)  # Contar música para referidos
-                increment_daily_counter(user_id, 'music')
-            elif content_type == 'apk':
-                increment_total_downloads(user_id)  # Contar APKs para referidos
-                increment_daily_counter(user_id, 'apk')
-            
-            # SISTEMA DE REFERIDOS: Confirmar referido si cumple requisitos
-            referrer_id = confirm_referral(user_id)
-            if referrer_id:
-                # Verificar y recompensar al referente si alcanzó 15 referidos
-                rewards_count = check_and_reward_referrer(referrer_id)
-                if rewards_count > 0:
-                    try:
-                        downloads_earned = rewards_count * 10
-                        await context.bot.send_message(
-                            chat_id=referrer_id,
-                            text=f"🎉 *¡Felicidades!*\n\n"
-                                 f"Has alcanzado 15 referidos válidos y has ganado *{downloads_earned} descargas extra*.\n\n"
-                                 f"🎁 ¡Gracias por ayudarnos a crecer!\n\n"
-                                 f"Usa /referidos para ver tu progreso.",
-                            parse_mode='Markdown'
-                        )
-                    except Exception as e:
-                        logger.warning(f"Could not notify referrer {referrer_id}: {e}")
-                else:
-                    # Notificar confirmación del referido sin recompensa aún
-                    try:
-                        stats = get_referral_stats(referrer_id)
-                        await context.bot.send_message(
-                            chat_id=referrer_id,
-                            text=f"✅ *Referido confirmado!*\n\n"
-                                 f"Tienes {stats['confirmed']}/15 referidos válidos.\n\n"
-                                 f"Usa /referidos para más detalles.",
-                            parse_mode='Markdown'
-                        )
-                    except Exception as e:
-                        logger.warning(f"Could not notify referrer {referrer_id}: {e}")
+            await record_successful_download(bot, user_id, content_type)
             
             # Éxito - eliminar mensaje de estado (solo si no es parte de un álbum, 
             # ya que process_download manejará el mensaje final para álbumes)
@@ -2742,14 +3726,240 @@ async def handle_media_download(update: Update, context_or_bot,
                         await UsageNotification.send_low_usage_warning(msg_to_reply, warning)
                 except Exception as e:
                     logger.warning(f"Error checking low usage warning: {e}")
-        else:
-            # El error ya fue enviado por download_and_send_media
-            pass
+        # Si falló, el error ya fue enviado por download_and_send_media
+        return bool(success)
         
+    except (FloodWaitError, TransferStalled):
+        raise
     except Exception as e:
         logger.error(f"Error en handle_media_download: {e}")
         await BotError.download_failed(status_msg, is_message=True)
+        return False
+
+
+
+ALBUM_INPUT_MEDIA = {
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+    'audio': InputMediaAudio,
+    'document': InputMediaDocument,
+}
+
+
+async def fetch_album_item(message, chat_id: int) -> dict:
+    """
+    Prepara un ítem de álbum: file_id cacheado, foto en memoria o documento en
+    archivo temporal. Los ítems con family=None se envían por separado.
+    """
+    from telethon.tl.types import MessageMediaPhoto
+
+    content_type = detect_content_type(message)
+    item = {
+        'message': message, 'content_type': content_type,
+        'cache_keys': media_cache_keys(message),
+        'kind': None, 'family': None, 'media': None, 'path': None,
+        'upload_size': 0, 'cached': False,
+    }
+
+    cached = get_cached_media(item['cache_keys'])
+    if cached and cached['media_kind'] in ALBUM_MEDIA_FAMILIES:
+        item.update(kind=cached['media_kind'], media=cached['file_id'], cached=True)
+        item['family'] = ALBUM_MEDIA_FAMILIES[item['kind']]
+        return item
+
+    if isinstance(message.media, MessageMediaPhoto):
+        kind = 'photo'
+    elif content_type == 'video':
+        kind = 'video'
+    elif content_type == 'music' and not getattr(message, 'voice', None):
+        kind = 'audio'
+    elif content_type == 'music':
+        return item  # Las notas de voz no pueden ir en un grupo
+    else:
+        kind = 'document'
+
+    file_size = get_file_size(message)
+    if file_size > ALBUM_GROUP_MAX_BYTES:
+        return item  # Demasiado grande para el Bot API: va por download_and_send_media
+
+    lane = choose_lane(file_size, is_photo=(kind == 'photo'))
+    async with download_slot(chat_id, lane=lane) as throttle:
+        dc_key = f"dc{media_dc_id(message) or 0}"
+        tracker = transfer_registry.start(
+            chat_id, lane, f"álbum/{kind}", file_size, tag=current_queue_download.get()
+        )
+        tracker.set_phase('descargando')
+        guard = StallGuard(stall_timeout_for(dc_key), name=f'álbum {dc_key}', on_progress=tracker.add)
+        outcome = 'error'
+        try:
+            item_ready = await _fetch_album_media(message, item, kind, file_size, guard, throttle)
+            outcome = 'ok' if item_ready else 'failed'
+        finally:
+            transfer_registry.finish(tracker, outcome)
+        if not item_ready:
+            return item
+        transfer_throughput.observe(dc_key, guard.bytes, guard.elapsed)
+
+    item.update(kind=kind, family=ALBUM_MEDIA_FAMILIES[kind])
+    return item
+
+
+async def _fetch_album_media(message, item: dict, kind: str, file_size: int, guard, throttle) -> bool:
+    """Descarga el media de un ítem de álbum a memoria (fotos) o al spool. False si no se pudo."""
+    if kind == 'photo':
+        photo_bytes = BytesIO()
+        if not await guard.run(message.download_media(
+                file=photo_bytes, progress_callback=transfer_progress(guard, throttle))):
+            return False
+        item.update(media=photo_bytes, upload_size=photo_bytes.tell())
+        return True
+
+    suffix = '.mp4' if kind == 'video' else ''
+    path = await download_spool.acquire(file_size, suffix=suffix, adopt=resumable_partial_path(message))
+    try:
+        if message.document and file_size > 0:
+            await guard.run(download_document_to_path(message, path, file_size, throttle, guard))
+        elif not await guard.run(message.download_media(
+                file=path, progress_callback=transfer_progress(guard, throttle))):
+            await download_spool.release(path)
+            return False
+    except BaseException:
+        await download_spool.release(path)
+        raise
+    item.update(path=path, upload_size=os.path.getsize(path))
+    return True
+
 
+def _album_media_input(item: dict):
+    """Contenido a enviar para un ítem (file_id, bytes en memoria o archivo abierto)"""
+    if item['cached']:
+        return item['media']
+    if item['path']:
+        return Path(item['path']).resolve() if BOT_API_LOCAL_MODE else open(item['path'], 'rb')
+    item['media'].seek(0)
+    return item['media']
+
+
+async def _pace_album_upload(items: list):
+    """Reserva en el gobernador la salida de los ítems que se van a subir"""
+    for item in items:
+        if not item['cached'] and item['upload_size']:
+            lane = choose_lane(item['upload_size'], is_photo=(item['kind'] == 'photo'))
+            await bandwidth_governor.egress(lane)(item['upload_size'])
+
+
+async def _send_album_fallback(bot, chat_id: int, item: dict, caption=None) -> bool:
+    """Flujo normal para un ítem; un atasco en la cola pierde ese ítem, no el álbum"""
+    try:
+        return bool(await download_and_send_media(item['message'], chat_id, bot, caption=caption))
+    except TransferStalled as stall:
+        logger.warning(f"Ítem de álbum {item['message'].id} atascado: {stall}")
+        return False
+
+
+async def send_album_single(bot, chat_id: int, item: dict, caption=None) -> bool:
+    """Envía un ítem suelto del álbum; si no hay media preparado usa el flujo normal"""
+    if item['kind'] is None:
+        return await _send_album_fallback(bot, chat_id, item, caption=caption)
+
+    await _pace_album_upload([item])
+    method_name, param = BOT_SEND_METHODS[item['kind']]
+    media_input = _album_media_input(item)
+    try:
+        sent = await getattr(bot, method_name)(
+            chat_id=chat_id, **{param: media_input}, caption=caption if caption else None
+        )
+        if not item['cached']:
+            remember_sent_media(item['cache_keys'], sent, item['upload_size'])
+        return True
+    except Exception as e:
+        logger.warning(f"Error enviando ítem de álbum ({item['kind']}): {e}")
+        if item['cached']:
+            delete_cached_media(item['cache_keys'])
+        return await _send_album_fallback(bot, chat_id, item, caption=caption)
+    finally:
+        if item['path'] and hasattr(media_input, 'close'):
+            media_input.close()
+
+
+async def send_album_group(bot, chat_id: int, group: list, caption=None) -> list:
+    """Envía un lote de 2-10 ítems en un solo send_media_group. Devuelve los ítems entregados."""
+    opened = []
+    media_list = []
+    await _pace_album_upload(group)
+    try:
+        for idx, item in enumerate(group):
+            media_input = _album_media_input(item)
+            if item['path']:
+                opened.append(media_input)
+            extra = {'supports_streaming': True} if item['kind'] == 'video' else {}
+            media_list.append(ALBUM_INPUT_MEDIA[item['kind']](
+                media=media_input,
+                caption=caption if (idx == 0 and caption) else None,
+                **extra
+            ))
+        sent_messages = await bot.send_media_group(chat_id=chat_id, media=media_list)
+    except Exception as e:
+        logger.warning(f"send_media_group falló ({len(group)} ítems), enviando uno a uno: {e}")
+        delivered = []
+        for idx, item in enumerate(group):
+            if await send_album_single(bot, chat_id, item, caption=caption if idx == 0 else None):
+                delivered.append(item)
+        return delivered
+    finally:
+        for f in opened:
+            f.close()
+
+    for item, sent in zip(group, sent_messages):
+        if not item['cached']:
+            remember_sent_media(item['cache_keys'], sent, item['upload_size'])
+    return list(group)
+
+
+async def deliver_album(bot, chat_id: int, messages: list, caption=None) -> list:
+    """
+    Motor de álbumes: descarga hasta ALBUM_FETCH_CONCURRENCY ítems a la vez y los
+    envía en orden con send_media_group (lotes de hasta 10).
+    Devuelve los content_type entregados, en orden, para actualizar contadores.
+    """
+    semaphore = asyncio.Semaphore(ALBUM_FETCH_CONCURRENCY)
+    # Ítems ya preparados: su reserva del spool se libera aunque otro falle o se cancele
+    fetched = []
+
+    async def fetch(message):
+        async with semaphore:
+            try:
+                item = await fetch_album_item(message, chat_id)
+            except Exception as e:
+                logger.warning(f"Error preparando ítem de álbum {message.id}: {e}")
+                item = {
+                    'message': message, 'content_type': detect_content_type(message),
+                    'cache_keys': media_cache_keys(message), 'kind': None, 'family': None,
+                    'media': None, 'path': None, 'upload_size': 0, 'cached': False,
+                }
+            fetched.append(item)
+            return item
+
+    delivered = []
+    pending_caption = caption
+    try:
+        # return_exceptions: si un ítem falla, los demás terminan y quedan en fetched
+        items = await asyncio.gather(*(fetch(m) for m in messages), return_exceptions=True)
+        for result in items:
+            if isinstance(result, BaseException):
+                raise result
+        for group in plan_media_groups(items, max_items=10, max_bytes=ALBUM_GROUP_MAX_BYTES):
+            if len(group) == 1:
+                if await send_album_single(bot, chat_id, group[0], caption=pending_caption):
+                    delivered.append(group[0]['content_type'])
+            else:
+                sent_items = await send_album_group(bot, chat_id, group, caption=pending_caption)
+                delivered.extend(item['content_type'] for item in sent_items)
+            pending_caption = None
+    finally:
+        for item in fetched:
+            await download_spool.release(item.get('path'))
+    return delivered
 
 
 def check_download_limits(user: dict, content_type: str) -> tuple[bool, str, dict]:
@@ -3065,7 +4275,7 @@ async def diagnostic_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # 3. Telethon Bot Client
     if bot_client and bot_client.is_connected():
-        results.append("✅ *Cliente Telethon (Bot):* Conectado")
+        results.append(f"✅ *Cliente Telethon (Bot):* Conectado ({bot_sender_pool.connected}/{bot_sender_pool.size} emisores)")
     else:
         results.append("⚠️ *Cliente Telethon (Bot):* Desconectado o no iniciado")
         
@@ -3390,8 +4600,13 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(msg, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
-async def handle_message_logic(update, context_or_bot, client, link, parsed, user_id, user):
-    """Lógica principal de manejo de mensajes con cliente de usuario"""
+async def handle_message_logic(update, context_or_bot, client, link, parsed, user_id, user) -> tuple[bool, Optional[str]]:
+    """
+    Lógica principal de manejo de mensajes con cliente de usuario.
+    Retorna: (completado, motivo). completado=True solo si el contenido pedido
+    llegó al usuario (o se unió al canal); si no, motivo resume el fallo que ya
+    se le mostró. FloodWait y los atascos de la cola se propagan.
+    """
     channel_id, message_id = parsed
     joined_automatically = False
     
@@ -3411,48 +4626,52 @@ async def handle_message_logic(update, context_or_bot, client, link, parsed, use
                 await asyncio.sleep(1)
                 channel_name = getattr(result.chats[0], 'title', 'canal') if result.chats else 'canal'
                 await reply(f"✅ *Unido Exitosamente*\n\nMe uní al canal: *{channel_name}*\n\nAhora puedes enviarme enlaces de mensajes específicos del canal para descargar contenido.\n\n📝 Ejemplo: t.me/+HASH/123")
-                return
+                return True, None
             except UserAlreadyParticipantError:
                 await reply("ℹ️ *Ya Estoy en el Canal*\n\nYa soy miembro de este canal.\n\nPuedes enviarme enlaces de mensajes específicos para descargar contenido.\n\n📝 Ejemplo: t.me/+HASH/123")
-                return
+                return True, None
             except InviteHashExpiredError:
                 await reply("La invitación ha expirado\n\nPide al administrador del canal un enlace nuevo (debe empezar con t.me/+) y envíamelo otra vez.")
-                return
+                return False, 'Invite link expired'
             except InviteHashInvalidError:
                 await reply("Enlace de invitación inválido o ya usado\n\nAsegúrate de copiar el enlace completo que empieza con t.me/+")
-                return
-            except FloodWaitError as e:
-                await reply(f"⏳ *Límite de Velocidad*\n\nDemasiadas solicitudes. Espera {e.seconds} segundos e inténtalo nuevamente.")
-                return
+                return False, 'Invalid invite link'
+            except FloodWaitError:
+                raise  # Se aplaza y reintenta con run_respecting_flood
             except Exception as join_e:
                 logger.error(f"Error joining channel: {join_e}")
                 await reply("❌ *Error al Unirse al Canal*\n\nNo pude unirme al canal automáticamente.\n\n🔍 *Qué puedes hacer:*\n1️⃣ Verifica que el enlace sea correcto\n2️⃣ Pide un nuevo enlace de invitación al admin\n3️⃣ Intenta agregar el bot manualmente al canal\n\n💡 Si el problema persiste, contacta al administrador del canal.")
-                return
+                return False, f'Could not join channel: {join_e}'
         else:
             await reply("❌ *Enlace Incompleto*\n\nEste enlace no tiene el número de mensaje.\n\n📝 *Necesito el enlace completo:*\n• Para canales públicos: t.me/canal/123\n• Para canales privados: t.me/c/123456/789\n\n💡 Toca el mensaje específico → Copiar enlace")
-            return
+            return False, 'Link without message id'
     
     try:
         message = None
         entity = None
         logger.info(f"Attempting to get message {message_id} from channel {channel_id}")
         try:
-            entity = await get_entity_from_identifier(client, channel_id)
+            entity = await get_entity_from_identifier(client, channel_id, user_id=user_id)
             logger.info(f"Entity resolved: {entity}")
-            message = await client.get_messages(entity, ids=message_id)
+            entity, message = await get_channel_messages(client, entity, channel_id, message_id, user_id=user_id)
             logger.info(f"Message retrieved: {message is not None}")
         except ValueError as ve:
             logger.warning(f"ValueError getting entity: {ve}")
             if channel_id.isdigit():
                 try:
                     logger.info(f"Numeric channel ID, searching in dialogs...")
+                    scanned_channels = []
                     async for dialog in client.iter_dialogs():
+                        if dialog.is_channel:
+                            scanned_channels.append(dialog.entity)
                         if dialog.is_channel and str(dialog.entity.id) == channel_id:
                             entity = dialog.entity
                             logger.info(f"Found channel in dialogs: {dialog.entity.title}")
                             message = await client.get_messages(entity, ids=message_id)
                             logger.info(f"Message retrieved from dialog channel: {message is not None}")
                             break
+                    # Cachear todos los canales vistos: próximas peticiones sin escaneo
+                    remember_channel_entities(user_id, scanned_channels)
                     if not message:
                         raise ChannelPrivateError(None)
                 except Exception as ex:
@@ -3470,37 +4689,37 @@ async def handle_message_logic(update, context_or_bot, client, link, parsed, use
             else:
                 raise ChannelPrivateError(None)
         except (ChannelPrivateError, ChatForbiddenError):
+            forget_channel_entity(user_id, channel_id)
             if channel_id.startswith('+'):
                 try:
                     invite_hash = channel_id[1:]
                     await client(ImportChatInviteRequest(invite_hash))
                     await asyncio.sleep(1)
-                    entity = await get_entity_from_identifier(client, channel_id)
-                    message = await client.get_messages(entity, ids=message_id)
+                    entity = await get_entity_from_identifier(client, channel_id, user_id=user_id)
+                    entity, message = await get_channel_messages(client, entity, channel_id, message_id, user_id=user_id)
                     await reply("Unido al canal automáticamente. Descargando...")
                     joined_automatically = True
                 except InviteHashExpiredError:
                     await reply("La invitación ha expirado\n\nPide al administrador del canal un enlace nuevo (debe empezar con t.me/+) y envíamelo otra vez.")
-                    return
+                    return False, 'Invite link expired'
                 except InviteHashInvalidError:
                     await reply("Enlace de invitación inválido o ya usado\n\nAsegúrate de copiar el enlace completo que empieza con t.me/+")
-                    return
-                except FloodWaitError as flood_e:
-                    await reply(f"⏳ *Límite de Velocidad*\n\nDemasiadas solicitudes. Espera {flood_e.seconds} segundos e inténtalo nuevamente.")
-                    return
+                    return False, 'Invalid invite link'
+                except FloodWaitError:
+                    raise  # Se aplaza y reintenta con run_respecting_flood
                 except Exception as join_e:
                     logger.error(f"Error joining channel: {join_e}")
                     await reply("❌ *Error al Unirse al Canal*\n\nNo pude unirme al canal automáticamente.\n\n🔍 *Qué puedes hacer:*\n1️⃣ Verifica que el enlace sea correcto\n2️⃣ Pide un nuevo enlace de invitación al admin\n3️⃣ Intenta agregar el bot manualmente al canal\n\n💡 Si el problema persiste, contacta al administrador del canal.")
-                    return
+                    return False, f'Could not join channel: {join_e}'
             else:
                 me = await client.get_me()
                 username = f"@{me.username}" if me.username else "el bot"
                 await reply(f"Este es un canal privado y no tengo acceso\n\nPara que pueda descargar:\n\nOpción 1 → Envíame un enlace de invitación (empieza con t.me/+) \nOpción 2 → Agrégame manualmente al canal con mi cuenta {username}")
-                return
+                return False, 'Private channel without access'
         
         if not message:
             await reply("❌ *Mensaje No Encontrado*\n\nNo pude encontrar este mensaje en el canal.\n\n🔍 *Posibles razones:*\n• El mensaje fue eliminado\n• El enlace está incorrecto\n• El canal no existe\n\n💡 Verifica el enlace y envíamelo otra vez.")
-            return
+            return False, 'Message not found'
 
         # Check if message is part of an album (grouped media)
         album_messages = []
@@ -3603,8 +4822,10 @@ async def handle_message_logic(update, context_or_bot, client, link, parsed, use
                         inner_ch, inner_msg_id = inner_parsed
                         if inner_msg_id:
                             try:
-                                inner_ent = await get_entity_from_identifier(client, inner_ch)
-                                inner_msg = await client.get_messages(inner_ent, ids=inner_msg_id)
+                                inner_ent = await get_entity_from_identifier(client, inner_ch, user_id=user_id)
+                                inner_ent, inner_msg = await get_channel_messages(
+                                    client, inner_ent, inner_ch, inner_msg_id, user_id=user_id
+                                )
                                 if inner_msg and inner_msg.media:
                                     # Reiniciar lógica con el nuevo mensaje anidado
                                     # Para simplificar, llamamos recursivamente o simplemente procesamos este
@@ -3614,9 +4835,9 @@ async def handle_message_logic(update, context_or_bot, client, link, parsed, use
         if not counts['photo'] and not counts['video'] and not counts['music'] and not counts['apk']:
             if not message.media and message.text:
                 await reply(f"📄 *Contenido del Mensaje:*\n\n{message.text}")
-            else:
-                await reply("❌ *Sin Contenido soportado*")
-            return
+                return True, None
+            await reply("❌ *Sin Contenido soportado*")
+            return False, 'Unsupported content'
 
         # 4. Reporte "Se detectó"
         report_lines = [f"*{get_msg('status_detected_title', lang)}*"]
@@ -3633,34 +4854,57 @@ async def handle_message_logic(update, context_or_bot, client, link, parsed, use
         
         report_lines.append(f"\n{get_msg('status_starting_download', lang)}")
         
-        status_msg = await reply("\n".join(report_lines))
-        await asyncio.sleep(1)
-
         # 5. Descargar
-        if not messages_to_download: return
+        if not messages_to_download:
+            await reply("\n".join(report_lines))
+            return False, 'Download limit reached'
+
+        # El mensaje de estado lleva el botón de cancelar mientras dure la transferencia
+        status_msg = await reply("\n".join(report_lines), reply_markup=cancel_button_markup())
+        cancel_key = register_cancellable(user_id, status_msg)
+        try:
+            await asyncio.sleep(1)
 
-        total = len(messages_to_download)
-        for idx, msg in enumerate(messages_to_download, 1):
+            total = len(messages_to_download)
             if total > 1:
+                # OPTIMIZACIÓN: Álbum completo con descargas concurrentes y send_media_group
                 try:
-                    await status_msg.edit_text(f"📥 *{get_msg('status_downloading', lang)}* ({idx}/{total})")
+                    await status_msg.edit_text(
+                        f"📥 *{get_msg('status_downloading', lang)}* ({total})",
+                        reply_markup=cancel_markup_for(status_msg)
+                    )
                 except Exception: pass
-            
-            await handle_media_download(
-                update, context_or_bot, msg, user, status_msg,
-                is_album=(total > 1), album_index=idx, album_total=total,
-                bypass_limits=True, custom_caption=shared_caption
-            )
+                
+                bot = context_or_bot.bot if hasattr(context_or_bot, 'bot') else context_or_bot
+                delivered = await deliver_album(
+                    bot, user_id, messages_to_download,
+                    caption=f"📸 Álbum ({total})\n\n{shared_caption}"
+                )
+                for content_type in delivered:
+                    await record_successful_download(bot, user_id, content_type)
+            else:
+                sent = await handle_media_download(
+                    update, context_or_bot, messages_to_download[0], user, status_msg,
+                    bypass_limits=True, custom_caption=shared_caption
+                )
+                return sent, None if sent else 'Media was not sent'
+        finally:
+            unregister_cancellable(cancel_key)
 
         # Mensaje Final
-        if total > 1:
-            try:
-                await status_msg.edit_text(f"✅ *{get_msg('success_download', lang).strip()}*\n\n📥 {total} {get_msg('success_album', lang).split(' ')[-2]}")
-            except Exception: pass
-
+        try:
+            await status_msg.edit_text(f"✅ *{get_msg('success_download', lang).strip()}*\n\n📥 {len(delivered)} {get_msg('success_album', lang).split(' ')[-2]}")
+        except Exception: pass
+        if not delivered:
+            return False, 'No album item was sent'
+        return True, None
+
+    except (FloodWaitError, TransferStalled):
+        raise
     except Exception as e:
         logger.error(f"Error in handle_message_logic: {e}", exc_info=True)
         await reply("❌ *Error Inesperado*")
+        return False, f'Unexpected error: {e}'
 
 
 async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -3784,9 +5028,35 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    try:
+    await run_direct_download(update, context, link, parsed, user_id, user)
+
+
+async def run_direct_download(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              link: str, parsed: dict, user_id: int, user: dict):
+    """
+    Ejecuta una descarga pedida por chat. Si la sesión del usuario está en
+    FloodWait, se aplaza en la cola y se reintenta sola cuando termine la ventana.
+    """
+    async def job():
         async with get_user_client(user_id) as client:
             await handle_message_logic(update, context, client, link, parsed, user_id, user)
+
+    try:
+        wait = await run_respecting_flood(user_id, job)
+        if not wait:
+            return
+        if wait > FLOOD_MAX_DEFER:
+            await update.message.reply_text(
+                f"⏳ *Límite de Velocidad*\n\nDemasiadas solicitudes. Espera {int(wait) + 1} segundos e inténtalo nuevamente.",
+                parse_mode='Markdown'
+            )
+            return
+        defer_chat_download(user_id, link, wait)
+        await update.message.reply_text(flood_deferral_text(wait), parse_mode='Markdown')
+    except asyncio.CancelledError:
+        if not cancelled_by_user():
+            raise
+        logger.info(f"🛑 Descarga de {user_id} cancelada por el usuario")
     except ValueError as ve:
         if "Invalid session" in str(ve):
             await update.message.reply_text(
@@ -3802,90 +5072,249 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Ocurrió un error inesperado.")
 
 
-# Configuración de concurrencia para descargas
-MAX_CONCURRENT_DOWNLOADS = 5
-download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+# Trabajos de la cola MiniApp en curso. Solo se reclaman filas cuando hay hueco
+# para ejecutarlas (el resto sigue en 'pending', sin tarea ni memoria) y cada
+# usuario tiene como mucho QUEUE_MAX_PER_USER en 'processing'.
+MAX_QUEUED_JOBS = int(os.getenv('QUEUE_MAX_JOBS', str(MAX_CONCURRENT_DOWNLOADS)))
+QUEUE_MAX_PER_USER = int(os.getenv('QUEUE_MAX_PER_USER', '2'))
+# Duración media de un trabajo (EWMA), publicada para estimar esperas en el panel
+queue_job_stats = {'avg_seconds': None, 'completed': 0}
+# Trabajo de la cola en curso en este contexto: etiqueta sus transferencias para
+# que su progreso se publique en pending_downloads (estado/SSE de la MiniApp)
+current_queue_download = contextvars.ContextVar('current_queue_download', default=None)
+QUEUE_PROGRESS_INTERVAL = 2
+# La cola se despierta al encolar (en proceso o por UDP) y al terminar un trabajo;
+# la revisión periódica solo cubre avisos perdidos
+QUEUE_IDLE_RECHECK = int(os.getenv('QUEUE_IDLE_RECHECK', '60'))
+queue_wakeup = asyncio.Event()
+
+# Leases: un trabajo reclamado renueva el suyo mientras corre. Si el proceso muere
+# (redeploy, pérdida de liderazgo) caduca y vuelve a la cola con backoff, hasta
+# DOWNLOAD_MAX_ATTEMPTS intentos; después queda en 'dead'.
+DOWNLOAD_LEASE_SECONDS = int(os.getenv('DOWNLOAD_LEASE_SECONDS', '120'))
+DOWNLOAD_LEASE_RENEW_INTERVAL = DOWNLOAD_LEASE_SECONDS / 4
+DOWNLOAD_MAX_ATTEMPTS = int(os.getenv('DOWNLOAD_MAX_ATTEMPTS', '3'))
+
+
+class QueueWakeupProtocol(asyncio.DatagramProtocol):
+    """Avisos UDP del panel (otro proceso) al encolar una descarga"""
+
+    def datagram_received(self, data, addr):
+        queue_wakeup.set()
+
 
 async def process_one_queued_download(application: Application, item: Dict):
-    """Procesa una única descarga de la cola con protección de tiempo y concurrencia"""
+    """Procesa una única descarga de la cola con protección de tiempo"""
     download_id = item['id']
     user_id = item['user_id']
     link = item['link']
+    started = time.monotonic()
+    current_queue_download.set(download_id)
     
-    async with download_semaphore:
-        try:
-            logger.info(f"📥 Processing queued download {download_id} for user {user_id}: {link}")
-            
-            # Check user existence and data
-            user = get_user(user_id)
-            if not user:
-                update_download_status(download_id, 'error', 'User not found')
-                return
-            
-            # Parse link
-            parsed = parse_telegram_link(link)
-            if not parsed:
-                await application.bot.send_message(user_id, "❌ El enlace enviado desde la MiniApp no es válido.")
-                update_download_status(download_id, 'error', 'Invalid link')
-                return
-            
-            # Use handle_message_logic with timeout (15 minutes max per download)
+    try:
+        logger.info(f"📥 Processing queued download {download_id} for user {user_id}: {link}")
+        
+        # Aviso en el chat (antes lo enviaba el panel de forma síncrona al encolar);
+        # no se repite en reintentos ni en descargas de chat aplazadas
+        if (item.get('source') or 'miniapp') == 'miniapp' and (item.get('attempts') or 1) <= 1 \
+                and not item.get('deferrals'):
             try:
-                async with asyncio.timeout(900): # 15 min timeout
-                    async with get_user_client(user_id) as client:
-                        await handle_message_logic(None, application, client, link, parsed, user_id, user)
+                await application.bot.send_message(
+                    user_id,
+                    f"📥 *Descarga solicitada desde MiniApp*\n\n🔗 Procesando: {link}\n\n⏳ Espera un momento...",
+                    parse_mode='Markdown'
+                )
+            except Exception as msg_e:
+                logger.warning(f"Error sending MiniApp confirmation to {user_id}: {msg_e}")
+        
+        # Check user existence and data
+        user = get_user(user_id)
+        if not user:
+            update_download_status(download_id, 'error', 'User not found')
+            return
+        
+        # Parse link
+        parsed = parse_telegram_link(link)
+        if not parsed:
+            await application.bot.send_message(user_id, "❌ El enlace enviado desde la MiniApp no es válido.")
+            update_download_status(download_id, 'error', 'Invalid link')
+            return
+        
+        # Las transferencias atascadas las corta StallGuard; este límite es solo una red de seguridad
+        async def job():
+            async with asyncio.timeout(QUEUE_JOB_MAX_SECONDS):
+                async with get_user_client(user_id) as client:
+                    # 'processed' solo con el envío confirmado; el aviso al usuario ya se dio
+                    delivered, reason = await handle_message_logic(None, application, client, link, parsed, user_id, user)
+                    if delivered:
                         update_download_status(download_id, 'processed')
                         logger.info(f"✅ Download {download_id} processed successfully")
-            except TimeoutError:
-                logger.error(f"⏱️ Timeout processing download {download_id}")
-                update_download_status(download_id, 'error', 'Timeout - processing took too long')
-                await application.bot.send_message(user_id, "❌ La descarga ha tardado demasiado y ha sido cancelada.")
-            except ValueError as ve:
-                if "Invalid session" in str(ve):
-                    update_download_status(download_id, 'error', 'Invalid session - user disconnected')
-                    await application.bot.send_message(
-                        user_id, 
-                        "⚠️ *Sesión Caducada*\n\nTu sesión de Telegram ya no es válida. Por seguridad, he desconectado tu cuenta.\n\n👉 Por favor, abre la MiniApp y vuelve a configurarla en la pestaña 'Cuenta'.",
-                        parse_mode='Markdown'
-                    )
-                else:
-                    update_download_status(download_id, 'error', str(ve))
-            except Exception as proc_e:
-                logger.error(f"Error processing queued download {download_id}: {proc_e}")
-                update_download_status(download_id, 'error', str(proc_e))
-                await application.bot.send_message(user_id, f"❌ Error al procesar descarga: {str(proc_e)[:50]}")
-                
-        except Exception as e:
-            logger.error(f"Fatal error in process_one_queued_download {download_id}: {e}")
-            update_download_status(download_id, 'error', f"Fatal: {str(e)}")
+                    else:
+                        update_download_status(download_id, 'error', reason or 'Not delivered')
+                        logger.warning(f"❌ Download {download_id} not delivered: {reason}")
+        
+        try:
+            wait = await run_respecting_flood(user_id, job)
+            if wait and (wait > FLOOD_MAX_DEFER or (item.get('deferrals') or 0) >= FLOOD_MAX_DEFERRALS):
+                update_download_status(download_id, 'error', f'FloodWait {int(wait)}s')
+                await application.bot.send_message(
+                    user_id,
+                    f"⏳ *Límite de Velocidad*\n\nDemasiadas solicitudes. Espera {int(wait) + 1} segundos e inténtalo nuevamente.",
+                    parse_mode='Markdown'
+                )
+            elif wait:
+                # Sesión limitada: vuelve a 'pending' con available_at (persistente);
+                # el observador la reclama cuando termine la ventana
+                if defer_download(download_id, wait + 1, f'FloodWait {int(wait)}s'):
+                    queue_wakeup.set()
+                    await application.bot.send_message(user_id, flood_deferral_text(wait), parse_mode='Markdown')
+        except asyncio.CancelledError:
+            if not cancelled_by_user():
+                raise
+            # Botón del mensaje de estado o MiniApp: la fila queda 'cancelled'
+            update_download_status(download_id, 'cancelled', 'Cancelled by user')
+            logger.info(f"🛑 Download {download_id} cancelada por el usuario")
+        except TransferStalled as stall:
+            # Atasco transitorio: vuelve a la cola con backoff y el diario del parcial
+            # intacto, así el siguiente intento reanuda donde quedó
+            outcome = retry_download(download_id, DOWNLOAD_MAX_ATTEMPTS, f'Stalled: {stall}')
+            logger.warning(f"⏸️ Download {download_id} atascada ({stall}): {outcome}")
+            if outcome == 'requeued':
+                queue_wakeup.set()
+                await application.bot.send_message(
+                    user_id,
+                    "⏸️ La descarga dejó de avanzar. Se reintentará automáticamente en unos minutos "
+                    "y continuará desde donde quedó."
+                )
+            elif outcome == 'dead':
+                await application.bot.send_message(
+                    user_id,
+                    "❌ La descarga dejó de avanzar varias veces y se ha cancelado.\n\n💡 Inténtalo de nuevo más tarde."
+                )
+        except TimeoutError:
+            logger.error(f"⏱️ Timeout processing download {download_id}")
+            update_download_status(download_id, 'error', 'Timeout - processing took too long')
+            await application.bot.send_message(user_id, "❌ La descarga ha tardado demasiado y ha sido cancelada.")
+        except ValueError as ve:
+            if "Invalid session" in str(ve):
+                update_download_status(download_id, 'error', 'Invalid session - user disconnected')
+                await application.bot.send_message(
+                    user_id, 
+                    "⚠️ *Sesión Caducada*\n\nTu sesión de Telegram ya no es válida. Por seguridad, he desconectado tu cuenta.\n\n👉 Por favor, abre la MiniApp y vuelve a configurarla en la pestaña 'Cuenta'.",
+                    parse_mode='Markdown'
+                )
+            else:
+                update_download_status(download_id, 'error', str(ve))
+        except Exception as proc_e:
+            logger.error(f"Error processing queued download {download_id}: {proc_e}")
+            update_download_status(download_id, 'error', str(proc_e))
+            await application.bot.send_message(user_id, f"❌ Error al procesar descarga: {str(proc_e)[:50]}")
+            
+    except Exception as e:
+        logger.error(f"Fatal error in process_one_queued_download {download_id}: {e}")
+        update_download_status(download_id, 'error', f"Fatal: {str(e)}")
+    finally:
+        queued_download_tasks.pop(download_id, None)
+        elapsed = time.monotonic() - started
+        avg = queue_job_stats['avg_seconds']
+        queue_job_stats['avg_seconds'] = elapsed if avg is None else 0.2 * elapsed + 0.8 * avg
+        queue_job_stats['completed'] += 1
 
 
 async def miniapp_queue_observer(application: Application):
     """
-    Background task that polls the database for pending downloads from the MiniApp
+    Background task that claims pending downloads from the MiniApp.
+    OPTIMIZACIÓN: sin sondeo; reclama en lote tantos trabajos como huecos
+    libres haya y espera a que lo despierten (encolado o trabajo terminado).
     """
-    logger.info(f"🚀 MiniApp Queue Observer started (Concurrency: {MAX_CONCURRENT_DOWNLOADS})")
+    logger.info(f"🚀 MiniApp Queue Observer started (Concurrency: {MAX_CONCURRENT_DOWNLOADS}, Jobs: {MAX_QUEUED_JOBS})")
     while True:
+        # Limpiar antes de reclamar: un aviso que llegue durante el claim no se pierde
+        queue_wakeup.clear()
+        free = MAX_QUEUED_JOBS - len(queued_download_tasks)
         try:
-            # Poll for next pending download
-            item = get_next_pending_download()
-            
-            if item:
-                # Mark as processing IMMEDIATELY to avoid other threads/tasks picking it up
-                update_download_status(item['id'], 'processing')
-                
-                # Start processing in background without blocking the loop
-                asyncio.create_task(process_one_queued_download(application, item))
-                
-                # Don't sleep if we found an item, try to pick next one immediately
-                # to fill up the concurrency slots
-                continue
-            
+            for item in claim_pending_downloads(free, INSTANCE_ID, DOWNLOAD_LEASE_SECONDS, QUEUE_MAX_PER_USER):
+                task = asyncio.create_task(process_one_queued_download(application, item))
+                queued_download_tasks[item['id']] = task
+                task.add_done_callback(lambda _: queue_wakeup.set())
         except Exception as queue_e:
             logger.error(f"Error in miniapp_queue_observer: {queue_e}")
+        
+        # Despertar también cuando venza la primera descarga aplazada (FloodWait o backoff)
+        timeout = QUEUE_IDLE_RECHECK
+        try:
+            next_at = get_next_available_at()
+            if next_at:
+                timeout = min(timeout, max(1.0, next_at - time.time()))
+        except Exception as e:
+            logger.debug(f"Error consultando descargas aplazadas: {e}")
+        try:
+            await asyncio.wait_for(queue_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def download_lease_keeper(application: Application):
+    """Renueva los leases de los trabajos en curso y recupera los de procesos caídos"""
+    while True:
+        try:
+            if queued_download_tasks:
+                renew_download_leases(list(queued_download_tasks), INSTANCE_ID, DOWNLOAD_LEASE_SECONDS)
             
-        # Wait before next poll if queue was empty
-        await asyncio.sleep(5)
+            reclaimed = reclaim_expired_downloads(DOWNLOAD_MAX_ATTEMPTS)
+            if reclaimed['requeued']:
+                logger.warning(f"♻️ {len(reclaimed['requeued'])} descargas con lease caducado devueltas a la cola")
+                queue_wakeup.set()
+            for item in reclaimed['dead']:
+                logger.error(f"💀 Download {item['id']} descartada tras {item['attempts']} intentos")
+                try:
+                    await application.bot.send_message(
+                        item['user_id'],
+                        "❌ No se pudo completar tu descarga tras varios intentos.\n\n💡 Vuelve a enviarla desde la MiniApp."
+                    )
+                except Exception as e:
+                    logger.debug(f"No se pudo avisar de la descarga {item['id']}: {e}")
+        except Exception as e:
+            logger.error(f"Error en download_lease_keeper: {e}")
+        await asyncio.sleep(DOWNLOAD_LEASE_RENEW_INTERVAL)
+
+
+async def queue_progress_publisher():
+    """Publica en pending_downloads el progreso de las transferencias de trabajos de la cola"""
+    published = {}
+    while True:
+        await asyncio.sleep(QUEUE_PROGRESS_INTERVAL)
+        try:
+            jobs = {}
+            for transfer in transfer_registry.snapshot()['active']:
+                if transfer['tag'] is None:
+                    continue
+                job = jobs.setdefault(transfer['tag'], {'phase': transfer['phase'], 'bytes': 0, 'total': 0})
+                job['bytes'] += transfer['bytes']
+                job['total'] += transfer['total'] or 0
+                # Un álbum sigue "descargando" mientras quede algún ítem en esa fase
+                if transfer['phase'] == 'descargando':
+                    job['phase'] = 'descargando'
+            updates = [
+                (download_id, job['phase'], job['bytes'], job['total'])
+                for download_id, job in jobs.items() if published.get(download_id) != job
+            ]
+            update_download_progress(updates)
+            published = jobs
+        except Exception as e:
+            logger.error(f"Error publicando progreso de la cola: {e}")
+
+
+async def start_queue_notifications():
+    """Despertador de la cola: callback en este proceso y escucha UDP para el panel"""
+    loop = asyncio.get_running_loop()
+    # El panel puede encolar desde otro hilo: despertar al loop del bot de forma segura
+    add_download_listener(lambda: loop.call_soon_threadsafe(queue_wakeup.set))
+    try:
+        await loop.create_datagram_endpoint(QueueWakeupProtocol, local_addr=QUEUE_NOTIFY_ADDR)
+        logger.info(f"📡 Avisos de cola por UDP en {QUEUE_NOTIFY_ADDR[0]}:{QUEUE_NOTIFY_ADDR[1]}")
+    except OSError as e:
+        logger.warning(f"No se pudo escuchar avisos UDP de la cola ({e}); revisión cada {QUEUE_IDLE_RECHECK}s")
 
 
 async def post_init(application: Application):
@@ -3903,11 +5332,47 @@ async def post_init(application: Application):
         bot_client = TelegramClient(session_path, TELEGRAM_API_ID, TELEGRAM_API_HASH)
         await bot_client.start(bot_token=TELEGRAM_TOKEN)
         logger.info("Telethon Bot Client started successfully")
+        connected = await bot_sender_pool.start()
+        logger.info(f"📤 Emisores de subida del bot: {connected}/{bot_sender_pool.size} conectados")
     except Exception as e:
         logger.error(f"Failed to start Telethon Bot Client: {e}")
 
+    # Limpieza de clientes de usuario inactivos del pool
+    spawn_background(user_client_pool_janitor())
+    
+    # Presupuestos de ancho de banda configurables desde el panel
+    spawn_background(bandwidth_config_watcher())
+    
+    # Spool de temporales: barrido de huérfanos al arrancar y periódico
+    spawn_background(spool_sweeper())
+    
+    # Métricas del pipeline (carriles, ancho de banda, FloodWait) para el panel
+    pipeline_metrics.register('flood', flood_registry.snapshot)
+    pipeline_metrics.register('lanes', lambda: {lane: sched.stats() for lane, sched in download_lanes.items()})
+    pipeline_metrics.register('bandwidth', bandwidth_governor.snapshot)
+    pipeline_metrics.register('client_pool', user_client_pool.stats)
+    pipeline_metrics.register('cross_dc', exported_senders.stats)
+    pipeline_metrics.register('bot_senders', bot_sender_pool.stats)
+    pipeline_metrics.register('singleflight', lambda: {'inflight': len(media_singleflight)})
+    pipeline_metrics.register('throughput', transfer_throughput.snapshot)
+    pipeline_metrics.register('upload_paths', upload_selector.snapshot)
+    pipeline_metrics.register('spool', download_spool.stats)
+    pipeline_metrics.register('transfers', transfer_registry.snapshot)
+    pipeline_metrics.register('queue', lambda: {
+        'capacity': MAX_QUEUED_JOBS,
+        'running': len(queued_download_tasks),
+        'per_user_limit': QUEUE_MAX_PER_USER,
+        'avg_job_seconds': round(queue_job_stats['avg_seconds'], 1) if queue_job_stats['avg_seconds'] else None,
+        'completed': queue_job_stats['completed'],
+    })
+    spawn_background(publish_pipeline_metrics())
+
     # Start MiniApp Download Queue Observer
-    asyncio.create_task(miniapp_queue_observer(application))
+    await start_queue_notifications()
+    spawn_background(download_lease_keeper(application))
+    spawn_background(queue_progress_publisher())
+    spawn_background(miniapp_queue_observer(application))
+    spawn_background(miniapp_cancel_watcher(application))
     logger.info("✅ MiniApp Queue Observer hooked into event loop")
 
     # Set bot commands menu
@@ -3947,6 +5412,14 @@ async def post_shutdown(application: Application):
     """Acciones a realizar al cerrar el bot"""
     logger.info("👋 Ejecutando post_shutdown...")
     
+    # Devolver a la cola los trabajos MiniApp en curso (los retoma la siguiente instancia)
+    try:
+        released = release_download_leases(INSTANCE_ID)
+        if released:
+            logger.info(f"🔁 {released} descargas en curso devueltas a la cola")
+    except Exception as e:
+        logger.error(f"Error devolviendo leases de descargas: {e}")
+    
     # Remove PID file
     if os.path.exists(PID_FILE):
         try:
@@ -3963,6 +5436,19 @@ async def post_shutdown(application: Application):
             logger.debug(f"Error disconnecting login client {user_id}: {e}")
             pass
             
+    # Close pooled user clients (y antes sus senders de otros DC)
+    try:
+        await exported_senders.close_all()
+        await user_client_pool.close_all()
+    except Exception as e:
+        logger.debug(f"Error closing user client pool: {e}")
+            
+    # Close bot upload senders (incluye bot_client)
+    try:
+        await bot_sender_pool.close_all()
+    except Exception as e:
+        logger.debug(f"Error closing bot sender pool: {e}")
+
     # Close bot client
     if bot_client:
         try:
@@ -4092,10 +5578,18 @@ async def async_main():
         pool_timeout=120.0        # 2 minutos para pool
     )
 
+    builder = Application.builder().token(TELEGRAM_TOKEN).request(request)
+    if BOT_API_SERVER_URL:
+        # Servidor Bot API propio; en modo local PTB envía los archivos por ruta
+        # y File.download_to_drive copia del disco del servidor en vez de por HTTP
+        logger.info(f"🛰️ Usando servidor Bot API {BOT_API_SERVER_URL} (local_mode={BOT_API_LOCAL_MODE})")
+        builder = (
+            builder.base_url(f"{BOT_API_SERVER_URL}/bot")
+            .base_file_url(f"{BOT_API_SERVER_URL}/file/bot")
+            .local_mode(BOT_API_LOCAL_MODE)
+        )
     application = (
-        Application.builder()
-        .token(TELEGRAM_TOKEN)
-        .request(request)
+        builder
         .post_init(post_init)
         .post_shutdown(post_shutdown)
         .build()
@@ -4133,7 +5627,8 @@ async def async_main():
     application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
     application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_webapp_data))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # block=False: una descarga larga no bloquea el resto de updates (p. ej. el botón de cancelar)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
 
     # Registrar el manejador de errores global
     application.add_error_handler(error_handler)
@@ -4149,13 +5644,17 @@ async def async_main():
             try:
                 if not try_acquire_bot_leadership(INSTANCE_ID):
                     logger.error("❌ Lost leadership! Shutting down this instance...")
+                    try:
+                        release_download_leases(INSTANCE_ID)
+                    except Exception as e:
+                        logger.error(f"Error devolviendo leases de descargas: {e}")
                     os._exit(1) # Radical shutdown to prevent Conflict 409
                 await asyncio.sleep(30) # Update leadership every 30s
             except Exception as e:
                 logger.error(f"Error in heartbeat: {e}")
                 await asyncio.sleep(10)
 
-    asyncio.create_task(leadership_heartbeat())
+    spawn_background(leadership_heartbeat())
     
     for attempt in range(max_retries):
         try:
@@ -8,7 +8,10 @@ VERSIÓN MEJORADA con más funcionalidades
 import os
 import csv
 import io
+import json
 import shutil
+import threading
+import time
 from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response, send_file
 from functools import wraps
 from dotenv import load_dotenv
@@ -38,6 +41,8 @@ app.config['SESSION_REFRESH_EACH_REQUEST'] = True  # Refresh session on each req
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "admin123")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN") or os.getenv("TELEGRAM_BOT_TOKEN")
 BOT_USERNAME_CACHE = os.getenv("BOT_USERNAME")
+# Mismo servidor Bot API que el bot (BOT_API_SERVER_URL si usa uno propio)
+TELEGRAM_API_BASE = (os.getenv("BOT_API_SERVER_URL", "") or "").strip().rstrip('/') or "https://api.telegram.org"
 
 from database import DB_FILE
 import requests
@@ -53,7 +58,7 @@ def get_bot_username_cached():
         return "bot"
         
     try:
-        response = requests.get(f"https://api.telegram.org/bot{token}/getMe", timeout=5)
+        response = requests.get(f"{TELEGRAM_API_BASE}/bot{token}/getMe", timeout=5)
         if response.ok:
             data = response.json()
             if data.get("ok"):
@@ -1164,7 +1169,7 @@ def broadcast_message():
         for user in users:
             user_id = user['user_id']
             try:
-                url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+                url = f"{TELEGRAM_API_BASE}/bot{bot_token}/sendMessage"
                 payload = {
                     "chat_id": user_id,
                     "text": message,
@@ -1433,7 +1438,7 @@ def create_invoice():
         plan = PREMIUM_PLANS.get(plan_key, PREMIUM_PLANS['pro'])
             
         # Telegram API createInvoiceLink
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/createInvoiceLink"
+        url = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/createInvoiceLink"
         
         payload = {
             "title": f"{plan['name']} - Premium {plan['days']} días",
@@ -1500,6 +1505,81 @@ def admin_flash_sale():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/admin/bandwidth', methods=['GET', 'POST'])
+@login_required
+def admin_bandwidth():
+    """API para ajustar en caliente el presupuesto de ancho de banda del bot (MB/s, 0 = sin límite)"""
+    from database import get_setting, set_setting
+    try:
+        if request.method == 'GET':
+            raw = get_setting('bandwidth_config', '')
+            return jsonify(json.loads(raw) if raw else {})
+        
+        data = request.get_json() or {}
+        config = {}
+        for key in ('ingress_mbps', 'egress_mbps'):
+            if key in data:
+                config[key] = max(0.0, float(data[key]))
+        for key in ('lane_shares', 'lane_mbps'):
+            if isinstance(data.get(key), dict):
+                config[key] = {
+                    lane: float(value) for lane, value in data[key].items()
+                    if lane in ('photo', 'medium', 'large')
+                }
+        set_setting('bandwidth_config', json.dumps(config))
+        return jsonify({'success': True, 'config': config})
+    
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid bandwidth config: {e}'}), 400
+    except Exception as e:
+        logger.error(f"Error managing bandwidth config: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/pipeline/metrics')
+@login_required
+def pipeline_metrics():
+    """Métricas del pipeline de descargas publicadas por el bot (carriles, ancho de banda, FloodWait)"""
+    from database import get_setting
+    try:
+        raw = get_setting('pipeline_metrics', '')
+        if not raw:
+            return jsonify({'available': False})
+        metrics = json.loads(raw)
+        metrics['available'] = True
+        metrics['age_seconds'] = round(datetime.now().timestamp() - metrics.get('generated_at', 0), 1)
+        return jsonify(metrics)
+    except Exception as e:
+        logger.error(f"Error reading pipeline metrics: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+# Admisión de la cola MiniApp: por encima de estos límites se responde 429 con
+# una espera estimada en vez de encolar sin fin
+MINIAPP_QUEUE_MAX_PENDING = int(os.getenv('MINIAPP_QUEUE_MAX_PENDING', '200'))
+MINIAPP_QUEUE_MAX_PER_USER = int(os.getenv('MINIAPP_QUEUE_MAX_PER_USER', '5'))
+QUEUE_DEFAULT_JOB_SECONDS = 60
+
+
+def bot_queue_metrics() -> dict:
+    """Métricas de la cola que publica el bot (capacidad, límite por usuario, duración media)"""
+    from database import get_setting
+    try:
+        return json.loads(get_setting('pipeline_metrics', '') or '{}').get('queue') or {}
+    except Exception as e:
+        logger.debug(f"Queue metrics unavailable: {e}")
+        return {}
+
+
+def estimate_queue_wait(jobs_ahead: int) -> int:
+    """Segundos estimados hasta que empiecen `jobs_ahead` trabajos, según las métricas de cola del bot"""
+    queue = bot_queue_metrics()
+    capacity = max(1, int(queue.get('capacity') or 1))
+    job_seconds = queue.get('avg_job_seconds') or QUEUE_DEFAULT_JOB_SECONDS
+    rounds = -(-max(1, jobs_ahead) // capacity)
+    return max(1, int(rounds * job_seconds))
+
+
 @app.route('/api/miniapp/download', methods=['POST'])
 def miniapp_download():
     """API endpoint to process download requests from MiniApp"""
@@ -1514,8 +1594,11 @@ def miniapp_download():
         # Asegurar que el usuario existe en la DB (por si entra directo por link sin pasar por /user)
         ensure_user_exists(user_id)
         
-        if not link or 't.me/' not in link:
+        from media_pipeline import normalize_telegram_link
+        link_key = normalize_telegram_link(link) if 't.me/' in link else None
+        if not link_key:
             return jsonify({'error': 'Valid Telegram link required'}), 400
+        channel_key, message_key = link_key
         
         # Check if user has session
         if not has_active_session(user_id):
@@ -1525,27 +1608,52 @@ def miniapp_download():
                 'message': 'Necesitas configurar tu cuenta primero'
             })
         
-        # Send message to user via bot (asíncrono via API de Telegram)
-        send_url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-        message_payload = {
-            "chat_id": user_id,
-            "text": f"📥 *Descarga solicitada desde MiniApp*\n\n🔗 Procesando: {link}\n\n⏳ Espera un momento...",
-            "parse_mode": "Markdown"
-        }
-        try:
-            requests.post(send_url, json=message_payload, timeout=5)
-        except Exception as msg_e:
-            logger.error(f"Error sending confirmation message: {msg_e}")
+        # Dobles toques y reintentos: si ya hay un trabajo activo para el mismo
+        # enlace se devuelve ese, antes de la admisión para no rechazarlo por cupo
+        from database import get_active_download_id, enqueue_download
+        existing_id = get_active_download_id(int(user_id), channel_key, message_key)
+        if existing_id:
+            logger.info(f"Download {existing_id} already active for user {user_id}, not enqueued again")
+            return jsonify({
+                'ok': True,
+                'download_id': existing_id,
+                'duplicate': True,
+                'message': 'Esa descarga ya está en curso. Revisa el chat del bot.'
+            })
+        
+        # Backpressure: no encolar si el usuario o la cola ya están al límite
+        from database import get_queue_load
+        load = get_queue_load(int(user_id))
+        retry_after = None
+        if load['user_active'] >= MINIAPP_QUEUE_MAX_PER_USER:
+            retry_after = estimate_queue_wait(1)
+        elif load['pending'] >= MINIAPP_QUEUE_MAX_PENDING:
+            retry_after = estimate_queue_wait(load['pending'] - MINIAPP_QUEUE_MAX_PENDING + 1)
+        if retry_after is not None:
+            logger.info(f"Download from user {user_id} rejected: queue full ({load}), retry in {retry_after}s")
+            response = jsonify({
+                'ok': False,
+                'error': 'queue_full',
+                'retry_after': retry_after,
+                'message': f'Hay muchas descargas en cola. Inténtalo de nuevo en unos {retry_after} segundos.'
+            })
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
         
         # AGREGAR A LA COLA DE DESCARGAS
-        from database import add_pending_download
-        download_id = add_pending_download(user_id, link)
-        logger.info(f"Download {download_id} enqueued for user {user_id}")
+        # (el aviso en el chat lo envía el bot al empezar; aquí no se llama al Bot API)
+        download_id, duplicate = enqueue_download(int(user_id), link, channel_key, message_key)
+        if duplicate:
+            logger.info(f"Download {download_id} already active for user {user_id}, not enqueued again")
+        else:
+            logger.info(f"Download {download_id} enqueued for user {user_id}")
         
         return jsonify({
             'ok': True,
             'download_id': download_id,
-            'message': 'Descarga iniciada. Revisa el chat del bot.'
+            'duplicate': duplicate,
+            'message': ('Esa descarga ya está en curso. Revisa el chat del bot.' if duplicate
+                        else 'Descarga iniciada. Revisa el chat del bot.')
         })
         
     except Exception as e:
@@ -1553,6 +1661,138 @@ def miniapp_download():
         return jsonify({'error': str(e)}), 500
 
 
+# Estado de las descargas de la cola: consulta puntual y stream SSE. Cada stream
+# ocupa un hilo de gunicorn, así que el tope global sale del pool de hilos (dejando
+# MINIAPP_SSE_RESERVED_THREADS para el resto de peticiones) y cada usuario puede
+# tener como mucho MINIAPP_SSE_MAX_PER_USER: un usuario con varias pestañas no deja
+# sin stream a los demás. Duran poco (EventSource reconecta); sin hueco, el
+# cliente consulta el estado directamente.
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', '16'))
+MINIAPP_SSE_RESERVED_THREADS = 4
+MINIAPP_SSE_MAX_STREAMS = int(os.getenv(
+    'MINIAPP_SSE_MAX_STREAMS', str(max(1, GUNICORN_THREADS - MINIAPP_SSE_RESERVED_THREADS))
+))
+MINIAPP_SSE_MAX_PER_USER = int(os.getenv('MINIAPP_SSE_MAX_PER_USER', '2'))
+MINIAPP_SSE_MAX_SECONDS = 60
+MINIAPP_SSE_POLL_SECONDS = 1
+TERMINAL_DOWNLOAD_STATUSES = ('processed', 'error', 'cancelled', 'dead')
+_sse_lock = threading.Lock()
+_sse_streams_by_user = {}
+
+
+def open_sse_stream(user_id: int) -> bool:
+    """Reserva un stream SSE para el usuario si hay hueco global y propio"""
+    with _sse_lock:
+        if sum(_sse_streams_by_user.values()) >= MINIAPP_SSE_MAX_STREAMS:
+            return False
+        if _sse_streams_by_user.get(user_id, 0) >= MINIAPP_SSE_MAX_PER_USER:
+            return False
+        _sse_streams_by_user[user_id] = _sse_streams_by_user.get(user_id, 0) + 1
+        return True
+
+
+def close_sse_stream(user_id: int):
+    with _sse_lock:
+        remaining = _sse_streams_by_user.get(user_id, 0) - 1
+        if remaining > 0:
+            _sse_streams_by_user[user_id] = remaining
+        else:
+            _sse_streams_by_user.pop(user_id, None)
+
+
+def download_status_payload(status: dict) -> dict:
+    """Estado de la fila con el porcentaje ya calculado para la MiniApp"""
+    total = status.get('bytes_total') or 0
+    status['percent'] = round(100 * (status.get('bytes_done') or 0) / total, 1) if total else None
+    status['done'] = status['status'] in TERMINAL_DOWNLOAD_STATUSES
+    return status
+
+
+@app.route('/api/miniapp/download/<int:download_id>', methods=['GET'])
+def miniapp_download_status(download_id):
+    """Estado de una descarga de la cola (posición, fase, bytes, resultado)"""
+    try:
+        user_id = request.args.get('user_id', type=int)
+        if not user_id:
+            return jsonify({'error': 'User ID required'}), 400
+        
+        from database import get_download_status
+        per_user_limit = bot_queue_metrics().get('per_user_limit') or 0
+        status = get_download_status(download_id, user_id, per_user_limit)
+        if status is None:
+            return jsonify({'error': 'not_found'}), 404
+        return jsonify({'ok': True, **download_status_payload(status)})
+        
+    except Exception as e:
+        logger.error(f"MiniApp download status error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/miniapp/download/<int:download_id>/events', methods=['GET'])
+def miniapp_download_events(download_id):
+    """Server-Sent Events con cada cambio de estado de la descarga hasta que termina"""
+    user_id = request.args.get('user_id', type=int)
+    if not user_id:
+        return jsonify({'error': 'User ID required'}), 400
+    
+    from database import get_download_status
+    if get_download_status(download_id, user_id) is None:
+        return jsonify({'error': 'not_found'}), 404
+    if not open_sse_stream(user_id):
+        return jsonify({'error': 'busy', 'retry_after': 2}), 503
+    
+    per_user_limit = bot_queue_metrics().get('per_user_limit') or 0
+    
+    def stream():
+        yield "retry: 2000\n\n"
+        last, last_sent = None, time.monotonic()
+        deadline = time.monotonic() + MINIAPP_SSE_MAX_SECONDS
+        while time.monotonic() < deadline:
+            status = get_download_status(download_id, user_id, per_user_limit)
+            if status is None:
+                return
+            payload = download_status_payload(status)
+            if payload != last:
+                yield f"data: {json.dumps(payload, default=str)}\n\n"
+                last, last_sent = payload, time.monotonic()
+                if payload['done']:
+                    return
+            elif time.monotonic() - last_sent > 15:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(MINIAPP_SSE_POLL_SECONDS)
+    
+    response = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    # El servidor WSGI cierra la respuesta al terminar o si el cliente se va
+    response.call_on_close(lambda: close_sse_stream(user_id))
+    return response
+
+
+@app.route('/api/miniapp/download/<int:download_id>/cancel', methods=['POST'])
+def miniapp_cancel_download(download_id):
+    """Cancela una descarga de la cola; si ya está en curso, el bot la corta en unos segundos"""
+    try:
+        data = request.get_json() or {}
+        user_id = data.get('user_id')
+        
+        if not user_id:
+            return jsonify({'error': 'User ID required'}), 400
+        
+        from database import cancel_pending_download
+        if not cancel_pending_download(download_id, int(user_id)):
+            return jsonify({'ok': False, 'error': 'not_cancellable'}), 409
+        
+        logger.info(f"Download {download_id} cancelled by user {user_id}")
+        return jsonify({'ok': True, 'download_id': download_id, 'status': 'cancelled'})
+        
+    except Exception as e:
+        logger.error(f"MiniApp cancel error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/miniapp/configure', methods=['POST'])
 def miniapp_configure():
     """API endpoint to redirect user to configure account"""
@@ -1564,7 +1804,7 @@ def miniapp_configure():
             return jsonify({'error': 'User ID required'}), 400
         
         # Send message to user via bot with configure instructions
-        send_url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+        send_url = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/sendMessage"
         
         keyboard = {
             "inline_keyboard": [[
@@ -1607,7 +1847,7 @@ def miniapp_disconnect():
             delete_user_session(user_id)
             
             # Notify user
-            send_url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+            send_url = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/sendMessage"
             message_payload = {
                 "chat_id": user_id,
                 "text": "✅ Tu cuenta ha sido desconectada correctamente.\n\nPuedes volver a configurarla cuando quieras con /configurar",
@@ -1656,7 +1896,7 @@ def miniapp_referrals():
         if not bot_username:
             try:
                 logger.info("Fetching bot username from Telegram API...")
-                bot_info_url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getMe"
+                bot_info_url = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/getMe"
                 bot_response = requests.get(bot_info_url, timeout=5).json()
                 logger.info(f"Telegram API response: {bot_response}")
                 bot_username = bot_response.get('result', {}).get('username', 'MEDIA_SAVE_videosbot')
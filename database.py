@@ -5,11 +5,14 @@ VERSIÓN OPTIMIZADA con mejores prácticas
 """
 
 import sqlite3
+import socket
 import logging
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 import os
+import time
+import json
 import base64
 import hashlib
 from cryptography.fernet import Fernet
@@ -33,6 +36,9 @@ else:
 
 DB_FILE = os.getenv("DATABASE_PATH", "users.db")
 
+# Aviso UDP al bot cuando se encola una descarga (panel y bot en procesos distintos)
+QUEUE_NOTIFY_ADDR = (os.getenv("QUEUE_NOTIFY_HOST", "127.0.0.1"), int(os.getenv("QUEUE_NOTIFY_PORT", "8765")))
+
 # Asegurar que el directorio de la base de datos existe
 db_dir = os.path.dirname(DB_FILE)
 if db_dir and not os.path.exists(db_dir):
@@ -228,6 +234,88 @@ def init_database():
         
         # Index para mejorar rendimiento de la cola con muchos usuarios
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_downloads_status_date ON pending_downloads(status, created_at)")
+
+        # Leases de la cola: instancia dueña, caducidad (epoch), intentos y backoff
+        for column, definition in (
+            ('lease_owner', 'TEXT DEFAULT NULL'),
+            ('lease_expires_at', 'REAL DEFAULT NULL'),
+            ('attempts', 'INTEGER DEFAULT 0'),
+            ('available_at', 'REAL DEFAULT 0'),
+            # Progreso en vivo del trabajo, publicado por el bot para la MiniApp
+            ('progress_phase', 'TEXT DEFAULT NULL'),
+            ('bytes_done', 'INTEGER DEFAULT 0'),
+            ('bytes_total', 'INTEGER DEFAULT 0'),
+            ('progress_at', 'REAL DEFAULT NULL'),
+            # Enlace normalizado (canal, mensaje) para deduplicar la cola
+            ('channel_key', 'TEXT DEFAULT NULL'),
+            ('message_key', 'INTEGER DEFAULT NULL'),
+            # Origen (miniapp o chat aplazado por FloodWait) y aplazamientos por FloodWait
+            ('source', "TEXT DEFAULT 'miniapp'"),
+            ('deferrals', 'INTEGER DEFAULT 0'),
+        ):
+            try:
+                cursor.execute(f"ALTER TABLE pending_downloads ADD COLUMN {column} {definition}")
+                logger.info(f"Added {column} column to pending_downloads table")
+            except sqlite3.OperationalError:
+                pass
+
+        # Migración: el estado 'deferred' ya no existe (un FloodWait deja la fila en
+        # 'pending' con available_at); las filas antiguas vuelven a la cola y el
+        # índice que lo incluía se recrea
+        cursor.execute("UPDATE pending_downloads SET status = 'pending' WHERE status = 'deferred'")
+        cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'idx_pending_downloads_active_link'"
+        )
+        index_row = cursor.fetchone()
+        if index_row and 'deferred' in (index_row['sql'] or ''):
+            cursor.execute("DROP INDEX idx_pending_downloads_active_link")
+            logger.info("Recreating idx_pending_downloads_active_link without 'deferred'")
+
+        # OPTIMIZACIÓN: un solo trabajo activo por (usuario, canal, mensaje); los
+        # terminados no cuentan, así que el mismo enlace puede volver a pedirse
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_pending_downloads_active_link
+            ON pending_downloads(user_id, channel_key, message_key)
+            WHERE status IN ('pending', 'processing') AND channel_key IS NOT NULL
+        """)
+        
+        # Caché de file_id: media de origen (documento/foto o canal+mensaje) -> file_id del bot
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS media_cache (
+                source_key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                media_kind TEXT NOT NULL,
+                file_size INTEGER DEFAULT 0,
+                hits INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Caché de entidades resueltas por usuario (canal -> access_hash), evita iter_dialogs
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS entity_cache (
+                user_id INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                access_hash INTEGER NOT NULL,
+                title TEXT DEFAULT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, channel_id)
+            )
+        """)
+        
+        # Diario de descargas parciales (para reanudar tras timeout o reintento)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS download_journal (
+                file_key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                file_size INTEGER NOT NULL,
+                offset INTEGER DEFAULT 0,
+                part_size INTEGER NOT NULL,
+                checksums TEXT DEFAULT '[]',
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
         
         logger.info("Database initialized successfully")
 
@@ -1054,7 +1142,8 @@ def hash_phone(phone_number: str) -> str:
 
 def set_user_session(user_id: int, session_string: str, phone_number: str) -> bool:
     """
-    Guarda la sesión encriptada del usuario
+    Guarda la sesión encriptada del usuario.
+    Los access_hash de entity_cache son de la sesión anterior: se descartan.
     """
     ensure_user_exists(user_id)
     encrypted_session = encrypt_session(session_string)
@@ -1066,7 +1155,9 @@ def set_user_session(user_id: int, session_string: str, phone_number: str) -> bo
             "UPDATE users SET session_string = ?, phone_hash = ? WHERE user_id = ?",
             (encrypted_session, phone_hash_val, user_id)
         )
-        return cursor.rowcount > 0
+        updated = cursor.rowcount > 0
+        cursor.execute("DELETE FROM entity_cache WHERE user_id = ?", (user_id,))
+        return updated
 
 def get_user_session(user_id: int) -> Optional[str]:
     """
@@ -1086,14 +1177,16 @@ def get_user_session(user_id: int) -> Optional[str]:
     return None
 
 def delete_user_session(user_id: int) -> bool:
-    """Elimina la sesión del usuario"""
+    """Elimina la sesión del usuario y su caché de entidades (access_hash de esa sesión)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "UPDATE users SET session_string = NULL, phone_hash = NULL WHERE user_id = ?",
             (user_id,)
         )
-        return cursor.rowcount > 0
+        updated = cursor.rowcount > 0
+        cursor.execute("DELETE FROM entity_cache WHERE user_id = ?", (user_id,))
+        return updated
 
 def has_active_session(user_id: int) -> bool:
     """Verifica si el usuario tiene una sesión activa"""
@@ -1106,43 +1199,362 @@ def has_active_session(user_id: int) -> bool:
 
 # ==================== COLA DE DESCARGAS (MINIAPP) ====================
 
-def add_pending_download(user_id: int, link: str) -> Optional[int]:
-    """Agrega una descarga a la cola"""
+_download_listeners = []
+
+
+def add_download_listener(callback):
+    """Registra un callback (sin argumentos) que se llama al encolar una descarga en este proceso"""
+    _download_listeners.append(callback)
+
+
+def notify_download_enqueued():
+    """Despierta al consumidor de la cola: en este proceso y por UDP si está en otro"""
+    for callback in list(_download_listeners):
+        try:
+            callback()
+        except Exception as e:
+            logger.debug(f"Error en listener de la cola: {e}")
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b"enqueued", QUEUE_NOTIFY_ADDR)
+    except OSError as e:
+        logger.debug(f"No se pudo avisar a la cola por UDP: {e}")
+
+
+def get_active_download_id(user_id: int, channel_key: str, message_key: Optional[int]) -> Optional[int]:
+    """Descarga aún activa del usuario para el mismo (canal, mensaje), si la hay"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
-            "INSERT INTO pending_downloads (user_id, link) VALUES (?, ?)",
-            (user_id, link)
+            """SELECT id FROM pending_downloads
+               WHERE user_id = ? AND channel_key = ? AND message_key IS ?
+                 AND status IN ('pending', 'processing')""",
+            (user_id, channel_key, message_key)
         )
-        return cursor.lastrowid
+        row = cursor.fetchone()
+        return row['id'] if row else None
 
-def get_next_pending_download() -> Optional[Dict]:
-    """Obtiene el siguiente elemento pendiente de la cola"""
+
+def enqueue_download(user_id: int, link: str, channel_key: Optional[str] = None,
+                     message_key: Optional[int] = None, source: str = 'miniapp',
+                     delay: float = 0) -> Tuple[Optional[int], bool]:
+    """
+    Encola una descarga salvo que el usuario ya tenga activa la misma.
+    Devuelve (download_id, duplicada); el índice único parcial resuelve la
+    carrera entre dos toques simultáneos. Con `delay` no se reclama hasta
+    pasados esos segundos (una descarga de chat aplazada por FloodWait).
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                """INSERT INTO pending_downloads
+                   (user_id, link, channel_key, message_key, source, available_at, deferrals)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (user_id, link, channel_key, message_key, source,
+                 time.time() + delay if delay else 0, 1 if delay else 0)
+            )
+            download_id = cursor.lastrowid
+        except sqlite3.IntegrityError:
+            cursor.execute(
+                """SELECT id FROM pending_downloads
+                   WHERE user_id = ? AND channel_key = ? AND message_key IS ?
+                     AND status IN ('pending', 'processing')""",
+                (user_id, channel_key, message_key)
+            )
+            row = cursor.fetchone()
+            return (row['id'] if row else None), True
+    notify_download_enqueued()
+    return download_id, False
+
+
+# Filas que el consumidor podría reclamar ya: 'pending', con available_at vencido
+# y su puesto dentro del usuario (slot) contando las que ya tiene en 'processing'.
+# Parámetro: ahora (epoch). Lo comparten el claim y la posición en la cola.
+_CLAIMABLE_DOWNLOADS_CTE = """
+    WITH inflight AS (
+        SELECT user_id, COUNT(*) AS running FROM pending_downloads
+        WHERE status = 'processing' GROUP BY user_id
+    ),
+    candidates AS (
+        SELECT p.id, p.created_at, COALESCE(i.running, 0) + ROW_NUMBER() OVER (
+            PARTITION BY p.user_id ORDER BY p.created_at, p.id
+        ) AS slot
+        FROM pending_downloads p INDEXED BY idx_pending_downloads_status_date
+        LEFT JOIN inflight i ON i.user_id = p.user_id
+        WHERE p.status = 'pending' AND COALESCE(p.available_at, 0) <= ?
+    )
+"""
+
+
+def claim_pending_downloads(limit: int, owner: str, lease_seconds: float,
+                            per_user_limit: int = 0) -> List[Dict]:
+    """
+    Reclama atómicamente hasta `limit` descargas pendientes (las más antiguas)
+    pasándolas a 'processing' en una sola sentencia: dos consumidores nunca
+    se llevan la misma fila. Cada fila queda con un lease de `owner` que hay
+    que renovar mientras dure el trabajo (renew_download_leases).
+    Con per_user_limit, un usuario nunca pasa de ese número de filas en
+    'processing'; las demás siguen en 'pending' hasta que termine alguna.
+    """
+    if limit <= 0:
+        return []
+    now = time.time()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            _CLAIMABLE_DOWNLOADS_CTE + """
+               UPDATE pending_downloads
+               SET status = 'processing', lease_owner = ?, lease_expires_at = ?,
+                   attempts = COALESCE(attempts, 0) + 1
+               WHERE id IN (
+                   SELECT id FROM candidates WHERE ? <= 0 OR slot <= ?
+                   ORDER BY created_at ASC, id ASC LIMIT ?
+               )
+               RETURNING *""",
+            (now, owner, now + lease_seconds, per_user_limit, per_user_limit, limit)
+        )
+        rows = [dict(row) for row in cursor.fetchall()]
+    # RETURNING no garantiza orden
+    return sorted(rows, key=lambda row: (row['created_at'] or '', row['id']))
+
+
+def update_download_progress(updates: List[tuple]) -> int:
+    """Guarda el progreso de trabajos en curso: [(download_id, fase, bytes, total), ...]"""
+    if not updates:
+        return 0
+    now = time.time()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            """UPDATE pending_downloads SET progress_phase = ?, bytes_done = ?, bytes_total = ?, progress_at = ?
+               WHERE id = ? AND status = 'processing'""",
+            [(phase, done, total, now, download_id) for download_id, phase, done, total in updates]
+        )
+        return cursor.rowcount
+
+
+def get_download_status(download_id: int, user_id: int, per_user_limit: int = 0) -> Optional[Dict]:
+    """
+    Estado de una descarga de la cola para su dueño. La posición cuenta solo las
+    filas que el consumidor reclamaría antes que ella (misma regla que
+    claim_pending_downloads); si la propia aún está aplazada, no hay posición.
+    """
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
-            "SELECT * FROM pending_downloads WHERE status = 'pending' ORDER BY created_at ASC LIMIT 1"
+            """SELECT id, status, error, attempts, created_at, processed_at, available_at,
+                      progress_phase, bytes_done, bytes_total
+               FROM pending_downloads WHERE id = ? AND user_id = ?""",
+            (download_id, user_id)
         )
         row = cursor.fetchone()
-        return dict(row) if row else None
+        if not row:
+            return None
+        status = dict(row)
+        status['position'] = None
+        now = time.time()
+        if status['status'] == 'pending' and (status['available_at'] or 0) <= now:
+            cursor.execute(
+                _CLAIMABLE_DOWNLOADS_CTE + """
+                   SELECT COUNT(*) FROM candidates
+                   WHERE (? <= 0 OR slot <= ?) AND (created_at < ? OR (created_at = ? AND id < ?))""",
+                (now, per_user_limit, per_user_limit, row['created_at'], row['created_at'], download_id)
+            )
+            status['position'] = cursor.fetchone()[0] + 1
+        return status
+
+
+def get_queue_load(user_id: int) -> Dict[str, int]:
+    """Descargas en espera (total) y activas del usuario, para la admisión del panel"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT COALESCE(SUM(status = 'pending'), 0) AS pending,
+                      COALESCE(SUM(status = 'processing'), 0) AS processing,
+                      COALESCE(SUM(user_id = ?), 0) AS user_active
+               FROM pending_downloads WHERE status IN ('pending', 'processing')""",
+            (user_id,)
+        )
+        return dict(cursor.fetchone())
+
+
+def renew_download_leases(download_ids: List[int], owner: str, lease_seconds: float) -> int:
+    """Prolonga los leases de los trabajos en curso de `owner`"""
+    if not download_ids:
+        return 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        placeholders = ','.join('?' * len(download_ids))
+        cursor.execute(
+            f"""UPDATE pending_downloads SET lease_expires_at = ?
+                WHERE status = 'processing' AND lease_owner = ? AND id IN ({placeholders})""",
+            [time.time() + lease_seconds, owner, *download_ids]
+        )
+        return cursor.rowcount
+
+
+def _retry_delay(attempts: int, backoff_base: float, backoff_max: float) -> float:
+    """Backoff exponencial tras `attempts` intentos fallidos"""
+    return min(backoff_max, backoff_base * (2 ** max(0, attempts - 1)))
+
+
+def reclaim_expired_downloads(max_attempts: int, backoff_base: float = 30,
+                              backoff_max: float = 900) -> Dict[str, List[Dict]]:
+    """
+    Recupera las descargas cuyo lease caducó (proceso caído o redeploy): vuelven
+    a 'pending' con backoff exponencial, o pasan a 'dead' tras max_attempts.
+    """
+    now = time.time()
+    requeued, dead = [], []
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM pending_downloads WHERE status = 'processing' AND lease_expires_at IS NOT NULL AND lease_expires_at < ?",
+            (now,)
+        )
+        for row in cursor.fetchall():
+            attempts = row['attempts'] or 0
+            if attempts >= max_attempts:
+                cursor.execute(
+                    """UPDATE pending_downloads SET status = 'dead', lease_owner = NULL, processed_at = ?,
+                       error = ? WHERE id = ? AND status = 'processing'""",
+                    (datetime.now(), f"Lease expired after {attempts} attempts", row['id'])
+                )
+                target = dead
+            else:
+                delay = _retry_delay(attempts, backoff_base, backoff_max)
+                cursor.execute(
+                    """UPDATE pending_downloads SET status = 'pending', lease_owner = NULL, available_at = ?
+                       WHERE id = ? AND status = 'processing'""",
+                    (now + delay, row['id'])
+                )
+                target = requeued
+            if cursor.rowcount:
+                target.append(dict(row))
+    return {'requeued': requeued, 'dead': dead}
+
+
+def retry_download(download_id: int, max_attempts: int, error: str,
+                   backoff_base: float = 30, backoff_max: float = 900) -> Optional[str]:
+    """
+    Devuelve a 'pending' con backoff un trabajo en curso que falló de forma
+    transitoria (transferencia atascada). Gasta el intento ya contado al
+    reclamarlo; tras max_attempts pasa a 'dead'.
+    Retorna 'requeued', 'dead' o None si la fila ya no estaba en curso.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT attempts FROM pending_downloads WHERE id = ? AND status = 'processing'",
+            (download_id,)
+        )
+        row = cursor.fetchone()
+        if not row:
+            return None
+        attempts = row['attempts'] or 0
+        if attempts >= max_attempts:
+            cursor.execute(
+                """UPDATE pending_downloads SET status = 'dead', lease_owner = NULL, processed_at = ?,
+                   error = ? WHERE id = ? AND status = 'processing'""",
+                (datetime.now(), f"{error} ({attempts} attempts)", download_id)
+            )
+            return 'dead' if cursor.rowcount else None
+        cursor.execute(
+            """UPDATE pending_downloads SET status = 'pending', lease_owner = NULL, available_at = ?,
+               error = ? WHERE id = ? AND status = 'processing'""",
+            (time.time() + _retry_delay(attempts, backoff_base, backoff_max), error, download_id)
+        )
+        return 'requeued' if cursor.rowcount else None
+
+
+def defer_download(download_id: int, delay: float, error: str = None) -> bool:
+    """
+    Devuelve a 'pending' un trabajo en curso que no debe reclamarse hasta dentro
+    de `delay` segundos (FloodWait de la sesión): no gasta intento y queda en la
+    base de datos, así que sobrevive a un reinicio.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE pending_downloads
+               SET status = 'pending', lease_owner = NULL, available_at = ?, error = ?,
+                   attempts = MAX(COALESCE(attempts, 1) - 1, 0),
+                   deferrals = COALESCE(deferrals, 0) + 1
+               WHERE id = ? AND status = 'processing'""",
+            (time.time() + delay, error, download_id)
+        )
+        return cursor.rowcount > 0
+
+
+def get_next_available_at() -> Optional[float]:
+    """Momento (epoch) en que vuelve a poder reclamarse la primera descarga aplazada"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT MIN(available_at) FROM pending_downloads WHERE status = 'pending' AND available_at > ?",
+            (time.time(),)
+        )
+        return cursor.fetchone()[0]
+
+
+def release_download_leases(owner: str) -> int:
+    """Devuelve a la cola (sin gastar intento) los trabajos en curso de `owner` al apagar"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE pending_downloads
+               SET status = 'pending', lease_owner = NULL, available_at = 0,
+                   attempts = MAX(COALESCE(attempts, 1) - 1, 0)
+               WHERE status = 'processing' AND lease_owner = ?""",
+            (owner,)
+        )
+        return cursor.rowcount
+
 
 def update_download_status(download_id: int, status: str, error: str = None) -> bool:
-    """Actualiza el estado de una descarga en la cola"""
+    """Actualiza el estado de una descarga en la cola (una descarga cancelada ya no cambia)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         if status == 'processed':
             cursor.execute(
-                "UPDATE pending_downloads SET status = ?, processed_at = ? WHERE id = ?",
+                "UPDATE pending_downloads SET status = ?, processed_at = ? WHERE id = ? AND status != 'cancelled'",
                 (status, datetime.now(), download_id)
             )
         else:
             cursor.execute(
-                "UPDATE pending_downloads SET status = ?, error = ? WHERE id = ?",
+                "UPDATE pending_downloads SET status = ?, error = ? WHERE id = ? AND status != 'cancelled'",
                 (status, error, download_id)
             )
         return cursor.rowcount > 0
 
 
+def cancel_pending_download(download_id: int, user_id: int) -> bool:
+    """Marca como cancelada una descarga del usuario que aún no ha terminado"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE pending_downloads SET status = 'cancelled', error = 'Cancelled by user', processed_at = ?
+               WHERE id = ? AND user_id = ? AND status IN ('pending', 'processing')""",
+            (datetime.now(), download_id, user_id)
+        )
+        return cursor.rowcount > 0
+
+
+def get_cancelled_download_ids(download_ids: List[int]) -> List[int]:
+    """De entre los ids dados, los que se han cancelado"""
+    if not download_ids:
+        return []
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        placeholders = ','.join('?' * len(download_ids))
+        cursor.execute(
+            f"SELECT id FROM pending_downloads WHERE status = 'cancelled' AND id IN ({placeholders})",
+            list(download_ids)
+        )
+        return [row['id'] for row in cursor.fetchall()]
+
+
 # ==================== SETTINGS & COORDINATION ====================
 
 def get_setting(key: str, default: Optional[str] = None) -> Optional[str]:
@@ -1229,3 +1641,143 @@ def try_acquire_bot_leadership(instance_id: str, timeout_seconds: int = 60) -> b
         logger.error(f"Error in leadership election: {e}")
         return False
 
+
+# ==================== CACHÉ DE FILE_ID ====================
+
+def get_cached_media(source_keys: list) -> Optional[Dict]:
+    """
+    Busca un file_id del bot ya enviado para alguna de las claves de origen
+    
+    Args:
+        source_keys: Claves en orden de preferencia (ej. 'doc:123', 'msg:-100456:789')
+        
+    Returns:
+        Dict con source_key, file_id, media_kind y file_size, o None si no hay entrada
+    """
+    if not source_keys:
+        return None
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for key in source_keys:
+            cursor.execute(
+                "SELECT source_key, file_id, media_kind, file_size FROM media_cache WHERE source_key = ?",
+                (key,)
+            )
+            row = cursor.fetchone()
+            if row:
+                cursor.execute(
+                    "UPDATE media_cache SET hits = hits + 1, last_used_at = CURRENT_TIMESTAMP WHERE source_key = ?",
+                    (key,)
+                )
+                return dict(row)
+    return None
+
+def save_cached_media(source_keys: list, file_id: str, media_kind: str, file_size: int = 0) -> None:
+    """Guarda el file_id devuelto por Telegram para todas las claves de origen"""
+    if not source_keys or not file_id:
+        return
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for key in source_keys:
+            cursor.execute("""
+                INSERT INTO media_cache (source_key, file_id, media_kind, file_size)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(source_key) DO UPDATE SET
+                    file_id = excluded.file_id,
+                    media_kind = excluded.media_kind,
+                    file_size = excluded.file_size,
+                    last_used_at = CURRENT_TIMESTAMP
+            """, (key, file_id, media_kind, file_size or 0))
+
+def delete_cached_media(source_keys: list) -> None:
+    """Invalida entradas de la caché (ej. file_id rechazado por Telegram)"""
+    if not source_keys:
+        return
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("DELETE FROM media_cache WHERE source_key = ?", [(k,) for k in source_keys])
+
+
+# ==================== DIARIO DE DESCARGAS PARCIALES ====================
+
+def get_download_journal(file_key: str) -> Optional[Dict]:
+    """Obtiene el estado guardado de una descarga parcial (checksums como lista)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM download_journal WHERE file_key = ?", (file_key,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        journal = dict(row)
+        try:
+            journal['checksums'] = json.loads(journal['checksums'] or '[]')
+        except ValueError:
+            journal['checksums'] = []
+        return journal
+
+def save_download_journal(file_key: str, path: str, file_size: int, offset: int,
+                          part_size: int, checksums: list) -> None:
+    """Guarda (o actualiza) el progreso de una descarga parcial"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO download_journal (file_key, path, file_size, offset, part_size, checksums, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(file_key) DO UPDATE SET
+                path = excluded.path,
+                file_size = excluded.file_size,
+                offset = excluded.offset,
+                part_size = excluded.part_size,
+                checksums = excluded.checksums,
+                updated_at = CURRENT_TIMESTAMP
+        """, (file_key, path, file_size, offset, part_size, json.dumps(checksums)))
+
+def delete_download_journal(file_key: str) -> None:
+    """Elimina el diario de una descarga (completada o descartada)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM download_journal WHERE file_key = ?", (file_key,))
+
+
+# ==================== CACHÉ DE ENTIDADES ====================
+
+def get_cached_entity(user_id: int, channel_id: int) -> Optional[Dict]:
+    """Obtiene el access_hash guardado de un canal para la sesión del usuario"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT channel_id, access_hash, title FROM entity_cache WHERE user_id = ? AND channel_id = ?",
+            (user_id, channel_id)
+        )
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+def save_cached_entities(user_id: int, entities: list) -> None:
+    """
+    Guarda canales resueltos para el usuario
+    
+    Args:
+        user_id: Telegram user ID
+        entities: Lista de tuplas (channel_id, access_hash, title)
+    """
+    if not entities:
+        return
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO entity_cache (user_id, channel_id, access_hash, title, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id, channel_id) DO UPDATE SET
+                access_hash = excluded.access_hash,
+                title = excluded.title,
+                updated_at = CURRENT_TIMESTAMP
+        """, [(user_id, channel_id, access_hash, title) for channel_id, access_hash, title in entities])
+
+def delete_cached_entity(user_id: int, channel_id: int) -> None:
+    """Invalida un canal cacheado (ej. ChannelPrivateError: el usuario perdió acceso)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM entity_cache WHERE user_id = ? AND channel_id = ?",
+            (user_id, channel_id)
+        )
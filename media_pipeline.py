@@ -0,0 +1,1733 @@
+#!/usr/bin/env python3
+"""
+Media pipeline helpers para el bot de descargas
+
+Piezas reutilizables del flujo descarga -> envío (caché de file_id, etc.)
+que usa bot_with_paywall.py. Las importaciones de Telethon se hacen dentro
+de las funciones, igual que en el módulo del bot.
+"""
+
+import os
+import re
+import time
+import zlib
+import asyncio
+import itertools
+import logging
+import random
+import shutil
+import uuid
+import weakref
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from typing import Optional, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# ==================== ENLACES ====================
+
+def parse_telegram_link(url: str) -> tuple[str, int | None] | None:
+    """Extrae identificador del canal y message_id (puede ser None)"""
+    url = url.strip()
+    
+    # Enlaces con hash de invitación: t.me/+HASH o t.me/+HASH/123
+    match = re.search(r't\.me/\+([^/]+)(?:/(\d+))?', url)
+    if match:
+        return f"+{match.group(1)}", int(match.group(2)) if match.group(2) else None
+    
+    # Enlaces privados numéricos: t.me/c/123456789 o t.me/c/123456789/123
+    match = re.search(r't\.me/c/(\d+)(?:/(\d+))?', url)
+    if match:
+        return match.group(1), int(match.group(2)) if match.group(2) else None
+    
+    # Canales públicos: t.me/username o t.me/username/123
+    match = re.search(r't\.me/([^/\s]+)(?:/(\d+))?', url)
+    if match and match.group(1) not in ['joinchat', 'c', '+']:
+        return match.group(1), int(match.group(2)) if match.group(2) else None
+    
+    return None
+
+
+def normalize_telegram_link(url: str) -> tuple[str, int | None] | None:
+    """
+    (canal, message_id) canónicos de un enlace para deduplicar la cola: los
+    usernames públicos no distinguen mayúsculas ni el '@'; los hash de
+    invitación sí, y los ids numéricos se quedan igual.
+    """
+    parsed = parse_telegram_link(url or '')
+    if not parsed:
+        return None
+    channel, message_id = parsed
+    channel = channel.split('?')[0]
+    if not channel.startswith('+') and not channel.isdigit():
+        channel = channel.lstrip('@').lower()
+    return channel, message_id
+
+
+# ==================== CACHÉ DE FILE_ID ====================
+
+# media_kind -> (método del Bot API, nombre del parámetro)
+BOT_SEND_METHODS = {
+    'photo': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'animation': ('send_animation', 'animation'),
+    'audio': ('send_audio', 'audio'),
+    'voice': ('send_voice', 'voice'),
+    'document': ('send_document', 'document'),
+}
+
+
+def media_cache_keys(message) -> List[str]:
+    """
+    Claves de caché para el media de un mensaje de Telethon.
+    Primero la del contenido (id de documento/foto, igual en reenvíos),
+    luego la del post original (canal + message_id).
+    """
+    keys = []
+    document = getattr(message, 'document', None)
+    photo = getattr(message, 'photo', None)
+    if document is not None and getattr(document, 'id', None):
+        keys.append(f"doc:{document.id}")
+    elif photo is not None and getattr(photo, 'id', None):
+        keys.append(f"photo:{photo.id}")
+
+    chat_id = getattr(message, 'chat_id', None)
+    msg_id = getattr(message, 'id', None)
+    if chat_id is not None and msg_id is not None:
+        keys.append(f"msg:{chat_id}:{msg_id}")
+    return keys
+
+
+def extract_sent_file_id(sent) -> Optional[Tuple[str, str]]:
+    """
+    Obtiene (file_id, media_kind) de un mensaje enviado por el bot.
+    Soporta mensajes de PTB y de Telethon (bot_client).
+    """
+    if sent is None:
+        return None
+
+    # Mensaje de python-telegram-bot
+    if hasattr(sent, 'effective_attachment'):
+        if sent.photo:
+            return sent.photo[-1].file_id, 'photo'
+        # animation va antes que document: PTB rellena ambos para GIFs
+        for kind in ('animation', 'video', 'audio', 'voice', 'document'):
+            media = getattr(sent, kind, None)
+            if media:
+                return media.file_id, kind
+        return None
+
+    # Mensaje de Telethon
+    from telethon import utils
+    media = getattr(sent, 'photo', None) or getattr(sent, 'document', None)
+    if media is None:
+        return None
+    file_id = utils.pack_bot_file_id(media)
+    if not file_id:
+        return None
+
+    if getattr(sent, 'photo', None):
+        kind = 'photo'
+    elif getattr(sent, 'gif', None):
+        kind = 'animation'
+    elif getattr(sent, 'video', None):
+        kind = 'video'
+    elif getattr(sent, 'voice', None):
+        kind = 'voice'
+    elif getattr(sent, 'audio', None):
+        kind = 'audio'
+    else:
+        kind = 'document'
+    return file_id, kind
+
+
+# ==================== STREAMING DESCARGA -> SUBIDA ====================
+
+class ChunkPipe:
+    """
+    Tubería en memoria entre la descarga por chunks (Telethon del usuario) y
+    la subida MTProto del bot. Expone un read() asíncrono que upload_file de
+    Telethon acepta como archivo, así la subida avanza a la vez que la descarga
+    sin escribir nada a disco. El buffer está acotado (backpressure).
+    Con StallGuard por extremo, el tiempo que uno espera al otro no cuenta
+    como atasco propio.
+    """
+
+    def __init__(self, size: int, name: str = None, max_buffered: int = 8 * 1024 * 1024,
+                 writer_guard=None, reader_guard=None):
+        self.size = size
+        self.name = name
+        self.max_buffered = max_buffered
+        self.writer_guard = writer_guard
+        self.reader_guard = reader_guard
+        self._buffer = bytearray()
+        self._eof = False
+        self._error = None
+        self._wanted = 0
+        self._cond = asyncio.Condition()
+
+    async def write(self, chunk: bytes):
+        """Añade un chunk descargado; espera si el consumidor va por detrás"""
+        async with self._cond:
+            # Nunca bloquear por debajo de lo que pide el lector (evita interbloqueo)
+            with self.writer_guard.waiting() if self.writer_guard else nullcontext():
+                await self._cond.wait_for(
+                    lambda: len(self._buffer) < max(self.max_buffered, self._wanted)
+                    or self._error is not None
+                )
+            if self._error is not None:
+                raise self._error
+            self._buffer.extend(chunk)
+            self._cond.notify_all()
+
+    async def close(self, error: Exception = None):
+        """Marca el fin de la descarga (o un error que se propagará al lector)"""
+        async with self._cond:
+            self._eof = True
+            if error is not None and self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+    async def read(self, n: int = -1) -> bytes:
+        """Devuelve exactamente n bytes (menos solo al final del stream)"""
+        async with self._cond:
+            self._wanted = n if n >= 0 else 0
+            self._cond.notify_all()
+            with self.reader_guard.waiting() if self.reader_guard else nullcontext():
+                await self._cond.wait_for(
+                    lambda: self._error is not None or self._eof
+                    or (n >= 0 and len(self._buffer) >= n)
+                )
+            self._wanted = 0
+            if self._error is not None:
+                raise self._error
+            if n < 0 or n > len(self._buffer):
+                n = len(self._buffer)
+            data = bytes(self._buffer[:n])
+            del self._buffer[:n]
+            self._cond.notify_all()
+            return data
+
+
+# ==================== DESCARGA PARALELA POR PARTES ====================
+
+DOWNLOAD_PART_SIZE = 512 * 1024  # Máximo permitido por upload.getFile
+# FloodWait que una descarga espera sin soltar su hueco ni el sender; los más
+# largos se propagan para que el trabajo se aplace (run_respecting_flood o la cola)
+FLOOD_INLINE_MAX = 10
+
+
+def classify_size(file_size: int) -> str:
+    """Clase de tamaño usada para elegir conexiones (y luego carriles/rutas)"""
+    if file_size <= 20 * 1024 * 1024:
+        return 'small'
+    if file_size <= 200 * 1024 * 1024:
+        return 'medium'
+    return 'large'
+
+
+class ExportedSenderCache:
+    """
+    Senders exportados (media en un DC distinto del de la sesión) por cliente
+    de usuario y DC. Telethon exporta la autorización y abre un sender nuevo
+    cuando el último préstamo se devuelve y caduca; aquí se mantiene un
+    préstamo por (cliente, DC) vivo entre peticiones hasta `idle_timeout` sin
+    uso. Cuenta también los accesos por DC y qué canales obligan a salir del
+    DC de origen.
+    """
+
+    def __init__(self, idle_timeout: float = 600):
+        self.idle_timeout = idle_timeout
+        self._entries = {}
+        self._locks = weakref.WeakValueDictionary()
+        self._dc_hits = {}
+        self._foreign_sources = Counter()
+
+    def _count(self, dc_id: int, field: str):
+        hits = self._dc_hits.setdefault(dc_id, {'home': 0, 'foreign': 0, 'exports': 0})
+        hits[field] += 1
+
+    def note_home(self, dc_id: int):
+        """Descarga servida por el DC de origen de la sesión"""
+        self._count(dc_id, 'home')
+
+    async def acquire(self, client, dc_id: int, source=None):
+        """Sender exportado del DC para este cliente (lo reutiliza si sigue conectado)"""
+        key = (client, dc_id)
+        self._count(dc_id, 'foreign')
+        if source is not None:
+            self._foreign_sources[source] += 1
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        async with lock:
+            entry = self._entries.get(key)
+            if entry and not entry['sender'].is_connected():
+                await self._drop(key)
+                entry = None
+            if entry is None:
+                sender = await client._borrow_exported_sender(dc_id)
+                self._count(dc_id, 'exports')
+                entry = {'sender': sender, 'in_use': 0, 'last_used': time.monotonic()}
+                self._entries[key] = entry
+            entry['in_use'] += 1
+            entry['last_used'] = time.monotonic()
+            return entry['sender']
+
+    def release(self, client, dc_id: int):
+        entry = self._entries.get((client, dc_id))
+        if entry:
+            entry['in_use'] = max(0, entry['in_use'] - 1)
+            entry['last_used'] = time.monotonic()
+
+    async def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            try:
+                await key[0]._return_exported_sender(entry['sender'])
+            except Exception as e:
+                logger.debug(f"Error devolviendo sender del DC {key[1]}: {e}")
+
+    async def evict_idle(self) -> int:
+        """Devuelve los senders sin uso durante idle_timeout o de clientes ya cerrados"""
+        now = time.monotonic()
+        stale = [
+            key for key, entry in self._entries.items()
+            if entry['in_use'] == 0 and (
+                now - entry['last_used'] > self.idle_timeout or not key[0].is_connected()
+            )
+        ]
+        for key in stale:
+            await self._drop(key)
+        return len(stale)
+
+    async def close_all(self):
+        for key in list(self._entries.keys()):
+            await self._drop(key)
+
+    def stats(self) -> dict:
+        return {
+            'open': len(self._entries),
+            'in_use': sum(1 for e in self._entries.values() if e['in_use']),
+            'dcs': {str(dc): dict(hits) for dc, hits in sorted(self._dc_hits.items())},
+            'top_foreign_sources': [
+                {'source': str(source), 'downloads': n} for source, n in self._foreign_sources.most_common(10)
+            ],
+        }
+
+
+class ParallelDownloader:
+    """
+    Descarga un documento con N peticiones upload.getFile concurrentes contra
+    el DC del archivo y entrega los chunks EN ORDEN (buffer de reensamblado
+    acotado a una ventana de partes). Ante un FloodWait pasa a modo secuencial
+    y, si dura más de `max_inline_flood` segundos, lo propaga.
+    """
+
+    def __init__(self, client, document, file_size: int, workers: int = 4,
+                 part_size: int = DOWNLOAD_PART_SIZE, throttle=None, on_flood=None,
+                 senders: Optional[ExportedSenderCache] = None, source=None,
+                 max_inline_flood: float = FLOOD_INLINE_MAX):
+        self.client = client
+        self.throttle = throttle  # async (n_bytes) -> None, presupuesto de ancho de banda
+        self.on_flood = on_flood  # (segundos) -> None, aviso de un FloodWait recibido
+        self.max_inline_flood = max_inline_flood
+        self.senders = senders  # caché de senders de otros DC (si no, los de Telethon)
+        self.source = source  # canal de origen, para las estadísticas por DC
+        self.document = document
+        self.file_size = file_size
+        self.workers = max(1, workers)
+        self.part_size = part_size
+        self.sequential = self.workers == 1
+        self._sender = None
+        self._sender_dc = None
+        self._exported = False
+
+    @property
+    def total_parts(self) -> int:
+        return (self.file_size + self.part_size - 1) // self.part_size
+
+    async def _get_sender(self, dc_id):
+        """Sender del DC del archivo (el principal o uno exportado)"""
+        if dc_id and self.client.session.dc_id != dc_id:
+            if self.senders is not None:
+                self._sender = await self.senders.acquire(self.client, dc_id, self.source)
+            else:
+                self._sender = await self.client._borrow_exported_sender(dc_id)
+            self._sender_dc = dc_id
+            self._exported = True
+        else:
+            if self.senders is not None:
+                self.senders.note_home(self.client.session.dc_id)
+            self._sender = self.client._sender
+            self._exported = False
+
+    async def _release_sender(self):
+        if self._exported and self._sender is not None:
+            if self.senders is not None:
+                self.senders.release(self.client, self._sender_dc)
+            else:
+                try:
+                    await self.client._return_exported_sender(self._sender)
+                except Exception as e:
+                    logger.debug(f"Error devolviendo sender exportado: {e}")
+        self._sender = None
+        self._sender_dc = None
+        self._exported = False
+
+    async def _fetch_part(self, location, index: int) -> bytes:
+        from telethon.tl.functions.upload import GetFileRequest
+        from telethon.errors import FileMigrateError, FloodWaitError
+
+        while True:
+            request = GetFileRequest(location, offset=index * self.part_size, limit=self.part_size)
+            try:
+                result = await self.client._call(self._sender, request)
+                return result.bytes
+            except FileMigrateError as e:
+                logger.info(f"Archivo en DC {e.new_dc}, cambiando de sender")
+                await self._release_sender()
+                await self._get_sender(e.new_dc)
+            except FloodWaitError as e:
+                if not self.sequential:
+                    logger.warning(f"FloodWait de {e.seconds}s en descarga paralela, pasando a modo secuencial")
+                    self.sequential = True
+                if self.on_flood is not None:
+                    self.on_flood(e.seconds)
+                if e.seconds > self.max_inline_flood:
+                    raise
+                await asyncio.sleep(e.seconds)
+
+    async def download(self, on_chunk, offset: int = 0):
+        """
+        Descarga desde `offset` (múltiplo de part_size) y llama a
+        `await on_chunk(data)` con cada parte en orden.
+        """
+        from telethon import utils
+
+        if offset % self.part_size:
+            raise ValueError("offset debe ser múltiplo del tamaño de parte")
+
+        dc_id, location = utils.get_input_location(self.document)
+        await self._get_sender(dc_id)
+
+        first = offset // self.part_size
+        total = self.total_parts
+        window = self.workers * 2
+        results = {}
+        state = {'next_fetch': first, 'next_yield': first, 'error': None}
+        cond = asyncio.Condition()
+
+        async def worker(worker_id: int):
+            try:
+                while True:
+                    async with cond:
+                        await cond.wait_for(
+                            lambda: state['next_fetch'] - state['next_yield'] < window
+                            or state['error'] is not None
+                        )
+                        # En modo secuencial solo sigue el primer worker
+                        if state['error'] is not None or (self.sequential and worker_id > 0):
+                            return
+                        index = state['next_fetch']
+                        if index >= total:
+                            return
+                        state['next_fetch'] += 1
+                    if self.throttle is not None:
+                        part_bytes = min(self.part_size, self.file_size - index * self.part_size)
+                        await self.throttle(part_bytes)
+                    data = await self._fetch_part(location, index)
+                    async with cond:
+                        results[index] = data
+                        cond.notify_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                async with cond:
+                    if state['error'] is None:
+                        state['error'] = e
+                    cond.notify_all()
+
+        tasks = [asyncio.create_task(worker(i)) for i in range(self.workers)]
+        try:
+            while state['next_yield'] < total:
+                async with cond:
+                    await cond.wait_for(
+                        lambda: state['next_yield'] in results or state['error'] is not None
+                    )
+                    if state['error'] is not None:
+                        raise state['error']
+                    data = results.pop(state['next_yield'])
+                    state['next_yield'] += 1
+                    cond.notify_all()
+                await on_chunk(data)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._release_sender()
+
+
+# ==================== DESCARGAS REANUDABLES ====================
+
+def chunk_checksum(data: bytes) -> int:
+    """Checksum por chunk guardado en el diario de descargas parciales"""
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def verify_partial_file(path: str, offset: int, part_size: int, checksums: list) -> bool:
+    """
+    Comprueba que el archivo parcial contiene los `offset` bytes del diario:
+    un checksum por chunk de part_size (el último puede ser más corto) y todos
+    coinciden. Lee el prefijo entero en secuencia, así que se llama fuera del
+    bucle de eventos.
+    """
+    if offset <= 0 or not checksums or not os.path.exists(path):
+        return False
+    if os.path.getsize(path) < offset or len(checksums) != -(-offset // part_size):
+        return False
+    with open(path, 'rb') as f:
+        for index, expected in enumerate(checksums):
+            data = f.read(min(part_size, offset - index * part_size))
+            if chunk_checksum(data) != expected:
+                return False
+    return True
+
+
+# ==================== ÁLBUMES (SEND_MEDIA_GROUP) ====================
+
+# media_kind -> familia que puede compartir un send_media_group
+# (fotos y videos se mezclan; audios y documentos solo entre sí)
+ALBUM_MEDIA_FAMILIES = {
+    'photo': 'visual',
+    'video': 'visual',
+    'audio': 'audio',
+    'document': 'document',
+}
+
+
+def plan_media_groups(items: list, max_items: int = 10, max_bytes: int = None) -> list:
+    """
+    Agrupa los ítems de un álbum (en su orden original) en lotes para
+    send_media_group. Cada ítem es un dict con 'family' (None = se envía solo)
+    y 'upload_size' (bytes a subir, 0 si va por file_id).
+    """
+    groups = []
+    current = []
+    current_family = None
+    current_bytes = 0
+
+    for item in items:
+        family = item.get('family')
+        size = item.get('upload_size', 0) or 0
+        if current and (
+            family != current_family
+            or len(current) >= max_items
+            or (max_bytes and current_bytes + size > max_bytes)
+        ):
+            groups.append(current)
+            current, current_family, current_bytes = [], None, 0
+        if family is None:
+            groups.append([item])
+            continue
+        current.append(item)
+        current_family = family
+        current_bytes += size
+
+    if current:
+        groups.append(current)
+    return groups
+
+
+# ==================== POOL DE CLIENTES DE USUARIO ====================
+
+class UserClientPool:
+    """
+    Pool LRU de clientes Telethon conectados por user_id. Evita el handshake
+    MTProto + get_me() en cada enlace: el cliente queda conectado entre
+    peticiones, se valida como mucho cada `health_ttl` segundos y se cierra
+    tras `idle_timeout` sin uso o al superar `max_open`.
+    """
+
+    def __init__(self, factory, max_open: int = 100, idle_timeout: float = 900,
+                 health_ttl: float = 600):
+        self._factory = factory  # session_string -> TelegramClient sin conectar
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.health_ttl = health_ttl
+        self._entries = OrderedDict()
+        self._locks = weakref.WeakValueDictionary()
+
+    def _lock_for(self, user_id: int) -> asyncio.Lock:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[user_id] = lock
+        return lock
+
+    async def acquire(self, user_id: int, session_string: str):
+        """
+        Devuelve un cliente conectado para el usuario. Propaga los errores de
+        autorización de get_me() (sesión inválida) tras descartar el cliente.
+        """
+        async with self._lock_for(user_id):
+            entry = self._entries.get(user_id)
+            if entry and (entry['session'] != session_string or not entry['client'].is_connected()):
+                await self._close(user_id)
+                entry = None
+
+            if entry is None:
+                client = self._factory(session_string)
+                await client.connect()
+                entry = {
+                    'client': client, 'session': session_string,
+                    'in_use': 0, 'last_used': time.monotonic(), 'last_validated': 0.0,
+                }
+                self._entries[user_id] = entry
+                await self._evict_over_limit()
+
+            now = time.monotonic()
+            if now - entry['last_validated'] > self.health_ttl:
+                try:
+                    await entry['client'].get_me()
+                except Exception:
+                    await self._close(user_id)
+                    raise
+                entry['last_validated'] = now
+
+            entry['in_use'] += 1
+            entry['last_used'] = now
+            self._entries.move_to_end(user_id)
+            return entry['client']
+
+    def release(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry:
+            entry['in_use'] = max(0, entry['in_use'] - 1)
+            entry['last_used'] = time.monotonic()
+
+    async def discard(self, user_id: int):
+        """Cierra y elimina el cliente del usuario (logout, sesión inválida)"""
+        async with self._lock_for(user_id):
+            await self._close(user_id)
+
+    async def _close(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry:
+            try:
+                await entry['client'].disconnect()
+            except Exception as e:
+                logger.debug(f"Error desconectando cliente de {user_id}: {e}")
+
+    async def _close_unused(self, user_id: int) -> bool:
+        """
+        Cierra el cliente si nadie lo usa. Uno cuyo lock está tomado se está
+        preparando (connect/get_me antes de contar el uso) y no se toca.
+        """
+        lock = self._locks.get(user_id)
+        if lock is not None and lock.locked():
+            return False
+        async with self._lock_for(user_id):
+            entry = self._entries.get(user_id)
+            if not entry or entry['in_use']:
+                return False
+            await self._close(user_id)
+            return True
+
+    async def _evict_over_limit(self):
+        """Cierra los clientes menos usados recientemente que no estén en uso"""
+        for user_id in list(self._entries.keys()):
+            if len(self._entries) <= self.max_open:
+                break
+            entry = self._entries.get(user_id)
+            if entry and entry['in_use'] == 0:
+                await self._close_unused(user_id)
+
+    async def evict_idle(self):
+        """
+        Cierra los clientes sin uso durante más de idle_timeout y, si el pool
+        quedó por encima de max_open (clientes que se preparaban al desalojar),
+        los menos usados que ya estén libres.
+        """
+        now = time.monotonic()
+        idle = [
+            user_id for user_id, entry in self._entries.items()
+            if entry['in_use'] == 0 and now - entry['last_used'] > self.idle_timeout
+        ]
+        closed = 0
+        for user_id in idle:
+            closed += await self._close_unused(user_id)
+        await self._evict_over_limit()
+        return closed
+
+    async def close_all(self):
+        for user_id in list(self._entries.keys()):
+            await self._close(user_id)
+
+    def stats(self) -> dict:
+        return {
+            'open': len(self._entries),
+            'in_use': sum(1 for e in self._entries.values() if e['in_use']),
+            'max_open': self.max_open,
+        }
+
+
+class BotSenderPool:
+    """
+    Varias conexiones MTProto autenticadas como el bot para repartir las
+    subidas grandes, que con un solo cliente van en serie por su conexión.
+    Cada subida va al emisor con menos bytes en vuelo. Un emisor desconectado
+    se deja de usar y se reconecta en segundo plano con backoff.
+    """
+
+    RECONNECT_BACKOFF = (1, 2, 5, 15, 30, 60)
+
+    def __init__(self, connect, size: int = 1):
+        self._connect = connect  # async index -> cliente conectado
+        self.size = max(1, int(size))
+        self._clients = [None] * self.size
+        self._bytes = [0] * self.size
+        self._active = [0] * self.size
+        self._uploads = [0] * self.size
+        self._failures = [0] * self.size
+        self._reconnecting = {}
+        self._closed = False
+
+    async def start(self) -> int:
+        """Abre los emisores; los que fallen se reintentan en segundo plano"""
+        async def open_sender(index):
+            try:
+                self._clients[index] = await self._connect(index)
+            except Exception as e:
+                logger.warning(f"Emisor del bot {index} no conectó: {e}")
+
+        await asyncio.gather(*(open_sender(i) for i in range(self.size)))
+        return self.connected
+
+    def _is_connected(self, index: int) -> bool:
+        client = self._clients[index]
+        return client is not None and client.is_connected()
+
+    @property
+    def connected(self) -> int:
+        return sum(1 for i in range(self.size) if self._is_connected(i))
+
+    @property
+    def available(self) -> bool:
+        return self.connected > 0
+
+    def _schedule_reconnect(self, index: int):
+        task = self._reconnecting.get(index)
+        if self._closed or (task is not None and not task.done()):
+            return
+        self._reconnecting[index] = asyncio.ensure_future(self._reconnect(index))
+
+    async def _reconnect(self, index: int):
+        for attempt in itertools.count():
+            if self._closed:
+                return
+            try:
+                client = self._clients[index]
+                if client is None:
+                    self._clients[index] = await self._connect(index)
+                else:
+                    await client.connect()
+                if self._is_connected(index):
+                    logger.info(f"🔌 Emisor del bot {index} reconectado")
+                    return
+            except Exception as e:
+                logger.warning(f"Reconexión del emisor del bot {index} falló: {e}")
+            await asyncio.sleep(self.RECONNECT_BACKOFF[min(attempt, len(self.RECONNECT_BACKOFF) - 1)])
+
+    @asynccontextmanager
+    async def sender(self, n_bytes: int = 0):
+        """Emisor conectado con menos carga; si falla por conexión, se reconecta"""
+        candidates = []
+        for index in range(self.size):
+            if self._is_connected(index):
+                candidates.append(index)
+            else:
+                self._schedule_reconnect(index)
+        if not candidates:
+            raise ConnectionError("No hay emisores del bot conectados")
+
+        index = min(candidates, key=lambda i: (self._bytes[i], self._active[i]))
+        self._bytes[index] += n_bytes
+        self._active[index] += 1
+        try:
+            yield self._clients[index]
+            self._uploads[index] += 1
+        except Exception:
+            self._failures[index] += 1
+            if not self._is_connected(index):
+                self._schedule_reconnect(index)
+            raise
+        finally:
+            self._bytes[index] -= n_bytes
+            self._active[index] -= 1
+
+    async def close_all(self):
+        self._closed = True
+        for task in self._reconnecting.values():
+            task.cancel()
+        for index, client in enumerate(self._clients):
+            if client is not None:
+                try:
+                    await client.disconnect()
+                except Exception as e:
+                    logger.debug(f"Error desconectando emisor del bot {index}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            'size': self.size,
+            'connected': self.connected,
+            'senders': [
+                {
+                    'connected': self._is_connected(i),
+                    'active': self._active[i],
+                    'mb_in_flight': round(self._bytes[i] / (1024 * 1024), 1),
+                    'uploads': self._uploads[i],
+                    'failures': self._failures[i],
+                }
+                for i in range(self.size)
+            ],
+        }
+
+
+# ==================== SINGLE-FLIGHT ====================
+
+class SingleFlight:
+    """
+    Deduplica trabajo concurrente idéntico dentro del proceso: la primera
+    llamada con una clave ejecuta la función y las siguientes esperan su
+    resultado. Si el líder falla o se cancela, los que esperan reciben None
+    (nunca la excepción) y deciden si reintentar por su cuenta.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self._inflight
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def run(self, key, fn):
+        """Devuelve (resultado, compartido). compartido=True si otro hizo el trabajo."""
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        result = None
+        try:
+            result = await fn()
+            return result, False
+        finally:
+            self._inflight.pop(key, None)
+            if not future.done():
+                future.set_result(result)
+
+
+# ==================== PLANIFICADOR JUSTO ====================
+
+class FairScheduler:
+    """
+    Reparte un número fijo de slots de descarga entre usuarios con colas
+    justas ponderadas (start-time fair queuing sobre tiempo virtual).
+
+    Cada petición recibe una etiqueta de inicio = max(tiempo virtual, fin de
+    la petición anterior del usuario); el fin avanza 1/peso. Se despacha la
+    menor etiqueta cuyo usuario no haya alcanzado su límite en vuelo, así que
+    un álbum de 50 ítems no bloquea a los demás y el peso (nivel premium)
+    decide cuánto servicio relativo recibe cada usuario.
+    """
+
+    def __init__(self, capacity: int, name: str = 'downloads'):
+        self.capacity = max(1, int(capacity))
+        self.name = name
+        self._active = 0
+        self._inflight = {}
+        self._finish = {}
+        self._vtime = 0.0
+        self._waiting = []
+        self._seq = itertools.count()
+        self.granted = 0
+        self.total_wait = 0.0
+
+    def _eligible(self, entry) -> bool:
+        return self._inflight.get(entry['user_id'], 0) < entry['limit']
+
+    def _ordered_waiting(self) -> list:
+        return sorted(self._waiting, key=lambda e: (e['start'], e['seq']))
+
+    def _dispatch(self):
+        while self._active < self.capacity:
+            entry = next((e for e in self._ordered_waiting() if self._eligible(e)), None)
+            if entry is None:
+                return
+            self._waiting.remove(entry)
+            if entry['future'].done():
+                continue
+            self._active += 1
+            self._inflight[entry['user_id']] = self._inflight.get(entry['user_id'], 0) + 1
+            self._vtime = max(self._vtime, entry['start'])
+            self.granted += 1
+            self.total_wait += time.monotonic() - entry['queued_at']
+            entry['future'].set_result(True)
+
+    def _release(self, user_id):
+        self._active -= 1
+        remaining = self._inflight.get(user_id, 0) - 1
+        if remaining > 0:
+            self._inflight[user_id] = remaining
+        else:
+            self._inflight.pop(user_id, None)
+            waiting = any(e['user_id'] == user_id for e in self._waiting)
+            if not waiting and self._finish.get(user_id, 0.0) <= self._vtime:
+                self._finish.pop(user_id, None)
+        self._dispatch()
+
+    def position(self, user_id) -> int:
+        """Posición (1-based) de la primera petición en cola del usuario; 0 si no espera"""
+        for index, entry in enumerate(self._ordered_waiting(), start=1):
+            if entry['user_id'] == user_id:
+                return index
+        return 0
+
+    async def acquire(self, user_id, weight: float = 1.0, limit: int = 1, on_queued=None):
+        """Espera un slot. on_queued(posición) se llama (async) si hay que esperar."""
+        start = max(self._vtime, self._finish.get(user_id, 0.0))
+        self._finish[user_id] = start + 1.0 / max(weight, 0.001)
+        entry = {
+            'user_id': user_id, 'limit': max(1, int(limit)), 'start': start,
+            'seq': next(self._seq), 'queued_at': time.monotonic(),
+            'future': asyncio.get_running_loop().create_future(),
+        }
+        self._waiting.append(entry)
+        self._dispatch()
+
+        future = entry['future']
+        try:
+            if not future.done() and on_queued is not None:
+                try:
+                    await on_queued(self.position(user_id))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.debug(f"on_queued falló en {self.name}: {e}")
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self._release(user_id)
+            else:
+                future.cancel()
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    self._dispatch()
+            raise
+
+    def release(self, user_id):
+        self._release(user_id)
+
+    @asynccontextmanager
+    async def slot(self, user_id, weight: float = 1.0, limit: int = 1, on_queued=None):
+        await self.acquire(user_id, weight=weight, limit=limit, on_queued=on_queued)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    def stats(self) -> dict:
+        return {
+            'capacity': self.capacity,
+            'active': self._active,
+            'waiting': len(self._waiting),
+            'users_active': len(self._inflight),
+            'granted': self.granted,
+            'avg_wait_seconds': round(self.total_wait / self.granted, 2) if self.granted else 0.0,
+        }
+
+
+# ==================== CARRILES Y ANCHO DE BANDA ====================
+
+DOWNLOAD_LANE_NAMES = ('photo', 'medium', 'large')
+
+
+def choose_lane(file_size: int, is_photo: bool = False) -> str:
+    """
+    Carril de ejecución de una transferencia, decidido antes de mover bytes:
+    fotos (en memoria), archivos pequeños/medianos y archivos grandes.
+    """
+    if is_photo:
+        return 'photo'
+    return 'large' if classify_size(file_size) == 'large' else 'medium'
+
+
+class TokenBucket:
+    """
+    Cubo de tokens en bytes/segundo. rate <= 0 significa sin límite.
+    consume() espera hasta que haya presupuesto; peticiones mayores que la
+    ráfaga se dejan pasar dejando el cubo en negativo (deuda), así nunca se
+    bloquean indefinidamente.
+    """
+
+    def __init__(self, rate: float = 0, burst: Optional[float] = None):
+        self._lock = asyncio.Lock()
+        self._updated = time.monotonic()
+        self.rate = rate
+        self.burst = burst
+        self._tokens = self.capacity
+        self.consumed = 0
+
+    @property
+    def capacity(self) -> float:
+        if self.burst:
+            return float(self.burst)
+        return max(float(self.rate), float(DOWNLOAD_PART_SIZE))
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def consume(self, n: int):
+        self.consumed += n
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            self._refill()
+            if self._tokens < min(n, self.capacity):
+                await asyncio.sleep((min(n, self.capacity) - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= n
+
+
+def progress_throttle(consume):
+    """
+    Adapta un consume(n_bytes) a progress_callback de Telethon (current, total),
+    que Telethon espera si es una corrutina.
+    """
+    state = {'last': 0}
+
+    async def callback(current, total):
+        delta = current - state['last']
+        state['last'] = current
+        if delta > 0:
+            await consume(delta)
+
+    return callback
+
+
+class BandwidthGovernor:
+    """
+    Presupuesto global de ancho de banda compartido por todas las rutas de
+    transferencia: un cubo de entrada (descargas) y otro de salida (subidas).
+    Cada carril tiene además su propio cubo con tope = cuota * presupuesto
+    global (o su límite absoluto en MB/s, el menor), así un carril no puede
+    acaparar el enlace y los demás siguen avanzando. Todo es reconfigurable
+    en caliente con configure(); 0 significa sin límite.
+    """
+
+    DEFAULT_SHARES = {'photo': 1.0, 'medium': 0.7, 'large': 0.5}
+
+    def __init__(self, ingress_mbps: float = 0, egress_mbps: float = 0,
+                 lane_shares: Optional[dict] = None, lane_mbps: Optional[dict] = None):
+        self._global = {'ingress': TokenBucket(), 'egress': TokenBucket()}
+        self._lanes = {
+            direction: {lane: TokenBucket() for lane in DOWNLOAD_LANE_NAMES}
+            for direction in ('ingress', 'egress')
+        }
+        self.ingress_mbps = 0.0
+        self.egress_mbps = 0.0
+        self.lane_shares = dict(self.DEFAULT_SHARES)
+        self.lane_mbps = {lane: 0.0 for lane in DOWNLOAD_LANE_NAMES}
+        self.configure(ingress_mbps, egress_mbps, lane_shares, lane_mbps)
+
+    def configure(self, ingress_mbps: Optional[float] = None, egress_mbps: Optional[float] = None,
+                  lane_shares: Optional[dict] = None, lane_mbps: Optional[dict] = None):
+        """Aplica nuevos presupuestos (MB/s). Los parámetros None no cambian."""
+        if ingress_mbps is not None:
+            self.ingress_mbps = max(0.0, float(ingress_mbps))
+        if egress_mbps is not None:
+            self.egress_mbps = max(0.0, float(egress_mbps))
+        for lane, share in (lane_shares or {}).items():
+            if lane in self.lane_shares:
+                self.lane_shares[lane] = min(1.0, max(0.05, float(share)))
+        for lane, mbps in (lane_mbps or {}).items():
+            if lane in self.lane_mbps:
+                self.lane_mbps[lane] = max(0.0, float(mbps))
+
+        for direction, total in (('ingress', self.ingress_mbps), ('egress', self.egress_mbps)):
+            self._global[direction].rate = total * 1024 * 1024
+            for lane, bucket in self._lanes[direction].items():
+                limits = []
+                if total:
+                    limits.append(total * self.lane_shares[lane])
+                if direction == 'ingress' and self.lane_mbps[lane]:
+                    limits.append(self.lane_mbps[lane])
+                bucket.rate = min(limits) * 1024 * 1024 if limits else 0
+
+    def _throttle(self, direction: str, lane: str):
+        lane_bucket = self._lanes[direction].get(lane) or self._lanes[direction]['medium']
+        global_bucket = self._global[direction]
+
+        async def consume(n: int):
+            await lane_bucket.consume(n)
+            await global_bucket.consume(n)
+
+        return consume
+
+    def ingress(self, lane: str):
+        """Throttle async (n_bytes) para descargas del carril"""
+        return self._throttle('ingress', lane)
+
+    def egress(self, lane: str):
+        """Throttle async (n_bytes) para subidas del carril"""
+        return self._throttle('egress', lane)
+
+    def snapshot(self) -> dict:
+        return {
+            'ingress_mbps': self.ingress_mbps,
+            'egress_mbps': self.egress_mbps,
+            'lane_shares': dict(self.lane_shares),
+            'lane_mbps': dict(self.lane_mbps),
+            'bytes': {
+                direction: {lane: bucket.consumed for lane, bucket in lanes.items()}
+                for direction, lanes in self._lanes.items()
+            },
+        }
+
+
+# ==================== FLOODWAIT Y MÉTRICAS ====================
+
+def flood_wait_seconds(error) -> Optional[int]:
+    """
+    Segundos de espera si el error es un límite de Telegram: FloodWaitError de
+    Telethon (.seconds) o RetryAfter de PTB (.retry_after). None si no lo es.
+    """
+    if 'FloodWait' in type(error).__name__ or 'FloodPremiumWait' in type(error).__name__:
+        return int(getattr(error, 'seconds', 0) or 0)
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        if hasattr(retry_after, 'total_seconds'):
+            return int(retry_after.total_seconds())
+        return int(retry_after)
+    return None
+
+
+class FloodRegistry:
+    """
+    Ventanas de FloodWait activas por clave: una por sesión de usuario
+    ('user:<id>') y una por ruta del bot ('bot:ptb', 'bot:mtproto').
+    Permite aplazar trabajo dirigido a una sesión limitada y esquivar rutas
+    del bot limitadas en lugar de insistir contra ellas.
+    """
+
+    def __init__(self):
+        self._deadlines = {}
+        self._events = {}
+
+    def record(self, key: str, seconds: float) -> float:
+        """Registra una ventana (se queda con la más larga). Devuelve los segundos restantes."""
+        deadline = time.monotonic() + max(0.0, float(seconds))
+        if deadline > self._deadlines.get(key, 0.0):
+            self._deadlines[key] = deadline
+        kind = key.split(':', 1)[0]
+        self._events[kind] = self._events.get(kind, 0) + 1
+        logger.warning(f"🌊 FloodWait de {seconds}s registrado para {key}")
+        return self.remaining(key)
+
+    def remaining(self, key: str) -> float:
+        deadline = self._deadlines.get(key)
+        if deadline is None:
+            return 0.0
+        left = deadline - time.monotonic()
+        if left <= 0:
+            del self._deadlines[key]
+            return 0.0
+        return left
+
+    def is_flooded(self, key: str) -> bool:
+        return self.remaining(key) > 0
+
+    def snapshot(self) -> dict:
+        active = {}
+        for key in list(self._deadlines):
+            left = self.remaining(key)
+            if left:
+                active[key] = round(left, 1)
+        return {'active': active, 'events': dict(self._events)}
+
+
+class MetricsRegistry:
+    """Proveedores de métricas del pipeline (callables sin argumentos que devuelven un dict)"""
+
+    def __init__(self):
+        self._providers = {}
+
+    def register(self, name: str, provider):
+        self._providers[name] = provider
+
+    def collect(self) -> dict:
+        metrics = {'generated_at': time.time()}
+        for name, provider in self._providers.items():
+            try:
+                metrics[name] = provider()
+            except Exception as e:
+                metrics[name] = {'error': str(e)}
+        return metrics
+
+
+# ==================== THROUGHPUT Y DETECCIÓN DE ATASCOS ====================
+
+def media_dc_id(message) -> Optional[int]:
+    """DC donde está almacenado el media del mensaje (documento o foto)"""
+    media = getattr(message, 'media', None)
+    for attr in ('document', 'photo'):
+        obj = getattr(media, attr, None)
+        if obj is not None and getattr(obj, 'dc_id', None):
+            return obj.dc_id
+    return None
+
+
+class ThroughputEstimator:
+    """
+    Media móvil exponencial (EWMA) de bytes/segundo por clave: 'dc<N>' para
+    descargas y 'upload:<ruta>' para subidas. Muestras muy pequeñas se
+    ignoran porque solo miden latencia.
+    """
+
+    MIN_SAMPLE_BYTES = 256 * 1024
+    MIN_SAMPLE_SECONDS = 0.5
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self._rates = {}
+        self._samples = {}
+
+    def observe(self, key: str, n_bytes: int, seconds: float):
+        if n_bytes < self.MIN_SAMPLE_BYTES or seconds < self.MIN_SAMPLE_SECONDS:
+            return
+        rate = n_bytes / seconds
+        previous = self._rates.get(key)
+        self._rates[key] = rate if previous is None else self.alpha * rate + (1 - self.alpha) * previous
+        self._samples[key] = self._samples.get(key, 0) + 1
+
+    def estimate(self, key: str, default: Optional[float] = None) -> Optional[float]:
+        return self._rates.get(key, default)
+
+    def snapshot(self) -> dict:
+        return {
+            key: {'mbps': round(rate / (1024 * 1024), 2), 'samples': self._samples.get(key, 0)}
+            for key, rate in self._rates.items()
+        }
+
+
+class TransferStalled(asyncio.TimeoutError):
+    """La transferencia dejó de progresar (se trata como un timeout)"""
+
+
+class StallGuard:
+    """
+    Vigila una transferencia por progreso y no por reloj: se cancela si pasan
+    `stall_after` segundos sin recibir bytes, pero una transferencia lenta
+    que sigue avanzando puede durar lo que necesite. extend() concede una
+    tregua explícita (p. ej. durante un FloodWait que se está respetando).
+    """
+
+    def __init__(self, stall_after: float, name: str = 'transfer', on_progress=None):
+        self.stall_after = stall_after
+        self.name = name
+        self.on_progress = on_progress  # (n_bytes) -> None, p. ej. TransferProgress.add
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._last_progress = self.started
+        self._grace_until = 0.0
+        self._waiting = 0
+
+    def progress(self, n_bytes: int):
+        if n_bytes > 0:
+            self.bytes += n_bytes
+            self._last_progress = time.monotonic()
+            if self.on_progress is not None:
+                self.on_progress(n_bytes)
+
+    def extend(self, seconds: float):
+        self._grace_until = max(self._grace_until, time.monotonic() + seconds)
+
+    @contextmanager
+    def waiting(self):
+        """Tramo en el que la etapa espera a otra (backpressure): no es un atasco suyo"""
+        self._waiting += 1
+        try:
+            yield
+        finally:
+            self._waiting -= 1
+            self._last_progress = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def stalled(self) -> bool:
+        if self._waiting:
+            return False
+        now = time.monotonic()
+        return now > self._grace_until and now - self._last_progress > self.stall_after
+
+    def stall_reason(self) -> str:
+        return (
+            f"{self.name}: sin progreso durante {self.stall_after:.0f}s "
+            f"({self.bytes / (1024 * 1024):.1f} MB transferidos)"
+        )
+
+    async def run(self, coro):
+        """Espera `coro`; si se atasca la cancela y lanza TransferStalled"""
+        task = asyncio.ensure_future(coro)
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=1.0)
+                if done:
+                    return task.result()
+                if self.stalled():
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    raise TransferStalled(self.stall_reason())
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+
+class StallGuardGroup(StallGuard):
+    """
+    Vigila a la vez las etapas de una transferencia encadenada (descarga y
+    subida en streaming), cada una con su StallGuard y su umbral: se abandona
+    en cuanto una deja de avanzar, sin esperar a que el atasco llegue a la otra.
+    """
+
+    def __init__(self, *legs: StallGuard, name: str = 'pipeline'):
+        super().__init__(min(leg.stall_after for leg in legs), name=name)
+        self.legs = legs
+        self.stalled_leg = None
+
+    def extend(self, seconds: float):
+        for leg in self.legs:
+            leg.extend(seconds)
+
+    def stalled(self) -> bool:
+        for leg in self.legs:
+            if leg.stalled():
+                self.stalled_leg = leg
+                return True
+        return False
+
+    def stall_reason(self) -> str:
+        if self.stalled_leg is not None:
+            return f"{self.name}, {self.stalled_leg.stall_reason()}"
+        return super().stall_reason()
+
+
+# ==================== SELECCIÓN DE RUTA DE SUBIDA ====================
+
+UPLOAD_PATHS = ('mtproto', 'ptb')
+
+
+class UploadPathSelector:
+    """
+    Elige la ruta de subida (bot_client MTProto o Bot API vía PTB) antes de
+    enviar, con estadísticas por (ruta, clase de tamaño, tipo de contenido):
+    tasa de éxito (con prior de Laplace) x throughput EWMA. Los priors
+    reproducen la cascada anterior (MTProto para vídeos y archivos > 50 MB)
+    hasta que hay datos reales.
+    """
+
+    PRIOR_MBPS = {
+        'mtproto': {'small': 4.0, 'medium': 6.0, 'large': 8.0},
+        'ptb': {'small': 5.0, 'medium': 3.0, 'large': 1.0},
+    }
+    VIDEO_PTB_PENALTY = 0.6  # PTB pierde metadatos de streaming en vídeos grandes
+
+    def __init__(self, alpha: float = 0.3, explore: float = 0.05):
+        self.alpha = alpha
+        self.explore = explore
+        self._stats = {}
+
+    def _entry(self, path: str, size_class: str, content_type: str) -> dict:
+        key = (path, size_class, content_type)
+        if key not in self._stats:
+            self._stats[key] = {'attempts': 0, 'successes': 0, 'rate': None}
+        return self._stats[key]
+
+    def score(self, path: str, size_class: str, content_type: str) -> float:
+        entry = self._stats.get((path, size_class, content_type)) or {'attempts': 0, 'successes': 0, 'rate': None}
+        success = (entry['successes'] + 1) / (entry['attempts'] + 2)
+        rate = entry['rate'] or self.PRIOR_MBPS[path][size_class] * 1024 * 1024
+        if path == 'ptb' and content_type == 'video' and entry['rate'] is None:
+            rate *= self.VIDEO_PTB_PENALTY
+        return success * rate
+
+    def order(self, file_size: int, content_type: str, available) -> list:
+        """Rutas disponibles de mejor a peor para este archivo"""
+        size_class = classify_size(file_size)
+        paths = sorted(available, key=lambda p: self.score(p, size_class, content_type), reverse=True)
+        # Explorar de vez en cuando solo con archivos pequeños (equivocarse es barato)
+        if len(paths) > 1 and size_class == 'small' and random.random() < self.explore:
+            paths.reverse()
+        return paths
+
+    def record(self, path: str, file_size: int, content_type: str, ok: bool,
+               seconds: float = 0.0):
+        entry = self._entry(path, classify_size(file_size), content_type)
+        entry['attempts'] += 1
+        if ok:
+            entry['successes'] += 1
+            if file_size >= ThroughputEstimator.MIN_SAMPLE_BYTES and seconds > 0:
+                rate = file_size / seconds
+                entry['rate'] = rate if entry['rate'] is None else (
+                    self.alpha * rate + (1 - self.alpha) * entry['rate']
+                )
+
+    def snapshot(self) -> dict:
+        return {
+            f"{path}/{size_class}/{content_type}": {
+                'attempts': entry['attempts'],
+                'success_rate': round(entry['successes'] / entry['attempts'], 3) if entry['attempts'] else None,
+                'mbps': round(entry['rate'] / (1024 * 1024), 2) if entry['rate'] else None,
+            }
+            for (path, size_class, content_type), entry in self._stats.items()
+        }
+
+
+# ==================== SPOOL DE ARCHIVOS TEMPORALES ====================
+
+class SpoolFullError(OSError):
+    """El archivo no cabe en el disco del spool ni esperando a que se libere"""
+
+
+class SpoolManager:
+    """
+    Directorio gestionado para los archivos temporales del pipeline.
+    Cada trabajo reserva su file_size contra una cuota antes de empezar y
+    espera si no hay espacio (en vez de llenar el disco y romper todo).
+    Los archivos que sobreviven a su trabajo (descargas parciales para
+    reanudar) se registran con retain(): cuentan contra la misma cuota y son
+    lo primero que se desaloja, del más antiguo al más nuevo, cuando un
+    trabajo nuevo no cabe. sweep() borra huérfanos que dejó un crash.
+    """
+
+    def __init__(self, directory: str, quota_bytes: int, min_free_bytes: int = 0, on_evict=None):
+        self.directory = directory
+        self.quota = quota_bytes
+        self.min_free = min_free_bytes
+        self.on_evict = on_evict  # (path) -> None, limpieza extra al desalojar un retenido
+        self._reserved = 0
+        self._active = {}
+        self._retained = OrderedDict()
+        self._retained_bytes = 0
+        self._waiting = 0
+        self._cond = None
+        self.swept_files = 0
+        self.swept_bytes = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _condition(self) -> asyncio.Condition:
+        # Se crea al primer uso para quedar ligada al event loop del bot
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    def _disk_free(self) -> int:
+        return shutil.disk_usage(self.directory).free
+
+    def _fits(self, n_bytes: int) -> bool:
+        if self._reserved == 0 and not self._retained:
+            return True  # Solo: basta con el disco (comprobado en acquire)
+        return (self._reserved + self._retained_bytes + n_bytes <= self.quota
+                and self._disk_free() - self._reserved - self.min_free >= n_bytes)
+
+    def _make_room(self, n_bytes: int) -> bool:
+        """Desaloja retenidos (los más antiguos primero) hasta que n_bytes quepa"""
+        while not self._fits(n_bytes) and self._retained:
+            path, size = self._retained.popitem(last=False)
+            self._retained_bytes -= size
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                logger.warning(f"No se pudo desalojar {path} del spool: {e}")
+            self.evicted_files += 1
+            self.evicted_bytes += size
+            logger.info(f"💽 Spool: desalojado {path} ({size / (1024*1024):.1f} MB) para hacer sitio")
+            if self.on_evict is not None:
+                try:
+                    self.on_evict(path)
+                except Exception as e:
+                    logger.warning(f"Error limpiando {path} desalojado: {e}")
+        return self._fits(n_bytes)
+
+    def retain(self, path: str):
+        """Registra un archivo que se queda en disco sin trabajo activo (p. ej. un parcial)"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            self.forget(path)
+            return
+        self._retained_bytes += size - self._retained.pop(path, 0)
+        self._retained[path] = size
+
+    def forget(self, path: str):
+        """Deja de contar un retenido (borrado, movido o retomado por un trabajo)"""
+        size = self._retained.pop(path, None)
+        if size is not None:
+            self._retained_bytes -= size
+
+    def refresh_retained(self, paths):
+        """Sincroniza los retenidos con los que siguen en disco (arranque y barridos)"""
+        paths = set(paths)
+        for path in list(self._retained):
+            if path not in paths or not os.path.exists(path):
+                self.forget(path)
+        for path in paths:
+            if path not in self._retained:
+                self.retain(path)
+
+    async def acquire(self, n_bytes: int, suffix: str = '', adopt: Optional[str] = None) -> str:
+        """
+        Reserva n_bytes (esperando si hace falta) y devuelve una ruta nueva del
+        spool. `adopt` es un retenido que el trabajo retoma (un parcial que va a
+        reanudar): pasa a estar cubierto por esta reserva y no se desaloja.
+        """
+        cond = self._condition()
+        async with cond:
+            if adopt:
+                self.forget(adopt)
+            if not self._make_room(n_bytes):
+                self._waiting += 1
+                logger.info(f"💽 Esperando espacio en el spool para {n_bytes / (1024*1024):.1f} MB")
+                try:
+                    while not self._make_room(n_bytes):
+                        await cond.wait()
+                finally:
+                    self._waiting -= 1
+            if self._reserved == 0 and self._disk_free() - self.min_free < n_bytes:
+                raise SpoolFullError(f"No hay espacio en disco para {n_bytes / (1024*1024):.1f} MB")
+            self._reserved += n_bytes
+        path = os.path.join(self.directory, f"spool-{uuid.uuid4().hex}{suffix}")
+        self._active[path] = n_bytes
+        return path
+
+    async def release(self, path: Optional[str]):
+        """Borra el archivo (si sigue ahí) y libera su reserva"""
+        if not path or path not in self._active:
+            return
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"No se pudo borrar {path} del spool: {e}")
+        cond = self._condition()
+        async with cond:
+            self._reserved -= self._active.pop(path)
+            cond.notify_all()
+
+    @asynccontextmanager
+    async def reserve(self, n_bytes: int, suffix: str = ''):
+        path = await self.acquire(n_bytes, suffix)
+        try:
+            yield path
+        finally:
+            await self.release(path)
+
+    def sweep(self, min_age: float = 0, keep=None) -> int:
+        """
+        Borra archivos del spool que no pertenecen a ningún trabajo activo y
+        tienen más de `min_age` segundos. keep(path) -> True los conserva
+        (p. ej. descargas parciales con diario válido).
+        """
+        removed = 0
+        now = time.time()
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if path in self._active:
+                    continue
+                try:
+                    stat = os.stat(path)
+                    if now - stat.st_mtime < min_age or (keep and keep(path)):
+                        continue
+                    os.remove(path)
+                except OSError:
+                    continue
+                removed += 1
+                self.swept_files += 1
+                self.swept_bytes += stat.st_size
+        if removed:
+            logger.info(f"🧹 Spool: {removed} archivos huérfanos eliminados")
+        return removed
+
+    def stats(self) -> dict:
+        used = files = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                try:
+                    used += os.path.getsize(os.path.join(root, name))
+                    files += 1
+                except OSError:
+                    pass
+        return {
+            'directory': self.directory,
+            'quota_mb': round(self.quota / (1024 * 1024), 1),
+            'reserved_mb': round(self._reserved / (1024 * 1024), 1),
+            'retained_files': len(self._retained),
+            'retained_mb': round(self._retained_bytes / (1024 * 1024), 1),
+            'evicted_files': self.evicted_files,
+            'evicted_mb': round(self.evicted_bytes / (1024 * 1024), 1),
+            'used_mb': round(used / (1024 * 1024), 1),
+            'files': files,
+            'active_jobs': len(self._active),
+            'waiting_jobs': self._waiting,
+            'swept_files': self.swept_files,
+            'swept_mb': round(self.swept_bytes / (1024 * 1024), 1),
+        }
+
+
+# ==================== PROGRESO DE TRANSFERENCIAS ====================
+
+class TransferProgress:
+    """
+    Estado en vivo de una transferencia: bytes, velocidad (EWMA por ventanas
+    de 1s), ETA, fase y carril. Si tiene on_update, lo llama como mucho una
+    vez cada `min_interval` segundos y sin bloquear la transferencia (si la
+    edición anterior sigue en curso, se salta).
+    """
+
+    def __init__(self, transfer_id: int, user_id: int, lane: str, label: str, total: int,
+                 on_update=None, min_interval: float = 4.0, tag=None):
+        self.id = transfer_id
+        self.user_id = user_id
+        self.tag = tag  # Trabajo al que pertenece (p. ej. id de la cola MiniApp)
+        self.lane = lane
+        self.label = label
+        self.total = total
+        self.phase = 'queued'
+        self.bytes = 0
+        self.rate = 0.0
+        self.started = time.time()
+        self.on_update = on_update
+        self.min_interval = min_interval
+        self.outcome = None
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._last_progress = self._window_start
+        self._last_emit = 0.0
+        self._emit_task = None
+
+    def set_phase(self, phase: str, total: Optional[int] = None):
+        """Cambia de fase (descarga, subida...) y reinicia el contador de bytes"""
+        self.phase = phase
+        if total is not None:
+            self.total = total
+        self.bytes = 0
+        self._window_bytes = 0
+        self._window_start = self._last_progress = time.monotonic()
+        self._emit(force=True)
+
+    def add(self, n_bytes: int):
+        now = time.monotonic()
+        self.bytes += n_bytes
+        self._window_bytes += n_bytes
+        self._last_progress = now
+        window = now - self._window_start
+        if window >= 1.0:
+            sample = self._window_bytes / window
+            self.rate = sample if not self.rate else 0.3 * sample + 0.7 * self.rate
+            self._window_bytes = 0
+            self._window_start = now
+        self._emit()
+
+    @property
+    def eta(self) -> Optional[float]:
+        if not self.rate or not self.total:
+            return None
+        return max(0.0, (self.total - self.bytes) / self.rate)
+
+    def _emit(self, force: bool = False):
+        if self.on_update is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_emit < self.min_interval:
+            return
+        if self._emit_task is not None and not self._emit_task.done():
+            return
+        self._last_emit = now
+        self._emit_task = asyncio.ensure_future(self._run_update())
+
+    async def _run_update(self):
+        try:
+            await self.on_update(self)
+        except Exception as e:
+            logger.debug(f"Actualización de progreso {self.id} falló: {e}")
+
+    def as_dict(self) -> dict:
+        eta = self.eta
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'tag': self.tag,
+            'lane': self.lane,
+            'label': self.label,
+            'phase': self.phase,
+            'bytes': self.bytes,
+            'total': self.total,
+            'percent': round(100 * self.bytes / self.total, 1) if self.total else None,
+            'mbps': round(self.rate / (1024 * 1024), 2),
+            'eta_seconds': round(eta) if eta is not None else None,
+            'idle_seconds': round(time.monotonic() - self._last_progress, 1),
+            'elapsed_seconds': round(time.time() - self.started, 1),
+            'outcome': self.outcome,
+        }
+
+
+class TransferRegistry:
+    """Transferencias en curso (y las últimas terminadas) para métricas y el panel"""
+
+    def __init__(self, keep_finished: int = 20):
+        self._ids = itertools.count(1)
+        self._active = {}
+        self._finished = []
+        self.keep_finished = keep_finished
+
+    def start(self, user_id: int, lane: str, label: str, total: int, **kwargs) -> TransferProgress:
+        progress = TransferProgress(next(self._ids), user_id, lane, label, total, **kwargs)
+        self._active[progress.id] = progress
+        return progress
+
+    def finish(self, progress: TransferProgress, outcome: str):
+        progress.outcome = outcome
+        progress.phase = 'done'
+        progress.on_update = None
+        # Una edición pendiente no debe pisar el mensaje final (p. ej. "cancelada")
+        if progress._emit_task is not None and not progress._emit_task.done():
+            progress._emit_task.cancel()
+        self._active.pop(progress.id, None)
+        self._finished.append(progress.as_dict())
+        del self._finished[:-self.keep_finished]
+
+    def __len__(self) -> int:
+        return len(self._active)
+
+    def snapshot(self) -> dict:
+        return {
+            'active': [p.as_dict() for p in self._active.values()],
+            'recent': list(self._finished),
+        }
@@ -81,7 +81,7 @@ def main():
         logger.info(f"🏥 Health check: http://{host}:{port}/health")
         
         # We use Gunicorn for production - this is what BLOCKS and keeps process alive
-        logger.info("📦 Server: Gunicorn (4 workers)")
+        logger.info(f"📦 Server: Gunicorn (1 worker, {os.getenv('GUNICORN_THREADS', '16')} threads)")
         print(f"\n✅ SERVICE IS READY AND LISTENING ON {host}:{port}\n", flush=True)
         
         # Iniciar Gunicorn programáticamente
@@ -106,7 +106,9 @@ def main():
         options = {
             'bind': f'{host}:{port}',
             'workers': 1,
-            'threads': 4,
+            # Los streams SSE de la MiniApp ocupan hilos; el panel reparte este
+            # mismo número (GUNICORN_THREADS) entre streams y peticiones normales
+            'threads': int(os.getenv('GUNICORN_THREADS', '16')),
             'timeout': 120,
             'accesslog': '-',
             'errorlog': '-',